@@ -0,0 +1,331 @@
+"""
+Throughput of the data pipeline on synthetic Genius data, from raw lyrics to training batches:
+
+    synthesize            lyricsgenius-style lyrics_*.json, a clean text corpus and a pre-tokenized corpus
+    format                LyricGeniusFormatter.format_batch on the raw songs (needs spaCy with the 'en' model)
+    documents             DocumentDatabase from the text corpus, WordPiece included
+    documents_token_ids   DocumentDatabase from the pre-tokenized corpus
+    instances             create_instances_from_document over every document
+    instances_vectorized  InstanceBuilder batches over every document
+    epoch_json/epoch_npy  generate_shard + merge of one epoch, as pregenerate_training_data.py writes it
+    load_json/load_npy    PregeneratedDataset of that epoch, then every item of it (needs torch)
+
+Everything runs offline on benchmarks/vocab.txt. Results (seconds, items/sec and peak RSS so far of every
+stage) are written as JSON, which --compare checks against an earlier run:
+
+    python benchmarks/bench_pipeline.py --songs 2000 --output before.json
+    python benchmarks/bench_pipeline.py --songs 2000 --output after.json --compare before.json
+    python benchmarks/bench_pipeline.py --compare before.json after.json
+"""
+import os
+import sys
+import json
+import time
+import random
+import platform
+import resource
+import subprocess
+import numpy as np
+
+from pathlib import Path
+from argparse import ArgumentParser, Namespace
+from tempfile import TemporaryDirectory
+
+ROOT = Path(__file__).resolve().parent.parent
+VOCAB = Path(__file__).resolve().parent / 'vocab.txt'
+sys.path.append(str(ROOT / 'lilBERT'))
+sys.path.append(str(ROOT / 'data' / 'formatting'))
+
+from pytorch_pretrained_bert.tokenization import BertTokenizer
+
+from corpus_io import render_song
+from token_corpus import TokenCorpus, TokenCorpusWriter
+from pregenerate_training_data import (DocumentDatabase, create_instances_from_document, generate_shard,
+                                       merge_shards, _shared)
+from instance_builder import InstanceBuilder
+from epoch_format import merge_epoch, write_metrics
+
+STAGES = ['synthesize', 'format', 'documents', 'documents_token_ids', 'instances', 'instances_vectorized',
+          'epoch_json', 'epoch_npy', 'load_json', 'load_npy']
+HEADERS = ['[Intro]', '[Verse {}]', '[Pre-Chorus]', '[Bridge]', '[Outro]']
+
+
+class Stage:
+    """Times a block, counts the items it handled and records the peak RSS at its end"""
+
+    def __init__(self, results, name, unit):
+        self.results = results
+        self.name = name
+        self.unit = unit
+        self.items = 0
+
+    def __enter__(self):
+        print(f'{self.name}...', end=' ', flush=True)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        if exc_type is not None:
+            return False
+        seconds = time.perf_counter() - self.start
+        self.results['stages'][self.name] = {
+            'seconds': round(seconds, 4),
+            'items': self.items,
+            'unit': self.unit,
+            'rate': round(self.items / seconds, 2) if seconds else None,
+            'peak_rss_mb': round(peak_rss_mb(), 1),
+        }
+        print(f'{self.items} {self.unit} in {seconds:.2f}s ({self.items / seconds:,.0f} {self.unit}/s)')
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux, bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / 1024
+
+
+def skip(results, name, reason):
+    results['skipped'][name] = reason
+    print(f'{name}: skipped, {reason}')
+
+
+def word_list(vocab, rng, n_slang=200):
+    """Vocab words plus made up words that WordPiece splits into pieces"""
+    words = [w for w in vocab if w.isalpha() and len(w) > 1]
+    letters = 'abcdefghijklmnopqrstuvwxyz'
+    slang = [''.join(rng.choice(letters) for _ in range(rng.randint(3, 8))) for _ in range(n_slang)]
+    return words + slang
+
+
+def synthetic_song(rng, words, weights, artist, n, sections, lines):
+    """A lyricsgenius-style song: headed sections with a chorus that keeps coming back"""
+    def line():
+        return ' '.join(rng.choices(words, weights, k=rng.randint(4, 12)))
+
+    chorus = [line() for _ in range(lines)]
+    parts, clean = list(), list()
+    for s in range(sections):
+        if s % 2:
+            parts.append('[Chorus]\n' + '\n'.join(chorus))
+            clean.append(chorus)
+        else:
+            verse = [line() for _ in range(lines)]
+            parts.append(rng.choice(HEADERS).format(s // 2 + 1) + '\n' + '\n'.join(verse))
+            clean.append(verse)
+    song = {'title': f'Song {n}', 'year': str(1990 + n % 30), 'image': None, 'lyrics': '\n\n'.join(parts)}
+    return {'artist': artist, 'songs': [song]}, clean
+
+
+def synthesize(work_dir, tokenizer, args):
+    """Writes raw/lyrics_*.json, corpus.txt and the pre-tokenized corpus token_corpus.*, returns the raw paths"""
+    rng = random.Random(args.seed)
+    words = word_list(tokenizer.vocab, rng)
+    weights = [1 / (rank + 1) for rank in range(len(words))]   # Zipf-like
+    raw_dir = work_dir / 'raw'
+    raw_dir.mkdir()
+    raw_files = list()
+    with (work_dir / 'corpus.txt').open('w') as corpus, \
+            TokenCorpusWriter(work_dir / 'token_corpus', 'bench', True) as token_writer:
+        for n in range(args.songs):
+            artist = f'Artist {n % args.artists}'
+            raw, sections = synthetic_song(rng, words, weights, artist, n, args.sections, args.lines)
+            raw_file = raw_dir / f'lyrics_{n}.json'
+            raw_file.write_text(json.dumps(raw))
+            raw_files.append(raw_file)
+            corpus.write(render_song({'sections': sections}))
+            token_writer.add_song(artist, raw['songs'][0]['title'], raw['songs'][0]['year'],
+                                  [[tokenizer.convert_tokens_to_ids(tokenizer.tokenize(l) + ['[SEP]']) for l in s]
+                                   for s in sections])
+    return raw_files
+
+
+def load_text_documents(docs, corpus_file, tokenizer):
+    doc = list()
+    with corpus_file.open() as corpus:
+        for line in corpus:
+            line = line.strip()
+            if line == '':
+                docs.add_document(doc)
+                doc = list()
+            else:
+                doc.append(tokenizer.tokenize(line))
+    if doc:
+        docs.add_document(doc)
+
+
+def generation_args(work_dir, output_format, args):
+    return Namespace(output_dir=work_dir, max_seq_len=args.max_seq_len, short_seq_prob=0.1, masked_lm_prob=0.15,
+                     max_predictions_per_seq=20, output_format=output_format, vectorized=False,
+                     dynamic_masking=False)
+
+
+def run(args):
+    results = {'commit': git_commit(), 'python': platform.python_version(), 'machine': platform.machine(),
+               'config': {k: v for k, v in vars(args).items() if k not in ('output', 'compare', 'work_dir', 'threshold')},
+               'stages': dict(), 'skipped': dict()}
+    stages = args.stages.split(',') if args.stages else STAGES
+    tokenizer = BertTokenizer(str(VOCAB), do_lower_case=True)
+
+    with TemporaryDirectory() as tmp:
+        work_dir = Path(args.work_dir or tmp)
+        work_dir.mkdir(parents=True, exist_ok=True)
+        with Stage(results, 'synthesize', 'songs') as stage:
+            raw_files = synthesize(work_dir, tokenizer, args)
+            stage.items = len(raw_files)
+
+        if 'format' in stages:
+            try:
+                from lyric_formatter import LyricGeniusFormatter
+                formatter = LyricGeniusFormatter(tokenizer_type=str(VOCAB), fast_lang=True)
+            except (ImportError, OSError) as e:
+                skip(results, 'format', f'{type(e).__name__}: {e}')
+            else:
+                with Stage(results, 'format', 'songs') as stage:
+                    for start in range(0, len(raw_files), formatter.lang_batch_size):
+                        formatter.format_batch(raw_files[start:start + formatter.lang_batch_size])
+                    stage.items = len(raw_files)
+
+        if 'documents_token_ids' in stages:
+            with Stage(results, 'documents_token_ids', 'documents') as stage, \
+                    DocumentDatabase(tokenizer.vocab) as docs:
+                for section in TokenCorpus(work_dir / 'token_corpus').iter_sections():
+                    docs.add_document_ids(section)
+                docs.freeze()
+                stage.items = len(docs)
+
+        # Every later stage works on these documents
+        with DocumentDatabase(tokenizer.vocab) as docs:
+            with Stage(results, 'documents', 'documents') as stage:
+                load_text_documents(docs, work_dir / 'corpus.txt', tokenizer)
+                docs.freeze()
+                stage.items = len(docs)
+            results['tokens'] = int(docs.sentence_offsets[-1])
+
+            vocab_list = list(tokenizer.vocab.keys())
+            if 'instances' in stages:
+                with Stage(results, 'instances', 'instances') as stage:
+                    random.seed(args.seed)
+                    for doc_idx in range(len(docs)):
+                        stage.items += len(create_instances_from_document(
+                            docs, doc_idx, max_seq_length=args.max_seq_len, short_seq_prob=0.1,
+                            masked_lm_prob=0.15, max_predictions_per_seq=20, vocab_list=vocab_list))
+
+            if 'instances_vectorized' in stages:
+                with Stage(results, 'instances_vectorized', 'instances') as stage:
+                    builder = InstanceBuilder(docs, args.max_seq_len, 0.1, 0.15, 20, tokenizer.vocab,
+                                              rng=np.random.RandomState(args.seed))
+                    for batch in builder.batches(range(len(docs))):
+                        stage.items += len(batch['lengths'])
+
+            for output_format in ('json', 'npy'):
+                if f'epoch_{output_format}' not in stages and f'load_{output_format}' not in stages:
+                    continue
+                epoch_dir = work_dir / f'epochs_{output_format}'
+                epoch_dir.mkdir(exist_ok=True)
+                gen_args = generation_args(epoch_dir, output_format, args)
+                _shared.update(docs=docs, args=gen_args, vocab_list=vocab_list, tokenizer=tokenizer)
+                with Stage(results, f'epoch_{output_format}', 'instances') as stage:
+                    _, _, shard_output, num_instances = generate_shard((0, 0, 0, len(docs), args.seed))
+                    if output_format == 'npy':
+                        merge_epoch(epoch_dir, 0, [shard_output], args.max_seq_len, 20)
+                    else:
+                        merge_shards(epoch_dir / 'epoch_0.json', [shard_output])
+                    write_metrics(epoch_dir, 0, {'num_training_examples': num_instances,
+                                                 'max_seq_len': args.max_seq_len, 'format': output_format,
+                                                 'max_predictions_per_seq': 20})
+                    stage.items = num_instances
+
+                if f'load_{output_format}' in stages:
+                    try:
+                        from finetune_on_pregenerated import PregeneratedDataset
+                    except ImportError as e:
+                        skip(results, f'load_{output_format}', f'ImportError: {e}')
+                        continue
+                    with Stage(results, f'load_{output_format}', 'instances') as stage:
+                        dataset = PregeneratedDataset(epoch_dir, 0, tokenizer, num_data_epochs=1,
+                                                      train_or_dev='train')
+                        for item in range(len(dataset)):
+                            dataset[item]
+                        stage.items = len(dataset)
+    return results
+
+
+def best_of(runs):
+    """Results of the first run, with every stage's fastest time of all runs"""
+    results = runs[0]
+    for name, stage in results['stages'].items():
+        fastest = min((r['stages'][name] for r in runs), key=lambda s: s['seconds'])
+        stage.update(seconds=fastest['seconds'], rate=fastest['rate'],
+                     peak_rss_mb=max(r['stages'][name]['peak_rss_mb'] for r in runs))
+    results['repeats'] = len(runs)
+    return results
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=str(ROOT),
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(baseline, current, threshold):
+    """Prints the rate of every stage of both runs, returns the stages that got more than threshold slower"""
+    print(f'\n{"stage":<22}{baseline.get("commit") or "baseline":>12}{current.get("commit") or "current":>12}'
+          f'{"change":>9}')
+    regressions = list()
+    for name in STAGES:
+        if name not in baseline['stages'] or name not in current['stages']:
+            continue
+        old, new = baseline['stages'][name]['rate'], current['stages'][name]['rate']
+        change = new / old - 1
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = '  REGRESSION'
+        print(f'{name:<22}{old:>12,.0f}{new:>12,.0f}{change:>+9.1%}{flag}')
+    if baseline['config'] != current['config']:
+        print('Warning! The runs were configured differently, rates may not be comparable')
+    return regressions
+
+
+def main():
+    parser = ArgumentParser(description='Data pipeline benchmarks on synthetic Genius data')
+    parser.add_argument('--songs', type=int, default=1000, help='Synthetic songs to generate')
+    parser.add_argument('--artists', type=int, default=50)
+    parser.add_argument('--sections', type=int, default=6, help='Sections per song, every other one a chorus')
+    parser.add_argument('--lines', type=int, default=8, help='Lines per section')
+    parser.add_argument('--max_seq_len', type=int, default=128)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of every stage, the fastest counts (timings of short runs are noisy)')
+    parser.add_argument('--stages', type=str, default=None,
+                        help=f'Comma separated stages to run (default all: {",".join(STAGES)})')
+    parser.add_argument('--work_dir', type=Path, default=None,
+                        help='Keep the synthetic data here instead of in a temporary directory')
+    parser.add_argument('--output', type=Path, default=None, help='Write the results to this JSON file')
+    parser.add_argument('--compare', type=Path, nargs='+', default=None, metavar='RESULTS',
+                        help='Compare against a baseline results file, or compare two results files without '
+                             'running anything. Exits 1 if a stage regressed')
+    parser.add_argument('--threshold', type=float, default=0.10,
+                        help='Relative slowdown of a stage that counts as a regression')
+    args = parser.parse_args()
+
+    if args.compare and len(args.compare) > 2:
+        parser.error('--compare takes a baseline, or a baseline and a current results file')
+    if args.compare and len(args.compare) == 2:
+        current = json.loads(args.compare[1].read_text())
+    else:
+        current = best_of([run(args) for _ in range(args.repeat)])
+        if args.output:
+            args.output.write_text(json.dumps(current, indent=2))
+            print(f'Results written to {args.output}')
+
+    if args.compare:
+        regressions = compare(json.loads(args.compare[0].read_text()), current, args.threshold)
+        if regressions:
+            exit(f'{len(regressions)} stage(s) regressed by more than {args.threshold:.0%}: {", ".join(regressions)}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,213 @@
+import re
+import sys
+import json
+import sqlite3
+
+from pathlib import Path
+from argparse import ArgumentParser
+from typing import Dict, Iterable, Iterator, List, Optional, Sequence, Tuple, Union
+
+from corpus_io import ShardWriter, render_song
+from splits import SPLITS, CounterSplit, HashSplit
+
+__all__ = ['LyricsCatalog']
+
+
+def parse_year(year) -> Optional[int]:
+    """lyricsgenius years are free text such as '2003-02-04', None or ''"""
+    match = re.search(r'\d{4}', str(year or ''))
+    return int(match.group()) if match else None
+
+
+class LyricsCatalog:
+    """
+    Single-file sqlite store of formatted songs (artist, title, year, sections), indexed by artist and
+    year, so corpora of any subset of artists, years or songs per artist can be written without
+    running the formatter again. Songs are keyed by their raw file, adding a song again replaces it.
+    """
+
+    def __init__(self, catalog_file: Union[str, Path]):
+        self.catalog_file = Path(catalog_file)
+        self.db = sqlite3.connect(str(self.catalog_file))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS songs (
+                id INTEGER PRIMARY KEY,
+                source TEXT UNIQUE,
+                artist TEXT,
+                title TEXT,
+                year INTEGER,
+                date TEXT,
+                n_sections INTEGER,
+                n_lines INTEGER,
+                sections TEXT
+            );
+            CREATE INDEX IF NOT EXISTS songs_artist ON songs (artist);
+            CREATE INDEX IF NOT EXISTS songs_year ON songs (year);
+        ''')
+        self.db.commit()
+        self.pending = list()
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM songs').fetchone()[0]
+
+    @staticmethod
+    def row(formatted_song: Dict, source: str = None) -> Tuple:
+        sections = formatted_song['sections']
+        source = str(source) if source is not None else f'{formatted_song["artist"]}\n{formatted_song["title"]}'
+        return (source, formatted_song['artist'], formatted_song['title'], parse_year(formatted_song['year']),
+                formatted_song['year'], len(sections), sum(len(s) for s in sections), json.dumps(sections))
+
+    def add(self, formatted_song: Dict, source: Union[str, Path] = None):
+        """Buffers one song until the next commit()"""
+        self.pending.append(self.row(formatted_song, source))
+
+    def insert(self, rows: Iterable[Tuple]):
+        with self.db:
+            self.db.executemany(
+                'INSERT OR REPLACE INTO songs (source, artist, title, year, date, n_sections, n_lines, sections) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def add_many(self, formatted_songs: Iterable[Tuple[Dict, Union[str, Path]]]):
+        """Bulk insert of (formatted_song, source) pairs in one transaction"""
+        self.insert(self.row(song, source) for song, source in formatted_songs)
+
+    def commit(self):
+        self.insert(self.pending)
+        self.pending = list()
+
+    def artists(self) -> List[Tuple[str, int]]:
+        """Every artist with their number of songs"""
+        return list(self.db.execute('SELECT artist, COUNT(*) FROM songs GROUP BY artist ORDER BY artist'))
+
+    def years(self) -> List[Tuple[Optional[int], int]]:
+        return list(self.db.execute('SELECT year, COUNT(*) FROM songs GROUP BY year ORDER BY year'))
+
+    def query(self, artists: Sequence[str] = None, year_from: int = None, year_to: int = None,
+              max_per_artist: int = None, min_lines: int = None) -> Iterator[Dict]:
+        """
+        Streams formatted songs in insertion order. Filters use the artist and year indexes;
+        max_per_artist keeps each artist's earliest inserted songs.
+        """
+        where, params = list(), list()
+        if artists:
+            where.append(f'artist IN ({", ".join("?" * len(artists))})')
+            params.extend(artists)
+        if year_from is not None:
+            where.append('year >= ?')
+            params.append(year_from)
+        if year_to is not None:
+            where.append('year <= ?')
+            params.append(year_to)
+        if min_lines is not None:
+            where.append('n_lines >= ?')
+            params.append(min_lines)
+        sql = 'SELECT source, artist, title, date, sections FROM songs'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY id'
+
+        per_artist = dict()
+        for source, artist, title, date, sections in self.db.execute(sql, params):
+            if max_per_artist is not None:
+                if per_artist.get(artist, 0) >= max_per_artist:
+                    continue
+                per_artist[artist] = per_artist.get(artist, 0) + 1
+            yield {'source': source, 'artist': artist, 'title': title, 'year': date,
+                   'sections': json.loads(sections)}
+
+    def export(self, clean_lyrics_dir: Union[str, Path], tokenizer_type: str, splitter=None,
+               compress: bool = True, shard_bytes: int = 256 << 20, **filters) -> Dict[str, int]:
+        """
+        Writes the songs matching filters (see query) to {n}-{train,dev,test}-{tokenizer_type}.txt.gz
+        shards, the same corpus format as clean_lyrics.py. Returns the number of songs per split.
+        """
+        splitter = splitter or CounterSplit()
+        clean_lyrics_dir = Path(clean_lyrics_dir)
+        clean_lyrics_dir.mkdir(parents=True, exist_ok=True)
+
+        writers = {split: ShardWriter(clean_lyrics_dir, f'{split}-{tokenizer_type}',
+                                      compress=compress, shard_bytes=shard_bytes) for split in SPLITS}
+        counts = {split: 0 for split in SPLITS}
+        try:
+            for i, song in enumerate(self.query(**filters), 1):
+                split = splitter.assign(i, song)
+                writers[split].write(render_song(song))
+                counts[split] += 1
+        finally:
+            for w in writers.values():
+                w.close()
+        return counts
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+def main():
+    arp = ArgumentParser(description='List or export subsets of a lyrics catalog built by clean_lyrics.py --catalog')
+    arp.add_argument('-d', '--catalog',
+                     required=True,
+                     help='Catalog sqlite file')
+    arp.add_argument('-c', '--clean-lyrics-dir',
+                     default=None,
+                     help='Directory to write {n}-{train,dev,test}-{tokenizer}.txt.gz shards of the selected songs')
+    arp.add_argument('-t', '--tokenizer-type',
+                     default='bert-base-uncased',
+                     help='Only names the output shards, sections are stored untokenized (Default = bert-base-uncased)')
+    arp.add_argument('-a', '--artist',
+                     action='append', default=None,
+                     help='Only songs of this artist, may be repeated')
+    arp.add_argument('--year-from',
+                     type=int, default=None,
+                     help='Only songs released this year or later')
+    arp.add_argument('--year-to',
+                     type=int, default=None,
+                     help='Only songs released this year or earlier')
+    arp.add_argument('--max-per-artist',
+                     type=int, default=None,
+                     help='At most n songs per artist')
+    arp.add_argument('--min-lines',
+                     type=int, default=None,
+                     help='Only songs with at least n lyric lines')
+    arp.add_argument('-s', '--split-mode',
+                     default='counter',
+                     choices=['counter', 'song', 'artist'],
+                     help='Same as clean_lyrics.py (Default = counter)')
+    arp.add_argument('--split-ratios',
+                     default='0.90,0.05,0.05',
+                     help='train,dev,test ratios of the hash split modes (Default = 0.90,0.05,0.05)')
+    arp.add_argument('--shard-size',
+                     type=int, default=256,
+                     help='Uncompressed MB of text per output shard (Default = 256)')
+    arp.add_argument('--no-compress',
+                     action='store_true',
+                     help='Write plain .txt shards instead of .txt.gz')
+    arp.add_argument('--list-artists',
+                     action='store_true',
+                     help='Print every artist and their number of songs')
+    opts = arp.parse_args()
+
+    with LyricsCatalog(opts.catalog) as catalog:
+        if opts.list_artists:
+            for artist, n_songs in catalog.artists():
+                print(f'{artist}\t{n_songs}')
+
+        if opts.clean_lyrics_dir:
+            splitter = (CounterSplit() if opts.split_mode == 'counter' else
+                        HashSplit([float(r) for r in opts.split_ratios.split(',')], key=opts.split_mode))
+            counts = catalog.export(opts.clean_lyrics_dir, opts.tokenizer_type, splitter=splitter,
+                                    compress=not opts.no_compress, shard_bytes=opts.shard_size << 20,
+                                    artists=opts.artist, year_from=opts.year_from, year_to=opts.year_to,
+                                    max_per_artist=opts.max_per_artist, min_lines=opts.min_lines)
+            print(f'Exported {sum(counts.values())} songs ' +
+                  ', '.join(f'({n} {split})' for split, n in counts.items()), file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
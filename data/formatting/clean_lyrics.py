@@ -2,12 +2,289 @@ import os
 import sys
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
+import json
 import tqdm
+import queue
+import itertools
+import traceback
+import numpy as np
+import multiprocessing as mp
 
 from pathlib import Path
 from argparse import ArgumentParser
 
 from lyric_formatter import *   # Only imports LyricGeniusFormatter class
+from manifest import ProgressManifest
+from corpus_io import ShardWriter, render_song
+from token_corpus import TokenCorpusWriter
+from dedup import DuplicateIndex
+from splits import SPLITS, CounterSplit, HashSplit, in_partition
+from raw_archive import RawArchive
+from catalog import LyricsCatalog
+
+
+class CleanCorpusWriter:
+    """
+    Appends formatted songs to the train/dev/test shards and records them in the progress manifest.
+    Shards are fsync'd before every manifest commit, and anything past the last commit is truncated
+    on startup, so an interrupted run resumes without duplicated or dropped songs.
+    """
+    def __init__(self, clean_lyrics_dir: Path, tokenizer_type: str, manifest_file: Path,
+                 commit_every: int = 256, compress: bool = True, shard_bytes: int = 256 << 20,
+                 token_ids: bool = False, dedup_threshold: float = None, dedup_report: Path = None,
+                 splitter=None, catalog_file: Path = None):
+        self.manifest = ProgressManifest(manifest_file)
+        self.commit_every = commit_every
+        self.splitter = splitter or CounterSplit()
+
+        # Roll back output written after the last commit
+        checkpoints = self.manifest.state.get('shards', dict())
+        self.writers = dict()
+        for split in SPLITS:
+            self.writers[split] = ShardWriter(clean_lyrics_dir, f'{split}-{tokenizer_type}',
+                                              compress=compress, shard_bytes=shard_bytes)
+            if split in checkpoints:
+                self.writers[split].restore(checkpoints[split])
+                # Shards of earlier runs are never appended to, so a corpus pregenerated from them
+                # can be extended with pregenerate_training_data.py --append
+                if checkpoints[split]['offset']:
+                    self.writers[split].rotate()
+
+        # Binary pre-tokenized copy of each split
+        token_checkpoints = self.manifest.state.get('token_corpora', dict())
+        self.token_writers = dict()
+        if token_ids:
+            for split in SPLITS:
+                self.token_writers[split] = TokenCorpusWriter(clean_lyrics_dir/f'{split}-{tokenizer_type}',
+                                                              tokenizer_type, 'uncased' in tokenizer_type)
+                if split in token_checkpoints:
+                    self.token_writers[split].restore(token_checkpoints[split])
+
+        # Near-duplicate index, rebuilt from the committed signatures of kept songs
+        self.dedup = None
+        self.dedup_report = dedup_report
+        if dedup_threshold is not None:
+            self.dedup = DuplicateIndex(threshold=dedup_threshold)
+            for path, signature, info in self.manifest.signatures():
+                self.dedup.insert(path, np.frombuffer(signature, dtype=np.uint32), info)
+
+        # Structured copy of every kept song, replayed songs simply replace their row
+        self.catalog = LyricsCatalog(catalog_file) if catalog_file else None
+
+        # Resume the split counter where the last commit left it
+        self.i = self.manifest.state.get('n_formatted', 0)
+        self.commit()
+
+    def is_duplicate(self, formatted_song, rlf: Path) -> bool:
+        info = {'artist': formatted_song['artist'], 'title': formatted_song['title'],
+                'split': self.splitter.assign(self.i + 1, formatted_song)}
+        signature, match = self.dedup.check(str(rlf), formatted_song['sections'], info)
+        if match is None:
+            if signature is not None:
+                self.manifest.record_signature(rlf, signature.tobytes(), info)
+            return False
+
+        duplicate_of, duplicate_info, similarity = match
+        self.manifest.record_duplicate(rlf, duplicate_of, similarity,
+                                       {'artist': info['artist'], 'title': info['title'],
+                                        'duplicate_of': duplicate_info})
+        return True
+
+    def add(self, formatted_song, rlf: Path, stat=None):
+        split, shard, start, end = None, None, None, None
+        if formatted_song and self.dedup is not None and self.is_duplicate(formatted_song, rlf):
+            split = 'duplicate'
+        elif formatted_song:
+            self.i += 1
+            split = self.splitter.assign(self.i, formatted_song)
+            shard, start, end = self.writers[split].write(render_song(formatted_song))
+            if split in self.token_writers:
+                self.token_writers[split].add_song(formatted_song['artist'], formatted_song['title'],
+                                                   formatted_song['year'], formatted_song['token_ids'])
+            if self.catalog is not None:
+                self.catalog.add(formatted_song, rlf)
+
+        # Record progress
+        self.manifest.record(rlf, split, shard, start, end, stat=stat)
+        if len(self.manifest.pending) >= self.commit_every:
+            self.commit()
+
+    def commit(self):
+        if self.catalog is not None:
+            self.catalog.commit()
+        self.manifest.commit(shards={split: w.checkpoint() for split, w in self.writers.items()},
+                             token_corpora={split: w.checkpoint() for split, w in self.token_writers.items()},
+                             n_formatted=self.i)
+
+    def write_dedup_report(self):
+        tmp = self.dedup_report.with_name(self.dedup_report.name + '.tmp')
+        with open(tmp, 'w') as rf:
+            for path, duplicate_of, similarity, info in self.manifest.duplicates():
+                kept = info['duplicate_of']
+                rf.write(json.dumps({'raw_file': path, 'artist': info['artist'], 'title': info['title'],
+                                     'duplicate_of': duplicate_of, 'duplicate_of_artist': kept['artist'],
+                                     'duplicate_of_title': kept['title'], 'duplicate_of_split': kept['split'],
+                                     'similarity': similarity}) + '\n')
+        os.replace(str(tmp), str(self.dedup_report))
+
+    def close(self):
+        self.commit()
+        for w in list(self.writers.values()) + list(self.token_writers.values()):
+            w.close()
+        if self.dedup is not None and self.dedup_report is not None:
+            self.write_dedup_report()
+        if self.catalog is not None:
+            self.catalog.close()
+        self.manifest.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+def format_songs(LGF: LyricGeniusFormatter, raws):
+    """
+    (formatted_song, error) for every raw song of a batch. If the batch fails, its songs are formatted one at
+    a time, so the error is recorded against each song that fails rather than the whole batch.
+    """
+    try:
+        return [(formatted_song, None) for formatted_song in LGF.format_batch(raws)]
+    except Exception:
+        pass
+    results = list()
+    for raw in raws:
+        try:
+            results.append((LGF.format_batch([raw])[0], None))
+        except Exception:
+            results.append((None, traceback.format_exc()))
+    return results
+
+
+def format_worker(formatter_opts, tasks: mp.Queue, results: mp.Queue):
+    # One formatter per process, spaCy and BertTokenizer are loaded only once
+    LGF = LyricGeniusFormatter(**formatter_opts)
+    for batch in iter(tasks.get, None):
+        formatted_songs = format_songs(LGF, [raw for _, _, _, raw in batch])
+        for (n, rlf, stat, _), (formatted_song, error) in zip(batch, formatted_songs):
+            results.put((n, rlf, stat, formatted_song, error))
+    report_token_cache(LGF)
+    results.put(None)
+
+
+def report_token_cache(LGF: LyricGeniusFormatter):
+    # With several workers each saves its own cache, the last one to finish is kept
+    stats = LGF.save_token_cache()
+    if stats is not None:
+        print(f'Token cache: {stats["hits"]} hits, {stats["misses"]} misses '
+              f'({stats["hit_rate"]:.1%}), {stats["cached_lines"]} lines cached')
+
+
+def report_failures(failed):
+    for rlf, error in failed:
+        print(f'Failed to format {rlf}:\n{error}', file=sys.stderr)
+    if failed:
+        raise RuntimeError(f'Failed to format {len(failed)} files, they are left for the next run: '
+                           + ', '.join(str(rlf) for rlf, _ in failed))
+
+
+def write_worker(n_workers: int, n_files: int, batch_size: int, window: mp.Semaphore, results: mp.Queue,
+                 writer_opts):
+    # Songs arrive out of order, so hold them until every earlier song was written. Every batch written
+    # frees a place in the window of batches the main process may hand out, which bounds pending.
+    pending = dict()
+    failed = list()
+    next_n = 0
+    finished = 0
+    with CleanCorpusWriter(**writer_opts) as writer, tqdm.tqdm(total=n_files) as pbar:
+        while finished < n_workers:
+            result = results.get()
+            if result is None:
+                finished += 1
+                continue
+
+            n, rlf, stat, formatted_song, error = result
+            pending[n] = (rlf, stat, formatted_song, error)
+
+            while next_n in pending:
+                rlf, stat, formatted_song, error = pending.pop(next_n)
+                if error:
+                    # Not recorded as done, so it is tried again next run
+                    failed.append((rlf, error))
+                else:
+                    writer.add(formatted_song, rlf, stat=stat)
+                next_n += 1
+                if next_n % batch_size == 0 or next_n == n_files:
+                    window.release()
+                pbar.update(1)
+    report_failures(failed)
+
+
+def check_alive(workers, writer):
+    if writer.exitcode not in (None, 0) or any(p.exitcode not in (None, 0) for p in workers):
+        raise RuntimeError('A cleaning process exited early, see traceback above')
+
+
+def batched(items, batch_size: int):
+    items = iter(items)
+    batch = list(itertools.islice(items, batch_size))
+    while batch:
+        yield batch
+        batch = list(itertools.islice(items, batch_size))
+
+
+def load_sources(todo, archive: RawArchive = None):
+    """
+    Yields (rlf, stat, raw) for every (rlf, stat) of todo, where raw is what format_batch takes: the file
+    itself, or its song dict streamed from the raw archive in one sequential pass
+    """
+    if archive is None:
+        for rlf, stat in todo:
+            yield rlf, stat, rlf
+        return
+    entries = [archive.by_source[str(rlf)] for rlf, _ in todo]
+    for (rlf, stat), (_, song) in zip(todo, archive.iter_songs(entries)):
+        yield rlf, stat, song
+
+
+def clean_parallel(sources, n_files: int, opts, formatter_opts, writer_opts):
+    ctx = mp.get_context()
+    n_queued = max(1, opts.queue_size // opts.lang_batch_size)
+    tasks = ctx.Queue(maxsize=n_queued)
+    results = ctx.Queue(maxsize=opts.queue_size)
+    # Batches handed out but not yet written: enough to keep the queue full and every worker busy, while a
+    # slow batch holds back at most this many batches of songs in the writer
+    window = ctx.Semaphore(n_queued + 2 * opts.workers)
+
+    workers = [ctx.Process(target=format_worker, args=(formatter_opts, tasks, results))
+               for _ in range(opts.workers)]
+    writer = ctx.Process(target=write_worker,
+                         args=(opts.workers, n_files, opts.lang_batch_size, window, results, writer_opts))
+    for p in workers + [writer]:
+        p.start()
+
+    try:
+        # Stream songs through the bounded queue, bailing out if the writer died
+        tasks_in_order = ((n, rlf, stat, raw) for n, (rlf, stat, raw) in enumerate(sources))
+        for task in itertools.chain(batched(tasks_in_order, opts.lang_batch_size), [None] * opts.workers):
+            while task is not None and not window.acquire(timeout=1):
+                check_alive(workers, writer)
+            while True:
+                try:
+                    tasks.put(task, timeout=1)
+                    break
+                except queue.Full:
+                    check_alive(workers, writer)
+        while writer.is_alive():
+            writer.join(timeout=1)
+            check_alive(workers, writer)
+        check_alive(workers, writer)
+    finally:
+        for p in workers + [writer]:
+            if p.is_alive():
+                p.terminate()
+            p.join()
 
 
 def main():
@@ -15,82 +292,165 @@ def main():
     arp = ArgumentParser()
     arp.add_argument('-r', '--raw-lyrics-dir',
                      required=True,
-                     help='Directory containing raw lyrics_*.json')
+                     help='Directory containing raw lyrics_*.json, or a raw archive packed by raw_archive.py')
     arp.add_argument('-c', '--clean-lyrics-dir',
                      default='./cleanLyrics/',
-                     help='Directory to write clean_lyrics_*.json')
+                     help='Directory to write {n}-{train,dev,test}-{tokenizer}.txt.gz shards')
     arp.add_argument('-t', '--tokenizer-type',
                      default='bert-base-uncased',
                      choices=['bert-base-uncased', 'bert-large-uncased', 'bert-base-cased'],
                      help='Make sure tokenizer type matches downstream model type!'
                           '(Default = bert-base-uncased)')
-    # TODO: Specify train/test/dev split in arp
+    arp.add_argument('-w', '--workers',
+                     type=int, default=1,
+                     help='Number of formatter processes. Output is identical to a serial run (Default = 1)')
+    arp.add_argument('-q', '--queue-size',
+                     type=int, default=None,
+                     help='Max songs waiting between processes (Default = 8 * workers)')
+    arp.add_argument('--fast-lang',
+                     action='store_true',
+                     help='Detect language without the spaCy tagger, parser and NER')
+    arp.add_argument('--lang-sample-lines',
+                     type=int, default=None,
+                     help='Detect language on at most n evenly spaced lines per song (Default = all)')
+    arp.add_argument('--lang-batch-size',
+                     type=int, default=32,
+                     help='Songs per nlp.pipe batch (Default = 32)')
+    arp.add_argument('--lang-report',
+                     type=int, default=0,
+                     help='Before cleaning, report how often the language filter agrees with the full '
+                          'pipeline on the first n songs (Default = 0)')
+    arp.add_argument('--token-ids',
+                     action='store_true',
+                     help='Also write a binary pre-tokenized copy of each split ({split}-{tokenizer}.ids, ...)')
+    arp.add_argument('--dedup-threshold',
+                     type=float, default=None,
+                     help='Drop songs whose estimated Jaccard similarity to an earlier song is at least this, '
+                          'e.g. 0.7 (Default = keep every song)')
+    arp.add_argument('--commit-every',
+                     type=int, default=256,
+                     help='Songs per atomic progress commit (Default = 256)')
+    arp.add_argument('--shard-size',
+                     type=int, default=256,
+                     help='Uncompressed MB of text per output shard (Default = 256)')
+    arp.add_argument('--no-compress',
+                     action='store_true',
+                     help='Write plain .txt shards instead of .txt.gz')
+    arp.add_argument('-s', '--split-mode',
+                     default='counter',
+                     choices=['counter', 'song', 'artist'],
+                     help='counter: every 20th formatted song to dev, the next to test. '
+                          'song/artist: stable hash of artist + title / artist alone, so any subset of files '
+                          'can be cleaned independently and merged (Default = counter)')
+    arp.add_argument('--split-ratios',
+                     default='0.90,0.05,0.05',
+                     help='train,dev,test ratios of the hash split modes (Default = 0.90,0.05,0.05)')
+    arp.add_argument('-p', '--partition',
+                     default=None,
+                     help='K/N: only clean the K-th of N disjoint subsets of the raw files (by file name hash)')
+    arp.add_argument('--catalog',
+                     default=None,
+                     help='Also store every kept song in this sqlite catalog, see catalog.py for building '
+                          'per-artist or per-year corpora from it')
+    arp.add_argument('--token-cache-size',
+                     type=int, default=1 << 18,
+                     help='Lines whose tokens are memoized per process, 0 to disable (Default = 262144)')
+    arp.add_argument('--token-cache-file',
+                     default=None,
+                     help='Load the token cache from and save it to this .json.gz file, so reruns start warm '
+                          '(Default = not saved)')
     opts = arp.parse_args()
+    if opts.queue_size is None:
+        opts.queue_size = 8 * opts.workers
 
-    # Glob raw lyrics_*.json
+    # Glob raw lyrics_*.json, or list those packed into a raw archive
     raw_lyrics_dir = Path(opts.raw_lyrics_dir)
-    raw_lyrics_files = sorted(list(raw_lyrics_dir.glob('*.json')))
-    print(f'Found {len(raw_lyrics_files)} raw lyrics files')
+    archive = None
+    if RawArchive.is_archive(raw_lyrics_dir):
+        archive = RawArchive(raw_lyrics_dir)
+        # Keyed by the original paths and sorted like them, so progress and splits carry over between loose
+        # and packed files
+        raw_lyrics_files = sorted(Path(entry.source) for entry in archive.entries)
+        print(f'Found {len(raw_lyrics_files)} raw lyrics files in archive {raw_lyrics_dir}')
+    else:
+        raw_lyrics_files = sorted(list(raw_lyrics_dir.glob('*.json')))
+        print(f'Found {len(raw_lyrics_files)} raw lyrics files')
+    if opts.partition:
+        partition, n_partitions = (int(p) for p in opts.partition.split('/'))
+        raw_lyrics_files = [rlf for rlf in raw_lyrics_files if in_partition(rlf, partition, n_partitions)]
+        print(f'Cleaning {len(raw_lyrics_files)} files of partition {partition}/{n_partitions}')
 
     # Prepare output paths
     clean_lyrics_dir = Path(opts.clean_lyrics_dir)
     clean_lyrics_dir.mkdir(exist_ok=True)
-    train_file = clean_lyrics_dir/f'train-data-{opts.tokenizer_type}.txt'
-    dev_file = clean_lyrics_dir/f'dev-data-{opts.tokenizer_type}.txt'
-    test_file = clean_lyrics_dir/f'test-data-{opts.tokenizer_type}.txt'
     progress_file = clean_lyrics_dir/f'progress-{opts.tokenizer_type}.txt'
+    manifest_file = clean_lyrics_dir/f'progress-{opts.tokenizer_type}.sqlite'
 
     # Track progress
-    progress = list()
-    if os.path.exists(progress_file):
-        with open(progress_file, 'r') as pf:
-            for line in pf:
-                progress.append(str(line).replace('\n', ''))
-    else:
-        with open(progress_file, 'a') as _:
-            pass
+    with ProgressManifest(manifest_file) as manifest:
+        if not len(manifest) and os.path.exists(progress_file):
+            print(f'Importing progress from {progress_file}')
+            manifest.import_progress_file(progress_file)
+
+        todo = list()
+        changed = 0
+        for rlf in raw_lyrics_files:
+            stat = archive.by_source[str(rlf)].stat if archive else ProgressManifest.stat(rlf)
+            if not manifest.is_done(rlf, stat):
+                if manifest.has_output(rlf):
+                    # Its song is already in the shards and token corpora, writing it again would duplicate it
+                    print(f'Warning! {rlf} changed since it was cleaned, skipping it. Clean into a new '
+                          f'--clean-lyrics-dir to use the new version')
+                    changed += 1
+                    continue
+                if rlf in manifest:
+                    print(f'{rlf} changed since it was cleaned, cleaning it again (nothing was written for it)')
+                todo.append((rlf, stat))
+    print(f'Skipping {len(raw_lyrics_files) - len(todo) - changed} already cleaned and {changed} changed files')
 
-    # Init
     do_lower_case = True if 'uncased' in opts.tokenizer_type else False
-    LGF = LyricGeniusFormatter(opts.tokenizer_type, do_lower_case=do_lower_case)
+    formatter_opts = dict(tokenizer_type=opts.tokenizer_type, do_lower_case=do_lower_case,
+                          fast_lang=opts.fast_lang, lang_sample_lines=opts.lang_sample_lines,
+                          lang_batch_size=opts.lang_batch_size, emit_token_ids=opts.token_ids,
+                          token_cache_size=opts.token_cache_size,
+                          token_cache_file=opts.token_cache_file)
+    writer_opts = dict(clean_lyrics_dir=clean_lyrics_dir, tokenizer_type=opts.tokenizer_type,
+                       manifest_file=manifest_file, commit_every=opts.commit_every,
+                       compress=not opts.no_compress, shard_bytes=opts.shard_size << 20,
+                       token_ids=opts.token_ids, dedup_threshold=opts.dedup_threshold,
+                       dedup_report=clean_lyrics_dir/f'duplicates-{opts.tokenizer_type}.jsonl',
+                       splitter=CounterSplit() if opts.split_mode == 'counter' else
+                       HashSplit([float(r) for r in opts.split_ratios.split(',')], key=opts.split_mode),
+                       catalog_file=opts.catalog)
+
+    # Compare language filter against the full 0.80 threshold pipeline
+    if opts.lang_report:
+        LGF = LyricGeniusFormatter(**formatter_opts)
+        raws = [raw if isinstance(raw, dict) else LGF.load_song(raw)
+                for _, _, raw in load_sources(todo[:opts.lang_report], archive)]
+        texts = [str(raw['songs'][0]['lyrics']) for raw in raws]
+        report = LGF.lang_agreement(texts)
+        print(f'Language filter agrees with the full pipeline on {report["agree"]}/{report["n"]} songs '
+              f'({report["only_here_accepted"]} accepted only by the filter, '
+              f'{report["only_full_accepted"]} accepted only by the full pipeline)')
 
     # Clean text and write to dev, test, and train files
-    i = 0
-    for rlf in tqdm.tqdm(raw_lyrics_files):
-        if str(rlf) not in progress:
-            formatted_song = LGF.format_lyrics(rlf)
-
-            if formatted_song:
-                i += 1
-
-                # 5% to dev
-                if i % 20 == 0:
-                    with open(dev_file, 'a') as df:
-                        for section in formatted_song['sections']:
-                            for l in section:
-                                df.write(f'{l} [SEP] \n')
-                            df.write('\n')  # Double newline between sections
-
-                # 5% to test
-                elif i % 20 == 1:
-                    with open(test_file, 'a') as tef:
-                        for section in formatted_song['sections']:
-                            for l in section:
-                                tef.write(f'{l} [SEP] \n')
-                            tef.write('\n')
-
-                # 90% to train
-                else:
-                    with open(train_file, 'a') as trf:
-                        for section in formatted_song['sections']:
-                            for l in section:
-                                trf.write(f'{l} [SEP] \n')
-                            trf.write('\n')
-
-            # Record progress
-            progress.append(str(rlf))
-            with open(progress_file, 'a') as pf:
-                pf.write(f'{rlf}\n')
+    if opts.workers > 1:
+        clean_parallel(load_sources(todo, archive), len(todo), opts, formatter_opts, writer_opts)
+    else:
+        LGF = LyricGeniusFormatter(**formatter_opts)
+        failed = list()
+        with CleanCorpusWriter(**writer_opts) as writer, tqdm.tqdm(total=len(todo)) as pbar:
+            for batch in batched(load_sources(todo, archive), opts.lang_batch_size):
+                formatted_songs = format_songs(LGF, [raw for _, _, raw in batch])
+                for (rlf, stat, _), (formatted_song, error) in zip(batch, formatted_songs):
+                    if error:
+                        failed.append((rlf, error))
+                    else:
+                        writer.add(formatted_song, rlf, stat=stat)
+                pbar.update(len(batch))
+        report_token_cache(LGF)
+        report_failures(failed)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,251 @@
+import os
+import re
+import glob
+import gzip
+import queue
+import threading
+
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Sequence, Tuple, Union
+
+__all__ = ['ShardWriter', 'expand_corpus', 'open_corpus', 'iter_corpus_lines', 'render_song']
+
+Corpus = Union[str, Path, Sequence[Union[str, Path]]]
+
+
+def _natural_key(path: Union[str, Path]):
+    # So that shard 100 sorts after shard 99
+    return [int(part) if part.isdigit() else part for part in re.split(r'(\d+)', str(path))]
+
+
+def expand_corpus(corpus: Corpus) -> List[Path]:
+    """
+    Resolves a corpus spec to an ordered list of files. A spec is a file, a directory (all *.txt and
+    *.txt.gz inside), a glob pattern such as 'cleanLyrics/*-train-*.txt.gz', or a list of any of these.
+    """
+    if isinstance(corpus, (str, Path)):
+        corpus = [corpus]
+
+    paths = list()
+    for spec in corpus:
+        spec = str(spec)
+        if os.path.isdir(spec):
+            paths.extend(sorted(list(Path(spec).glob('*.txt')) + list(Path(spec).glob('*.txt.gz')),
+                                key=_natural_key))
+        elif glob.has_magic(spec):
+            paths.extend(Path(p) for p in sorted(glob.glob(spec), key=_natural_key))
+        else:
+            paths.append(Path(spec))
+
+    if not paths:
+        raise FileNotFoundError(f'No corpus files match {corpus}')
+    return paths
+
+
+def open_corpus(path: Union[str, Path], mode: str = 'rt', encoding: str = 'utf-8'):
+    """Opens plain or gzipped (*.gz) corpus files alike"""
+    if str(path).endswith('.gz'):
+        return gzip.open(str(path), mode, encoding=None if 'b' in mode else encoding)
+    return open(str(path), mode, encoding=None if 'b' in mode else encoding)
+
+
+def render_song(formatted_song: Dict) -> str:
+    """One line per lyric line, a blank line after every section (the documents of the corpus)"""
+    lines = list()
+    for section in formatted_song['sections']:
+        for l in section:
+            lines.append(f'{l} [SEP] \n')
+        lines.append('\n')  # Double newline between sections
+    return ''.join(lines)
+
+
+def _put(q: queue.Queue, item, stop: threading.Event):
+    while not stop.is_set():
+        try:
+            q.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+def _read_blocks(path: Path, q: queue.Queue, block_size: int, stop: threading.Event):
+    # zlib releases the GIL, so shards decompress in parallel on plain threads
+    try:
+        with open_corpus(path, 'rb') as f:
+            while not stop.is_set():
+                block = f.read(block_size)
+                if not block:
+                    break
+                _put(q, block, stop)
+    except BaseException as e:
+        _put(q, e, stop)
+    _put(q, None, stop)
+
+
+def iter_corpus_lines(corpus: Corpus, workers: int = 1, encoding: str = 'utf-8',
+                      block_size: int = 1 << 20, blocks_per_shard: int = 8) -> Iterator[str]:
+    """
+    Streams the lines of every shard in order, as if they were one file. With workers > 1, the next
+    `workers` shards are decompressed ahead in background threads. Memory stays bounded by
+    (workers + 1) * blocks_per_shard * block_size.
+    """
+    paths = expand_corpus(corpus)
+    if workers <= 1 or len(paths) == 1:
+        for path in paths:
+            with open_corpus(path, 'rt', encoding=encoding) as f:
+                for line in f:
+                    yield line
+        return
+
+    stop = threading.Event()
+    pending_paths = iter(paths)
+    in_flight = deque()
+
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def read_ahead():
+            path = next(pending_paths, None)
+            if path is not None:
+                q = queue.Queue(maxsize=blocks_per_shard)
+                pool.submit(_read_blocks, path, q, block_size, stop)
+                in_flight.append(q)
+
+        try:
+            for _ in range(workers):
+                read_ahead()
+
+            while in_flight:
+                q = in_flight.popleft()
+                read_ahead()
+                tail = b''
+                for block in iter(q.get, None):
+                    if isinstance(block, BaseException):
+                        raise block
+                    lines = (tail + block).split(b'\n')
+                    tail = lines.pop()
+                    for line in lines:
+                        yield line.decode(encoding) + '\n'
+                if tail:
+                    yield tail.decode(encoding)
+        finally:
+            stop.set()
+
+
+class ShardWriter:
+    """
+    Buffered writer of size-rotated corpus shards named '{n:02d}-{name}.txt.gz' (or '.txt').
+
+    Documents are never split across shards: a new shard is started before a write once the current
+    one holds shard_bytes of uncompressed text. checkpoint() flushes everything to disk and returns a
+    state that restore() can later truncate back to. With compression on, every checkpoint closes a
+    gzip member, so a shard truncated at a checkpoint is still a valid (multi-member) gzip file.
+    """
+    Checkpoint = Dict[str, int]
+
+    def __init__(self, out_dir: Union[str, Path], name: str, compress: bool = True,
+                 shard_bytes: int = 256 << 20, buffer_bytes: int = 4 << 20, compresslevel: int = 6):
+        self.out_dir = Path(out_dir)
+        self.name = name
+        self.compress = compress
+        self.shard_bytes = shard_bytes
+        self.buffer_bytes = buffer_bytes
+        self.compresslevel = compresslevel
+
+        self.buffer = list()
+        self.buffered = 0
+        self.handle = None
+
+        # Never append to shards of unknown state, start after the last existing one
+        existing = self.existing_shards()
+        self.shard = existing[-1] + 1 if existing else 0
+        self.raw_offset = 0
+
+    @property
+    def suffix(self) -> str:
+        return '.txt.gz' if self.compress else '.txt'
+
+    def shard_path(self, shard: int) -> Path:
+        return self.out_dir/f'{shard:02d}-{self.name}{self.suffix}'
+
+    def existing_shards(self) -> List[int]:
+        pattern = re.compile(rf'^(\d+)-{re.escape(self.name)}{re.escape(self.suffix)}$')
+        matches = (pattern.match(p.name) for p in self.out_dir.glob(f'*-{self.name}{self.suffix}'))
+        return sorted(int(m.group(1)) for m in matches if m)
+
+    def write(self, text: str) -> Tuple[int, int, int]:
+        """Writes one document. Returns its shard and uncompressed start/end offsets within the shard"""
+        if self.raw_offset >= self.shard_bytes:
+            self.rotate()
+
+        data = text.encode('utf-8')
+        start = self.raw_offset
+        self.raw_offset += len(data)
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.buffer_bytes:
+            self.flush()
+        return self.shard, start, self.raw_offset
+
+    def flush(self):
+        if not self.buffer:
+            return
+        if self.handle is None:
+            path = self.shard_path(self.shard)
+            self.handle = (gzip.open(str(path), 'ab', compresslevel=self.compresslevel) if self.compress
+                           else open(path, 'ab'))
+        self.handle.write(b''.join(self.buffer))
+        self.buffer = list()
+        self.buffered = 0
+
+    def close_handle(self):
+        self.flush()
+        if self.handle is not None:
+            self.handle.close()
+            self.handle = None
+
+    def sync(self) -> int:
+        """Closes and fsyncs the current shard, returns its size on disk"""
+        self.close_handle()
+        path = self.shard_path(self.shard)
+        if not path.exists():
+            return 0
+        with open(path, 'ab') as f:
+            os.fsync(f.fileno())
+        return path.stat().st_size
+
+    def rotate(self):
+        self.sync()
+        self.shard += 1
+        self.raw_offset = 0
+
+    def checkpoint(self) -> Checkpoint:
+        offset = self.sync()
+        return {'shard': self.shard, 'offset': offset, 'raw_offset': self.raw_offset}
+
+    def restore(self, checkpoint: Checkpoint):
+        """Drops everything written after checkpoint"""
+        self.buffer = list()
+        self.buffered = 0
+        self.handle = None
+
+        for shard in self.existing_shards():
+            path = self.shard_path(shard)
+            if shard > checkpoint['shard']:
+                print(f'Rolling back uncommitted shard {path}')
+                path.unlink()
+            elif shard == checkpoint['shard'] and path.stat().st_size > checkpoint['offset']:
+                print(f'Rolling back {path.stat().st_size - checkpoint["offset"]} uncommitted bytes of {path}')
+                os.truncate(path, checkpoint['offset'])
+
+        self.shard = checkpoint['shard']
+        self.raw_offset = checkpoint['raw_offset']
+
+    def close(self):
+        self.close_handle()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
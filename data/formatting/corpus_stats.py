@@ -0,0 +1,282 @@
+import sys
+import csv
+import json
+import tqdm
+import numpy as np
+import multiprocessing as mp
+
+from pathlib import Path
+from collections import Counter
+from argparse import ArgumentParser
+from typing import Dict, List, Sequence
+
+from catalog import parse_year
+from raw_archive import RawArchive
+from token_corpus import TokenCorpus
+
+__all__ = ['CorpusStats']
+
+
+class CorpusStats:
+    """
+    Mergeable count arrays of a corpus: per artist a term count array over the vocabulary, song/section/
+    line/token/[UNK] totals and a year histogram, plus global histograms of tokens per line, lines per
+    section and sections per song (lengths past max_len are counted in the last bin). Memory is bounded by
+    n_artists * vocab_size counts, however many songs go through. Each line's trailing [SEP] isn't counted.
+    """
+
+    def __init__(self, vocab_size: int, unk_id: int, sep_id: int, max_len: int = 256):
+        self.vocab_size = vocab_size
+        self.unk_id = unk_id
+        self.sep_id = sep_id
+        self.max_len = max_len
+        self.artists = dict()
+        self.line_hist = np.zeros(max_len + 1, dtype=np.int64)
+        self.section_hist = np.zeros(max_len + 1, dtype=np.int64)
+        self.song_hist = np.zeros(max_len + 1, dtype=np.int64)
+
+    def artist(self, name: str) -> Dict:
+        if name not in self.artists:
+            self.artists[name] = {'counts': np.zeros(self.vocab_size, dtype=np.uint32), 'years': Counter(),
+                                  'n_songs': 0, 'n_sections': 0, 'n_lines': 0, 'n_tokens': 0, 'n_unk': 0}
+        return self.artists[name]
+
+    def hist(self, lengths: np.ndarray) -> np.ndarray:
+        return np.bincount(np.minimum(lengths, self.max_len), minlength=self.max_len + 1)
+
+    def add(self, artist: str, years: Sequence, ids: np.ndarray, line_lengths: np.ndarray,
+            section_lengths: np.ndarray, song_lengths: np.ndarray):
+        """
+        Adds consecutive songs of one artist: ids of all their lines back to back, then tokens per line
+        (with [SEP]), lines per section and sections per song.
+        """
+        a = self.artist(artist)
+        counts = np.bincount(ids, minlength=self.vocab_size)
+        counts[self.sep_id] = 0
+        a['counts'] += counts.astype(np.uint32)
+        a['years'].update(parse_year(y) for y in years)
+        a['n_songs'] += len(song_lengths)
+        a['n_sections'] += len(section_lengths)
+        a['n_lines'] += len(line_lengths)
+        a['n_tokens'] += int(counts.sum())
+        a['n_unk'] += int(counts[self.unk_id])
+
+        self.line_hist += self.hist(line_lengths - 1)
+        self.section_hist += self.hist(section_lengths)
+        self.song_hist += self.hist(song_lengths)
+
+    def add_song(self, artist: str, year, token_ids: List[List[List[int]]]):
+        """Adds one song as sections of lines of ids, e.g. LyricGeniusFormatter's Cleaned['token_ids']"""
+        lines = [line for section in token_ids for line in section]
+        self.add(artist, [year], np.fromiter((i for line in lines for i in line), dtype=np.int64),
+                 np.array([len(line) for line in lines], dtype=np.int64),
+                 np.array([len(section) for section in token_ids], dtype=np.int64),
+                 np.array([len(token_ids)], dtype=np.int64))
+
+    def merge(self, other: 'CorpusStats'):
+        for name, b in other.artists.items():
+            a = self.artist(name)
+            for key, value in b.items():
+                a[key] += value
+        self.line_hist += other.line_hist
+        self.section_hist += other.section_hist
+        self.song_hist += other.song_hist
+
+    @staticmethod
+    def hist_summary(hist: np.ndarray) -> Dict:
+        n = int(hist.sum())
+        if not n:
+            return {'n': 0}
+        cumulative = np.cumsum(hist)
+        return {'n': n, 'mean': float((hist * np.arange(len(hist))).sum() / n),
+                'median': int(np.searchsorted(cumulative, n / 2)),
+                'p95': int(np.searchsorted(cumulative, 0.95 * n)),
+                'max_bin': int(np.nonzero(hist)[0][-1]),
+                'hist': hist[:int(np.nonzero(hist)[0][-1]) + 1].tolist()}
+
+    @staticmethod
+    def frequency_histogram(counts: np.ndarray) -> List[int]:
+        """Number of terms used 1, 2-3, 4-7, 8-15, ... times"""
+        used = counts[counts > 0]
+        if not len(used):
+            return list()
+        return np.bincount(np.log2(used).astype(np.int64)).tolist()
+
+    def artist_report(self, name: str, ids_to_tokens=None, top_k: int = 20) -> Dict:
+        a = self.artists[name]
+        counts = a['counts']
+        years = sorted(y for y in a['years'] if y is not None)
+        report = {'artist': name, 'n_songs': a['n_songs'], 'n_sections': a['n_sections'], 'n_lines': a['n_lines'],
+                  'n_tokens': a['n_tokens'], 'vocab_size': int(np.count_nonzero(counts)),
+                  'unk_rate': a['n_unk'] / a['n_tokens'] if a['n_tokens'] else 0.0,
+                  'first_year': years[0] if years else None, 'last_year': years[-1] if years else None,
+                  'n_undated': a['years'].get(None, 0),
+                  'years': {str(y): a['years'][y] for y in years},
+                  'term_frequency_histogram': self.frequency_histogram(counts)}
+        top = np.argsort(-counts.astype(np.int64), kind='stable')[:top_k]
+        top = [int(i) for i in top if counts[i]]
+        report['top_terms'] = [[ids_to_tokens([i])[0] if ids_to_tokens else i, int(counts[i])] for i in top]
+        return report
+
+    def report(self, ids_to_tokens=None, top_k: int = 20) -> Dict:
+        total = np.zeros(self.vocab_size, dtype=np.int64)
+        for a in self.artists.values():
+            total += a['counts']
+        years = Counter()
+        for a in self.artists.values():
+            years.update(a['years'])
+        n_tokens = sum(a['n_tokens'] for a in self.artists.values())
+        return {'n_artists': len(self.artists),
+                'n_songs': sum(a['n_songs'] for a in self.artists.values()),
+                'n_tokens': n_tokens,
+                'vocab_size': int(np.count_nonzero(total)),
+                'unk_rate': sum(a['n_unk'] for a in self.artists.values()) / n_tokens if n_tokens else 0.0,
+                'years': {str(y): n for y, n in sorted(years.items(), key=lambda yn: (yn[0] is None, yn[0] or 0))},
+                'term_frequency_histogram': self.frequency_histogram(total),
+                'tokens_per_line': self.hist_summary(self.line_hist),
+                'lines_per_section': self.hist_summary(self.section_hist),
+                'sections_per_song': self.hist_summary(self.song_hist),
+                'artists': [self.artist_report(name, ids_to_tokens, top_k) for name in sorted(self.artists)]}
+
+    @staticmethod
+    def write_csv(report: Dict, csv_file: Path):
+        columns = ['artist', 'n_songs', 'n_sections', 'n_lines', 'n_tokens', 'vocab_size', 'unk_rate',
+                   'first_year', 'last_year', 'n_undated']
+        with open(csv_file, 'w', newline='') as cf:
+            writer = csv.writer(cf)
+            writer.writerow(columns)
+            for artist in report['artists']:
+                writer.writerow([artist[c] for c in columns])
+
+
+def token_corpus_stats(job) -> CorpusStats:
+    """
+    Stats of songs [start, end) of a token corpus, one bincount per run of songs by the same artist.
+    meta holds the (artist, year) of those songs, read from the .meta file by the parent.
+    """
+    prefix, start, end, meta, vocab_size, unk_id, sep_id = job
+    corpus = TokenCorpus(prefix)
+    stats = CorpusStats(vocab_size, unk_id, sep_id)
+
+    run_start = start
+    for s in range(start, end + 1):
+        if s < end and meta[s - start][0] == meta[run_start - start][0]:
+            continue
+        s0, s1 = corpus.song_offsets[run_start], corpus.song_offsets[s]
+        l0, l1 = corpus.section_offsets[s0], corpus.section_offsets[s1]
+        stats.add(meta[run_start - start][0], [year for _, year in meta[run_start - start:s - start]],
+                  np.asarray(corpus.ids[corpus.line_offsets[l0]:corpus.line_offsets[l1]]),
+                  np.diff(corpus.line_offsets[l0:l1 + 1]),
+                  np.diff(corpus.section_offsets[s0:s1 + 1]),
+                  np.diff(corpus.song_offsets[run_start:s + 1]))
+        run_start = s
+    return stats
+
+
+_formatter = None
+
+
+def init_formatter(formatter_opts):
+    # One formatter per pool process, spaCy and BertTokenizer are loaded only once
+    global _formatter
+    from lyric_formatter import LyricGeniusFormatter
+    _formatter = LyricGeniusFormatter(**formatter_opts)
+
+
+def raw_archive_stats(job) -> CorpusStats:
+    """
+    Stats of a slice of archive entries (read from the index by the parent), formatted (language filter
+    included) as clean_lyrics.py would with the same formatter options
+    """
+    archive_dir, entries, vocab_size, unk_id, sep_id = job
+    archive = RawArchive(archive_dir, entries)
+    stats = CorpusStats(vocab_size, unk_id, sep_id)
+    songs = [song for _, song in archive.iter_songs()]
+    for formatted_song in _formatter.format_batch(songs):
+        if formatted_song and formatted_song['token_ids']:
+            stats.add_song(formatted_song['artist'], formatted_song['year'], formatted_song['token_ids'])
+    return stats
+
+
+def main():
+    arp = ArgumentParser(description='One-pass corpus statistics for the dataset datasheet')
+    arp.add_argument('corpus',
+                     nargs='+',
+                     help='Pre-tokenized corpus prefixes written by clean_lyrics.py --token-ids '
+                          '(e.g. cleanLyrics/train-bert-base-uncased), or one raw archive directory')
+    arp.add_argument('-o', '--output-prefix',
+                     default='corpus-stats',
+                     help='Writes {prefix}.json (everything) and {prefix}.csv (one row per artist)')
+    arp.add_argument('-t', '--tokenizer-type',
+                     default=None,
+                     help='Tokenizer of a raw archive (Default = the token corpus header, else bert-base-uncased)')
+    arp.add_argument('-w', '--workers',
+                     type=int, default=mp.cpu_count(),
+                     help='Number of processes (Default = all cores)')
+    arp.add_argument('--chunk-size',
+                     type=int, default=2000,
+                     help='Songs per task (Default = 2000)')
+    arp.add_argument('--top-k',
+                     type=int, default=20,
+                     help='Most frequent terms listed per artist (Default = 20)')
+    arp.add_argument('--fast-lang',
+                     action='store_true',
+                     help='Raw archive: detect language without the spaCy tagger, parser and NER, '
+                          'as clean_lyrics.py --fast-lang')
+    arp.add_argument('--lang-sample-lines',
+                     type=int, default=None,
+                     help='Raw archive: detect language on at most n evenly spaced lines per song, '
+                          'as clean_lyrics.py (Default = all)')
+    arp.add_argument('--lang-batch-size',
+                     type=int, default=32,
+                     help='Raw archive: songs per nlp.pipe batch (Default = 32)')
+    opts = arp.parse_args()
+
+    from pytorch_pretrained_bert import BertTokenizer
+
+    is_archive = RawArchive.is_archive(opts.corpus[0])
+    tokenizer_type = opts.tokenizer_type
+    if tokenizer_type is None:
+        tokenizer_type = 'bert-base-uncased' if is_archive else TokenCorpus(opts.corpus[0]).tokenizer_type
+    do_lower_case = 'uncased' in tokenizer_type
+    toke = BertTokenizer.from_pretrained(tokenizer_type, do_lower_case=do_lower_case)
+    vocab = (len(toke.vocab), toke.vocab['[UNK]'], toke.vocab['[SEP]'])
+
+    jobs = list()
+    if is_archive:
+        entries = RawArchive(opts.corpus[0]).entries
+        jobs = [(opts.corpus[0], entries[s:s + opts.chunk_size]) + vocab
+                for s in range(0, len(entries), opts.chunk_size)]
+        work = raw_archive_stats
+        pool = mp.Pool(opts.workers, initializer=init_formatter,
+                       initargs=(dict(tokenizer_type=tokenizer_type, do_lower_case=do_lower_case,
+                                      fast_lang=opts.fast_lang, lang_sample_lines=opts.lang_sample_lines,
+                                      lang_batch_size=opts.lang_batch_size, emit_token_ids=True),))
+    else:
+        for prefix in opts.corpus:
+            corpus = TokenCorpus(prefix)
+            if corpus.tokenizer_type != tokenizer_type:
+                print(f'{prefix} was tokenized with {corpus.tokenizer_type}, not {tokenizer_type}', file=sys.stderr)
+            meta = [(m['artist'], m['year']) for m in corpus.meta]
+            jobs.extend((prefix, s, min(s + opts.chunk_size, corpus.n_songs), meta[s:s + opts.chunk_size]) + vocab
+                        for s in range(0, corpus.n_songs, opts.chunk_size))
+        work = token_corpus_stats
+        pool = mp.Pool(opts.workers)
+
+    stats = CorpusStats(*vocab)
+    with pool:
+        for partial in tqdm.tqdm(pool.imap_unordered(work, jobs), total=len(jobs)):
+            stats.merge(partial)
+
+    report = stats.report(toke.convert_ids_to_tokens, top_k=opts.top_k)
+    report['tokenizer_type'] = tokenizer_type
+    report['corpus'] = opts.corpus
+    with open(f'{opts.output_prefix}.json', 'w') as jf:
+        json.dump(report, jf)
+    CorpusStats.write_csv(report, Path(f'{opts.output_prefix}.csv'))
+    print(f'{report["n_songs"]} songs by {report["n_artists"]} artists, {report["n_tokens"]} tokens, '
+          f'vocabulary {report["vocab_size"]}, [UNK] rate {report["unk_rate"]:.4%}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+import re
+import zlib
+import numpy as np
+
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+
+__all__ = ['DuplicateIndex']
+
+# Largest prime below 2**32, so (a * x + b) of 32 bit hashes never overflows uint64
+PRIME = np.uint64(4294967291)
+
+
+class DuplicateIndex:
+    """
+    Streaming MinHash/LSH index for near-duplicate songs.
+
+    Songs are reduced to word shingle_size-grams of their normalized sections, so the same lyrics under
+    another artist, or a clean/explicit/remaster variant, still share most shingles. Each song keeps a
+    num_perm MinHash signature; signatures are banded into LSH buckets and a song is a duplicate if any
+    bucket-mate agrees on at least `threshold` of its signature (estimated Jaccard similarity).
+    At most max_songs signatures are kept, the oldest are evicted first.
+    """
+    Match = Tuple[str, Dict, float]
+
+    def __init__(self, threshold: float = 0.7, num_perm: int = 64, bands: int = 16, shingle_size: int = 4,
+                 max_songs: int = 500000, seed: int = 1):
+        assert num_perm % bands == 0, 'num_perm must be a multiple of bands'
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.bands = bands
+        self.shingle_size = shingle_size
+        self.max_songs = max_songs
+
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, int(PRIME), size=(num_perm, 1), dtype=np.uint64)
+        self.b = rng.randint(0, int(PRIME), size=(num_perm, 1), dtype=np.uint64)
+
+        self.buckets = [dict() for _ in range(bands)]   # band bytes -> song key
+        self.songs = OrderedDict()                      # song key -> (signature, info)
+
+    def __len__(self):
+        return len(self.songs)
+
+    @staticmethod
+    def normalize(line: str) -> str:
+        return ' '.join(re.sub(r"[^\w\s]|_", '', line.lower()).split())
+
+    def shingles(self, sections: List[List[str]]) -> np.ndarray:
+        hashes = set()
+        for section in sections:
+            words = ' '.join(self.normalize(l) for l in section).split()
+            n = max(1, len(words) - self.shingle_size + 1)
+            for w in range(n):
+                hashes.add(zlib.crc32(' '.join(words[w:w + self.shingle_size]).encode('utf-8')))
+        return np.fromiter(hashes, dtype=np.uint64, count=len(hashes))
+
+    def signature(self, sections: List[List[str]]) -> Optional[np.ndarray]:
+        shingles = self.shingles(sections)
+        if not len(shingles):
+            return None
+        return ((self.a * shingles[None, :] + self.b) % PRIME).min(axis=1).astype(np.uint32)
+
+    def band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [band.tobytes() for band in signature.reshape(self.bands, -1)]
+
+    def query(self, key: str, signature: np.ndarray) -> Optional[Match]:
+        best = None
+        for band, band_key in enumerate(self.band_keys(signature)):
+            candidate = self.buckets[band].get(band_key)
+            # A rolled back song may be cleaned again, it isn't a duplicate of itself
+            if candidate is None or candidate == key or (best and candidate == best[0]):
+                continue
+            candidate_signature, candidate_info = self.songs[candidate]
+            similarity = float(np.mean(candidate_signature == signature))
+            if similarity >= self.threshold and (best is None or similarity > best[2]):
+                best = (candidate, candidate_info, similarity)
+        return best
+
+    def insert(self, key: str, signature: np.ndarray, info: Dict):
+        self.songs[key] = (signature, info)
+        for band, band_key in enumerate(self.band_keys(signature)):
+            self.buckets[band][band_key] = key
+
+        # Bounded memory: forget the oldest songs
+        while self.max_songs and len(self.songs) > self.max_songs:
+            old_key, (old_signature, _) = self.songs.popitem(last=False)
+            for band, band_key in enumerate(self.band_keys(old_signature)):
+                if self.buckets[band].get(band_key) == old_key:
+                    del self.buckets[band][band_key]
+
+    def check(self, key: str, sections: List[List[str]], info: Dict) -> Tuple[Optional[np.ndarray], Optional[Match]]:
+        """
+        Returns (signature, match). A song without a match is inserted and should be kept, a song with
+        a match is a near-duplicate of the matched (key, info, similarity) and is not inserted.
+        """
+        signature = self.signature(sections)
+        if signature is None:
+            return None, None
+        match = self.query(key, signature)
+        if match is None:
+            self.insert(key, signature, info)
+        return signature, match
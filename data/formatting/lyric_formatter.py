@@ -6,6 +6,7 @@ from pathlib import Path
 from typing import List, Dict, Union
 from spacy_langdetect import LanguageDetector
 from pytorch_pretrained_bert import BertTokenizer
+from token_cache import CachedTokenizer
 
 __all__ = ['LyricGeniusFormatter']
 
@@ -15,11 +16,27 @@ class LyricGeniusFormatter:
     Cleaned = Dict[str, Union[str, Section]]
 
     def __init__(self, tokenizer_type: str = 'bert-base-uncased',
-                 do_lower_case: bool = True):
-        self.nlp = spacy.load('en')
-        self.nlp.add_pipe(LanguageDetector(), name='language_detector', last=True)
+                 do_lower_case: bool = True,
+                 fast_lang: bool = False,
+                 lang_sample_lines: int = None,
+                 lang_batch_size: int = 32,
+                 emit_token_ids: bool = False,
+                 token_cache_size: int = 0,
+                 token_cache_file: str = None):
+        # Language detection only needs the tokenized text, so fast_lang drops the tagger, parser and NER
+        self.nlp = self.load_lang_pipeline(fast_lang)
+        self.reference_nlp = None   # Full pipeline, only loaded by lang_agreement
+        self.fast_lang = fast_lang
+        self.lang_sample_lines = lang_sample_lines  # Detect on at most n evenly spaced lines per song
+        self.lang_batch_size = lang_batch_size
+        self.lang_threshold = 0.80
         self.toke = BertTokenizer.from_pretrained(tokenizer_type,
                                                   do_lower_case=do_lower_case)
+        if token_cache_size:
+            # Repeated lines (hooks, choruses) are only tokenized once
+            self.toke = CachedTokenizer(self.toke, tokenizer_type, do_lower_case,
+                                        max_size=token_cache_size, cache_file=token_cache_file)
+        self.emit_token_ids = emit_token_ids    # Keep the ids of every line in Cleaned['token_ids']
 
         # For splitting by \n\n followed by
         # [... , (...) , {... , int... , ...: , or (R/r)epeat...
@@ -27,33 +44,101 @@ class LyricGeniusFormatter:
         # For cleaning up any missed characters
         self.clean_seed = '\([^)].*\)|\[.*?\]|\(|\)|\[|\]|:'
 
+    def save_token_cache(self):
+        """Saves and reports on the token cache, if there is one with a cache file"""
+        if not isinstance(self.toke, CachedTokenizer):
+            return None
+        if self.toke.cache_file is not None:
+            self.toke.save()
+        return self.toke.stats()
+
+    @staticmethod
+    def load_lang_pipeline(fast_lang: bool = False):
+        if fast_lang:
+            nlp = spacy.load('en', disable=['tagger', 'parser', 'ner'])
+        else:
+            nlp = spacy.load('en')
+        nlp.add_pipe(LanguageDetector(), name='language_detector', last=True)
+        return nlp
+
     def detect_lang(self, text: str):
         doc = self.nlp(text)
         return doc._.language
 
-    def clean_sections(self, raw_lyrics: str) -> Section:
+    def lang_sample(self, text: str) -> str:
+        lines = [l for l in text.split('\n') if l.strip() and not re.match(r'\s*[\[({]', l)]
+        if not self.lang_sample_lines or len(lines) <= self.lang_sample_lines:
+            return '\n'.join(lines)
+        step = len(lines) / self.lang_sample_lines
+        return '\n'.join(lines[int(i * step)] for i in range(self.lang_sample_lines))
+
+    def detect_langs(self, texts: List[str]) -> List[Dict[str, Union[str, float]]]:
+        if self.lang_sample_lines:
+            texts = [self.lang_sample(t) for t in texts]
+        return [doc._.language for doc in self.nlp.pipe(texts, batch_size=self.lang_batch_size)]
+
+    def is_english(self, detect: Dict[str, Union[str, float]]) -> bool:
+        return 'en' in detect['language'] and detect['score'] >= self.lang_threshold
+
+    def lang_agreement(self, texts: List[str]) -> Dict[str, int]:
+        """Counts how often this formatter's accept/reject decisions match the full pipeline on whole songs"""
+        if self.reference_nlp is None:
+            self.reference_nlp = self.load_lang_pipeline(fast_lang=False)
+        accepted = [self.is_english(d) for d in self.detect_langs(texts)]
+        reference = [self.is_english(doc._.language) for doc in self.reference_nlp.pipe(texts)]
+
+        report = {'n': len(texts), 'agree': 0, 'only_here_accepted': 0, 'only_full_accepted': 0}
+        for a, r in zip(accepted, reference):
+            if a == r:
+                report['agree'] += 1
+            elif a:
+                report['only_here_accepted'] += 1
+            else:
+                report['only_full_accepted'] += 1
+        return report
+
+    def clean_sections(self, raw_lyrics: str, token_ids: List[List[List[int]]] = None) -> Section:
         sections = list()
 
         raw_sections = re.split(self.header_seed, '\n\n' + raw_lyrics)   # Catch [Intro]
         for raw_sect in raw_sections:
             clean_sect = re.sub(self.clean_seed, '', str(raw_sect))      # Clean residual
-            split_sect = [l for l in clean_sect.split('\n') if len(self.toke.tokenize(l))]
+            split_sect, split_ids = list(), list()
+            for l in clean_sect.split('\n'):
+                tokens = self.toke.tokenize(l)
+                if len(tokens):
+                    split_sect.append(l)
+                    if token_ids is not None:
+                        # Same ids as tokenizing the corpus line f'{l} [SEP] '
+                        split_ids.append(self.toke.convert_tokens_to_ids(tokens + ['[SEP]']))
             if len(split_sect) > 1:     # Only includes couplets or longer
                 sections.append(split_sect)
+                if token_ids is not None:
+                    token_ids.append(split_ids)
 
         return sections
 
-    # noinspection PyTypeChecker
-    def format_lyrics(self, raw_lyrics_file: Path) -> Cleaned:
-
-        # Load song dict
+    @staticmethod
+    def load_song(raw_lyrics_file: Path) -> Dict:
         with open(raw_lyrics_file, 'r') as rlf:
-            raw = json.loads(rlf.read())
-        raw_lyrics = str(raw['songs'][0]['lyrics'])
+            return json.loads(rlf.read())
+
+    def format_lyrics(self, raw_lyrics: Union[Path, Dict]) -> Cleaned:
+        return self.format_batch([raw_lyrics])[0]
 
-        # Detect language
-        detect = self.detect_lang(raw_lyrics)
-        if 'en' not in detect['language'] or detect['score'] < 0.80:
+    def format_batch(self, raw_lyrics: List[Union[Path, Dict]]) -> List[Cleaned]:
+        # Load song dicts, songs read from a raw archive are dicts already
+        raws = [rl if isinstance(rl, dict) else self.load_song(rl) for rl in raw_lyrics]
+
+        # Detect language, batched through nlp.pipe
+        detects = self.detect_langs([str(raw['songs'][0]['lyrics']) for raw in raws])
+
+        return [self.format_song(raw, detect) for raw, detect in zip(raws, detects)]
+
+    # noinspection PyTypeChecker
+    def format_song(self, raw: Dict, detect: Dict[str, Union[str, float]]) -> Cleaned:
+        raw_lyrics = str(raw['songs'][0]['lyrics'])
+        if not self.is_english(detect):
             return
 
         # Copy fields
@@ -65,6 +150,10 @@ class LyricGeniusFormatter:
         formatted['raw_lyrics'] = raw_lyrics
 
         # Clean lyrics
-        formatted['sections'] = self.clean_sections(raw_lyrics)
+        if self.emit_token_ids:
+            formatted['token_ids'] = list()
+            formatted['sections'] = self.clean_sections(raw_lyrics, token_ids=formatted['token_ids'])
+        else:
+            formatted['sections'] = self.clean_sections(raw_lyrics)
 
         return formatted
@@ -0,0 +1,139 @@
+import os
+import json
+import sqlite3
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple, Union
+
+__all__ = ['ProgressManifest']
+
+
+class ProgressManifest:
+    """
+    On-disk record of every raw lyrics file that has been cleaned.
+
+    Each row holds the raw file's path, size and mtime, the split and shard it was written to and the
+    uncompressed byte range of its output within that shard. Rows are buffered and committed in one
+    sqlite transaction together with the committed length of every output file, so a crash can only
+    ever lose the uncommitted tail of a batch.
+    """
+    Row = Tuple[str, Optional[int], Optional[float], Optional[str], Optional[int], Optional[int], Optional[int]]
+
+    def __init__(self, manifest_file: Path):
+        self.manifest_file = Path(manifest_file)
+        self.db = sqlite3.connect(str(self.manifest_file))
+        self.db.executescript('''
+            CREATE TABLE IF NOT EXISTS files (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime REAL,
+                split TEXT,
+                start INTEGER,
+                end INTEGER,
+                shard INTEGER
+            );
+            CREATE TABLE IF NOT EXISTS state (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            );
+            CREATE TABLE IF NOT EXISTS signatures (
+                path TEXT PRIMARY KEY,
+                signature BLOB,
+                info TEXT
+            );
+            CREATE TABLE IF NOT EXISTS duplicates (
+                path TEXT PRIMARY KEY,
+                duplicate_of TEXT,
+                similarity REAL,
+                info TEXT
+            );
+        ''')
+        if 'shard' not in [column[1] for column in self.db.execute('PRAGMA table_info(files)')]:
+            self.db.execute('ALTER TABLE files ADD COLUMN shard INTEGER')
+        self.db.commit()
+
+        # Kept in memory so resume checks are a dict lookup instead of a scan or a query
+        self.done = {path: (size, mtime) for path, size, mtime in
+                     self.db.execute('SELECT path, size, mtime FROM files')}
+        self.state = {key: json.loads(value) for key, value in
+                      self.db.execute('SELECT key, value FROM state')}
+        self.pending = list()  # type: List[ProgressManifest.Row]
+        self.pending_signatures = list()
+        self.pending_duplicates = list()
+
+    def __len__(self):
+        return len(self.done)
+
+    def __contains__(self, raw_file: Union[str, Path]) -> bool:
+        return str(raw_file) in self.done
+
+    @staticmethod
+    def stat(raw_file: Union[str, Path]) -> Tuple[int, float]:
+        st = os.stat(str(raw_file))
+        return st.st_size, st.st_mtime
+
+    def is_done(self, raw_file: Union[str, Path], stat: Tuple[int, float] = None) -> bool:
+        """True if raw_file was cleaned and has not changed since (legacy entries carry no stat)"""
+        recorded = self.done.get(str(raw_file))
+        if recorded is None:
+            return False
+        if recorded[0] is None:
+            return True
+        return recorded == (stat or self.stat(raw_file))
+
+    def has_output(self, raw_file: Union[str, Path]) -> bool:
+        """True if raw_file's committed row points at a song written to a split"""
+        row = self.db.execute('SELECT split, shard FROM files WHERE path = ?', (str(raw_file),)).fetchone()
+        return row is not None and row[0] not in (None, 'duplicate') and row[1] is not None
+
+    def record(self, raw_file: Union[str, Path], split: str = None, shard: int = None, start: int = None,
+               end: int = None, stat: Tuple[int, float] = None):
+        size, mtime = stat or self.stat(raw_file)
+        self.pending.append((str(raw_file), size, mtime, split, start, end, shard))
+
+    def record_signature(self, raw_file: Union[str, Path], signature: bytes, info: Dict):
+        """Near-duplicate signature of a kept song, so the index survives a resume"""
+        self.pending_signatures.append((str(raw_file), signature, json.dumps(info)))
+
+    def record_duplicate(self, raw_file: Union[str, Path], duplicate_of: str, similarity: float, info: Dict):
+        self.pending_duplicates.append((str(raw_file), duplicate_of, similarity, json.dumps(info)))
+
+    def signatures(self) -> Iterator[Tuple[str, bytes, Dict]]:
+        for path, signature, info in self.db.execute('SELECT path, signature, info FROM signatures ORDER BY rowid'):
+            yield path, signature, json.loads(info)
+
+    def duplicates(self) -> Iterator[Tuple[str, str, float, Dict]]:
+        for path, duplicate_of, similarity, info in self.db.execute(
+                'SELECT path, duplicate_of, similarity, info FROM duplicates ORDER BY rowid'):
+            yield path, duplicate_of, similarity, json.loads(info)
+
+    def commit(self, **state):
+        """Writes pending rows and state (e.g. output offsets) in a single transaction"""
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?)', self.pending)
+            self.db.executemany('INSERT OR REPLACE INTO signatures VALUES (?, ?, ?)', self.pending_signatures)
+            self.db.executemany('INSERT OR REPLACE INTO duplicates VALUES (?, ?, ?, ?)', self.pending_duplicates)
+            self.db.executemany('INSERT OR REPLACE INTO state VALUES (?, ?)',
+                                [(key, json.dumps(value)) for key, value in state.items()])
+        for path, size, mtime, *_ in self.pending:
+            self.done[path] = (size, mtime)
+        self.state.update(state)
+        self.pending = list()
+        self.pending_signatures = list()
+        self.pending_duplicates = list()
+
+    def import_progress_file(self, progress_file: Path):
+        """Marks every path of an old progress-*.txt as done"""
+        with open(progress_file, 'r') as pf:
+            paths = [line.rstrip('\n') for line in pf if line.strip()]
+        self.pending.extend((path, None, None, None, None, None, None) for path in paths)
+        self.commit()
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
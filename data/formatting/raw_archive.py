@@ -0,0 +1,213 @@
+import os
+import sys
+import json
+import tqdm
+
+from pathlib import Path
+from argparse import ArgumentParser
+from typing import Dict, Iterable, Iterator, List, Tuple, Union
+
+__all__ = ['RawArchiveWriter', 'RawArchive', 'pack_raw_lyrics']
+
+# An archive is a directory of
+#   raw-{n:05d}.jsonl  one lyricsgenius song dict per line, shards rotate every shard_bytes
+#   index.tsv          name, source, shard, offset, length, size, mtime of every song (tab separated)
+# Songs are appended to a shard before their index line, so the index never points past written data.
+# An index line cut off by a crash is skipped by readers and truncated by the next writer.
+INDEX_NAME = 'index.tsv'
+
+
+class IndexEntry:
+    __slots__ = ['name', 'source', 'shard', 'offset', 'length', 'size', 'mtime']
+
+    def __init__(self, name: str, source: str, shard: int, offset: int, length: int, size: int, mtime: float):
+        self.name = name
+        self.source = source    # Path of the original lyrics_*.json, used as the progress key when cleaning
+        self.shard = shard
+        self.offset = offset
+        self.length = length
+        self.size = size
+        self.mtime = mtime
+
+    @classmethod
+    def parse(cls, line: str) -> 'IndexEntry':
+        name, source, shard, offset, length, size, mtime = line.rstrip('\n').split('\t')
+        return cls(name, source, int(shard), int(offset), int(length), int(size), float(mtime))
+
+    def __str__(self):
+        return '\t'.join(str(getattr(self, field)) for field in self.__slots__)
+
+    @property
+    def stat(self) -> Tuple[int, float]:
+        return self.size, self.mtime
+
+
+def read_index(archive_dir: Path, truncate: bool = False) -> List[IndexEntry]:
+    """
+    Entries of the index. A last line without its newline was cut off by a crash mid-write and is skipped,
+    with truncate it is also cut from the file, so that appending starts on a fresh line.
+    """
+    index_file = Path(archive_dir)/INDEX_NAME
+    if not index_file.exists():
+        return list()
+    with open(index_file, 'r', encoding='utf-8', newline='') as idx:
+        lines = idx.readlines()
+    if lines and not lines[-1].endswith('\n'):
+        partial = lines.pop()
+        if truncate:
+            print(f'Rolling back {len(partial.encode("utf-8"))} bytes of an incomplete line of {index_file}')
+            os.truncate(index_file, index_file.stat().st_size - len(partial.encode('utf-8')))
+    return [IndexEntry.parse(line) for line in lines if line.strip()]
+
+
+class RawArchiveWriter:
+    """Appends song dicts to an archive, see module header for the layout"""
+
+    def __init__(self, archive_dir: Union[str, Path], shard_bytes: int = 256 << 20):
+        self.archive_dir = Path(archive_dir)
+        self.archive_dir.mkdir(parents=True, exist_ok=True)
+        self.shard_bytes = shard_bytes
+
+        self.entries = {entry.name: entry for entry in read_index(self.archive_dir, truncate=True)}
+        self.shard = max([entry.shard for entry in self.entries.values()], default=0)
+        self.handle = None
+        self.index = open(self.archive_dir/INDEX_NAME, 'a', encoding='utf-8')
+        self.pending_index = list()
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def shard_path(self, shard: int) -> Path:
+        return self.archive_dir/f'raw-{shard:05d}.jsonl'
+
+    def add(self, name: str, song: Dict, source: str = None, size: int = None, mtime: float = None):
+        if self.handle is None:
+            self.handle = open(self.shard_path(self.shard), 'ab')
+        if self.handle.tell() >= self.shard_bytes:
+            self.handle.close()
+            self.shard += 1
+            self.handle = open(self.shard_path(self.shard), 'ab')
+
+        data = (json.dumps(song) + '\n').encode('utf-8')
+        entry = IndexEntry(name, source or name, self.shard, self.handle.tell(), len(data),
+                           size if size is not None else len(data), mtime or 0.0)
+        # Bytes of a song left behind by a crash before flush() are simply never indexed
+        self.handle.write(data)
+        self.entries[name] = entry
+        self.pending_index.append(str(entry))
+
+    def flush(self):
+        """Data first, then the index lines that point into it"""
+        if self.handle is not None:
+            self.handle.flush()
+            os.fsync(self.handle.fileno())
+        if self.pending_index:
+            self.index.write(''.join(f'{line}\n' for line in self.pending_index))
+            self.pending_index.clear()
+        self.index.flush()
+        os.fsync(self.index.fileno())
+
+    def close(self):
+        self.flush()
+        if self.handle is not None:
+            self.handle.close()
+        self.index.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+class RawArchive:
+    """Reads an archive with a few large sequential reads instead of one open() per song"""
+
+    def __init__(self, archive_dir: Union[str, Path], entries: List[IndexEntry] = None):
+        """entries, if given, stand in for the index, e.g. a slice of it already read by another process"""
+        self.archive_dir = Path(archive_dir)
+        self.entries = read_index(self.archive_dir) if entries is None else list(entries)
+        self.by_name = {entry.name: entry for entry in self.entries}
+        self.by_source = {entry.source: entry for entry in self.entries}
+
+    @staticmethod
+    def is_archive(path: Union[str, Path]) -> bool:
+        return (Path(path)/INDEX_NAME).is_file()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def shard_path(self, shard: int) -> Path:
+        return self.archive_dir/f'raw-{shard:05d}.jsonl'
+
+    def __getitem__(self, name: str) -> Dict:
+        entry = self.by_name[name]
+        with open(self.shard_path(entry.shard), 'rb') as shard:
+            shard.seek(entry.offset)
+            return json.loads(shard.read(entry.length).decode('utf-8'))
+
+    def iter_songs(self, entries: Iterable[IndexEntry] = None) -> Iterator[Tuple[IndexEntry, Dict]]:
+        """
+        Yields (entry, song) for entries (default all). Entries in archive order are read front to back through
+        a large buffer, others with a seek and one read each.
+        """
+        entries = self.entries if entries is None else list(entries)
+        in_order = all((a.shard, a.offset) < (b.shard, b.offset) for a, b in zip(entries, entries[1:]))
+        buffering = 16 << 20 if in_order else -1
+        shard_handle, shard_id = None, None
+        try:
+            for entry in entries:
+                if entry.shard != shard_id:
+                    if shard_handle is not None:
+                        shard_handle.close()
+                    shard_handle = open(self.shard_path(entry.shard), 'rb', buffering=buffering)
+                    shard_id = entry.shard
+                if shard_handle.tell() != entry.offset:
+                    shard_handle.seek(entry.offset)
+                yield entry, json.loads(shard_handle.read(entry.length).decode('utf-8'))
+        finally:
+            if shard_handle is not None:
+                shard_handle.close()
+
+
+def pack_raw_lyrics(raw_lyrics_dir: Union[str, Path], archive_dir: Union[str, Path],
+                    shard_bytes: int = 256 << 20, flush_every: int = 1000) -> int:
+    """Packs every lyrics_*.json of raw_lyrics_dir not yet in the archive, returns how many were added"""
+    raw_lyrics_files = sorted(Path(raw_lyrics_dir).glob('*.json'))
+    added = 0
+    with RawArchiveWriter(archive_dir, shard_bytes=shard_bytes) as writer:
+        for rlf in tqdm.tqdm(raw_lyrics_files):
+            if rlf.name in writer:
+                continue
+            st = rlf.stat()
+            with open(rlf, 'r', encoding='utf-8') as f:
+                song = json.loads(f.read())
+            writer.add(rlf.name, song, source=str(rlf), size=st.st_size, mtime=st.st_mtime)
+            added += 1
+            if added % flush_every == 0:
+                writer.flush()
+    return added
+
+
+def main():
+    arp = ArgumentParser(description='Pack a directory of raw lyrics_*.json into an indexed archive')
+    arp.add_argument('-r', '--raw-lyrics-dir',
+                     required=True,
+                     help='Directory containing raw lyrics_*.json')
+    arp.add_argument('-a', '--archive-dir',
+                     required=True,
+                     help='Archive directory to create or extend')
+    arp.add_argument('--shard-size',
+                     type=int, default=256,
+                     help='MB per archive shard (Default = 256)')
+    opts = arp.parse_args()
+
+    added = pack_raw_lyrics(opts.raw_lyrics_dir, opts.archive_dir, shard_bytes=opts.shard_size << 20)
+    print(f'Packed {added} new songs into {opts.archive_dir}', file=sys.stderr)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,63 @@
+import hashlib
+
+from pathlib import Path
+from typing import Dict, Sequence, Union
+
+__all__ = ['SPLITS', 'CounterSplit', 'HashSplit', 'stable_fraction', 'in_partition']
+
+SPLITS = ('train', 'dev', 'test')
+
+
+def stable_fraction(key: str) -> float:
+    """Maps a string to [0, 1), identically on every machine and Python run"""
+    return int.from_bytes(hashlib.md5(key.encode('utf-8')).digest()[:8], 'big') / 2 ** 64
+
+
+def in_partition(raw_file: Union[str, Path], partition: int, n_partitions: int) -> bool:
+    """Disjoint subsets of the raw files by file name, e.g. for cleaning on several machines"""
+    return int(stable_fraction(Path(raw_file).name) * n_partitions) == partition
+
+
+class CounterSplit:
+    """The original assignment over the running count i of formatted songs: 5% dev, 5% test, 90% train"""
+
+    def assign(self, i: int, formatted_song: Dict) -> str:
+        # 5% to dev
+        if i % 20 == 0:
+            return 'dev'
+        # 5% to test
+        elif i % 20 == 1:
+            return 'test'
+        # 90% to train
+        return 'train'
+
+
+class HashSplit:
+    """
+    Assigns each song by a stable hash of its artist and title (key='song') or of its artist alone
+    (key='artist', keeping every song of an artist in one split). The split of a song never depends
+    on which or how many other songs are cleaned, so any subset can be cleaned on its own and merged.
+    """
+
+    def __init__(self, ratios: Sequence[float] = (0.90, 0.05, 0.05), key: str = 'song'):
+        assert len(ratios) == len(SPLITS) and abs(sum(ratios) - 1) < 1e-6, 'Need train,dev,test ratios summing to 1'
+        assert key in ('song', 'artist'), key
+        self.ratios = ratios
+        self.key = key
+
+    @staticmethod
+    def normalize(text: str) -> str:
+        return ' '.join(str(text).lower().split())
+
+    def assign(self, i: int, formatted_song: Dict) -> str:
+        key = self.normalize(formatted_song['artist'])
+        if self.key == 'song':
+            key += '\n' + self.normalize(formatted_song['title'])
+
+        fraction = stable_fraction(key)
+        cumulative = 0.0
+        for split, ratio in zip(SPLITS, self.ratios):
+            cumulative += ratio
+            if fraction < cumulative:
+                return split
+        return SPLITS[-1]
@@ -0,0 +1,53 @@
+"""Rolling a TokenCorpusWriter back to a checkpoint, as CleanCorpusWriter does when a run resumes."""
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from token_corpus import TokenCorpusWriter, TokenCorpus  # noqa: E402
+
+
+def add_songs(writer, first, n):
+    for i in range(first, first + n):
+        writer.add_song(f'artist {i}', f'title {i}', '2019', [[[i, 100, 3], [i, 101, 102, 3]], [[i, 3]]])
+
+
+def crash(writer):
+    """Leaves whatever was written on disk without a checkpoint"""
+    for handle in writer.handles.values():
+        handle.flush()
+        handle.close()
+
+
+def test_restore_then_checkpoint_then_crash(tmp_path):
+    prefix = tmp_path / 'train-bert-base-uncased'
+    writer = TokenCorpusWriter(prefix, 'bert-base-uncased', True)
+    add_songs(writer, 0, 2)
+    committed = writer.checkpoint()
+    add_songs(writer, 2, 3)
+    crash(writer)
+
+    # Resume: roll back the three uncommitted songs and commit straight away
+    writer = TokenCorpusWriter(prefix, 'bert-base-uncased', True)
+    writer.restore(committed)
+    assert writer.checkpoint() == committed
+    add_songs(writer, 5, 1)
+    recommitted = writer.checkpoint()
+    add_songs(writer, 6, 4)
+    crash(writer)
+
+    writer = TokenCorpusWriter(prefix, 'bert-base-uncased', True)
+    writer.restore(recommitted)
+    add_songs(writer, 10, 1)
+    writer.close()
+
+    corpus = TokenCorpus(prefix)
+    assert [m['title'] for m in corpus.meta] == ['title 0', 'title 1', 'title 5', 'title 10']
+    assert corpus.n_sections == 8 and corpus.n_lines == 12
+    for song, i in enumerate([0, 1, 5, 10]):
+        sections = [corpus.section(s) for s in corpus.song_sections(song)]
+        assert [[line.tolist() for line in section] for section in sections] == \
+            [[[i, 100, 3], [i, 101, 102, 3]], [[i, 3]]]
+    assert np.array_equal(corpus.line(corpus.n_lines - 1), [10, 3])
@@ -0,0 +1,91 @@
+import os
+import gzip
+import json
+
+from pathlib import Path
+from collections import OrderedDict
+from typing import Dict, List, Union
+
+__all__ = ['CachedTokenizer']
+
+
+class CachedTokenizer:
+    """
+    A BertTokenizer whose tokenize() is memoized per line of text in a bounded LRU. Hooks and choruses
+    repeat so often in lyrics that most lines cost a dictionary lookup instead of a basic + WordPiece pass.
+    Every other attribute (vocab, convert_tokens_to_ids, ...) is the wrapped tokenizer's.
+
+    The cache can be saved to and loaded from a gzipped JSON file, which records the tokenizer type and
+    casing it was made with and is ignored when loaded for a different one.
+    """
+
+    def __init__(self, tokenizer, tokenizer_type: str, do_lower_case: bool,
+                 max_size: int = 1 << 18, cache_file: Union[str, Path] = None):
+        self.tokenizer = tokenizer
+        self.key = f'{tokenizer_type}/{"uncased" if do_lower_case else "cased"}'
+        self.max_size = max_size
+        self.cache_file = Path(cache_file) if cache_file else None
+        self.lines = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        if self.cache_file is not None and self.cache_file.is_file():
+            self.load(self.cache_file)
+
+    @classmethod
+    def from_pretrained(cls, tokenizer_type: str, do_lower_case: bool = True, **kwargs):
+        from pytorch_pretrained_bert import BertTokenizer
+        return cls(BertTokenizer.from_pretrained(tokenizer_type, do_lower_case=do_lower_case),
+                   tokenizer_type, do_lower_case, **kwargs)
+
+    def __getattr__(self, name):
+        # Only called for attributes not found here, i.e. everything but tokenize
+        if name == 'tokenizer':
+            raise AttributeError(name)
+        return getattr(self.tokenizer, name)
+
+    def __len__(self):
+        return len(self.lines)
+
+    def tokenize(self, text: str) -> List[str]:
+        tokens = self.lines.get(text)
+        if tokens is not None:
+            self.hits += 1
+            self.lines.move_to_end(text)
+        else:
+            self.misses += 1
+            tokens = tuple(self.tokenizer.tokenize(text))
+            self.lines[text] = tokens
+            if len(self.lines) > self.max_size:
+                self.lines.popitem(last=False)
+        return list(tokens)     # Callers may truncate their tokens in place
+
+    @property
+    def hit_rate(self) -> float:
+        calls = self.hits + self.misses
+        return self.hits / calls if calls else 0.0
+
+    def stats(self) -> Dict[str, Union[int, float]]:
+        return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hit_rate,
+                'cached_lines': len(self.lines), 'max_size': self.max_size}
+
+    def load(self, cache_file: Union[str, Path]) -> int:
+        """Adds the lines of a saved cache, returns how many were loaded"""
+        with gzip.open(str(cache_file), 'rt', encoding='utf-8') as f:
+            saved = json.load(f)
+        if saved['tokenizer'] != self.key:
+            print(f'Ignoring token cache {cache_file}, it was made for {saved["tokenizer"]}, not {self.key}')
+            return 0
+        # Saved least recently used first, so the most recent lines are kept if max_size is smaller now
+        for text, tokens in saved['lines'][-self.max_size:]:
+            self.lines[text] = tuple(tokens)
+        while len(self.lines) > self.max_size:
+            self.lines.popitem(last=False)
+        return len(saved['lines'])
+
+    def save(self, cache_file: Union[str, Path] = None):
+        """Writes the cache atomically, to the cache_file it was created with by default"""
+        cache_file = Path(cache_file or self.cache_file)
+        tmp_file = cache_file.with_name(cache_file.name + '.tmp')
+        with gzip.open(str(tmp_file), 'wt', encoding='utf-8') as f:
+            json.dump({'tokenizer': self.key, 'lines': list(self.lines.items())}, f, ensure_ascii=False)
+        os.replace(str(tmp_file), str(cache_file))
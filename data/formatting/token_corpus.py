@@ -0,0 +1,175 @@
+import os
+import json
+import numpy as np
+
+from pathlib import Path
+from typing import Dict, Iterator, List, Union
+
+__all__ = ['TokenCorpusWriter', 'TokenCorpus']
+
+# On-disk layout of a pre-tokenized corpus at {prefix}:
+#   {prefix}.ids       int32  token ids of every line, back to back (each line ends with its [SEP] id,
+#                             exactly as tokenizing the text corpus line '{line} [SEP] ' would give)
+#   {prefix}.lines     int64  offset into .ids of the first token of each line
+#   {prefix}.sections  int64  index of the first line of each section
+#   {prefix}.songs     int64  index of the first section of each song
+#   {prefix}.meta      jsonl  one {"artist", "title", "year"} per song
+#   {prefix}.json      json   tokenizer_type, do_lower_case and counts
+# Offset files only hold starts, every array ends where the next level's data ends.
+ID_DTYPE = np.int32
+OFFSET_DTYPE = np.int64
+ARRAYS = {'ids': ID_DTYPE, 'lines': OFFSET_DTYPE, 'sections': OFFSET_DTYPE, 'songs': OFFSET_DTYPE}
+
+
+def prefix_of(path: Union[str, Path]) -> Path:
+    path = Path(path)
+    if path.suffix in ['.json', '.meta'] or path.suffix[1:] in ARRAYS:
+        return path.with_suffix('')
+    return path
+
+
+class TokenCorpusWriter:
+    """Appends songs of token ids to a binary pre-tokenized corpus. See module header for the layout."""
+    Checkpoint = Dict[str, int]
+
+    def __init__(self, prefix: Union[str, Path], tokenizer_type: str, do_lower_case: bool):
+        self.prefix = prefix_of(prefix)
+        self.header = {'tokenizer_type': tokenizer_type, 'do_lower_case': do_lower_case}
+        self.handles = {name: open(self.path(name), 'ab') for name in list(ARRAYS) + ['meta']}
+
+        # Pick up counts from whatever is on disk already
+        self.counts = {name: self.path(name).stat().st_size // np.dtype(dtype).itemsize
+                       for name, dtype in ARRAYS.items()}
+
+    def path(self, name: str) -> Path:
+        return self.prefix.with_name(f'{self.prefix.name}.{name}')
+
+    def add_song(self, artist: str, title: str, year: str, token_ids: List[List[List[int]]]):
+        """token_ids holds sections of lines of ids"""
+        song_start = self.counts['sections']
+        lines, sections, ids = list(), list(), list()
+        n_tokens, n_lines = self.counts['ids'], self.counts['lines']
+        for section in token_ids:
+            sections.append(n_lines)
+            for line in section:
+                lines.append(n_tokens)
+                ids.extend(line)
+                n_tokens += len(line)
+                n_lines += 1
+
+        self.write('ids', ids)
+        self.write('lines', lines)
+        self.write('sections', sections)
+        self.write('songs', [song_start])
+        self.handles['meta'].write((json.dumps({'artist': artist, 'title': title, 'year': year}) + '\n').encode())
+
+    def write(self, name: str, values: List[int]):
+        self.handles[name].write(np.asarray(values, dtype=ARRAYS[name]).tobytes())
+        self.counts[name] += len(values)
+
+    def checkpoint(self) -> Checkpoint:
+        """Flushes and fsyncs everything, returns the committed size of every file"""
+        sizes = dict()
+        for name, handle in self.handles.items():
+            handle.flush()
+            os.fsync(handle.fileno())
+            sizes[name] = handle.tell()
+
+        header = dict(self.header, **{f'n_{name}': count for name, count in self.counts.items()})
+        tmp = self.path('json.tmp')
+        tmp.write_text(json.dumps(header))
+        os.replace(str(tmp), str(self.path('json')))
+        return sizes
+
+    def restore(self, checkpoint: Checkpoint):
+        """Truncates every file back to a checkpoint"""
+        for name, handle in self.handles.items():
+            handle.flush()
+            if self.path(name).stat().st_size > checkpoint[name]:
+                print(f'Rolling back {self.path(name).stat().st_size - checkpoint[name]} uncommitted bytes '
+                      f'of {self.path(name)}')
+                os.truncate(self.path(name), checkpoint[name])
+            # Append handles keep reporting the old size until they seek to the new end
+            handle.seek(0, os.SEEK_END)
+        self.counts = {name: checkpoint[name] // np.dtype(dtype).itemsize for name, dtype in ARRAYS.items()}
+
+    def close(self):
+        self.checkpoint()
+        for handle in self.handles.values():
+            handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, traceback):
+        self.close()
+
+
+class TokenCorpus:
+    """Memory-mapped reader of a corpus written by TokenCorpusWriter"""
+
+    def __init__(self, prefix: Union[str, Path]):
+        self.prefix = prefix_of(prefix)
+        self.header = json.loads(self.path('json').read_text())
+
+        # Only the committed part of each file, a run may still be appending
+        arrays = dict()
+        for name, dtype in ARRAYS.items():
+            count = self.header[f'n_{name}']
+            arrays[name] = (np.memmap(self.path(name), dtype=dtype, mode='r', shape=(count,)) if count
+                            else np.zeros(0, dtype=dtype))
+        self.ids = arrays['ids']
+        self.line_offsets = np.append(arrays['lines'], len(self.ids))
+        self.section_offsets = np.append(arrays['sections'], len(arrays['lines']))
+        self.song_offsets = np.append(arrays['songs'], len(arrays['sections']))
+        self._meta = None
+
+    @staticmethod
+    def is_token_corpus(path: Union[str, Path]) -> bool:
+        return prefix_of(path).with_name(f'{prefix_of(path).name}.json').is_file()
+
+    def path(self, name: str) -> Path:
+        return self.prefix.with_name(f'{self.prefix.name}.{name}')
+
+    @property
+    def tokenizer_type(self) -> str:
+        return self.header['tokenizer_type']
+
+    @property
+    def meta(self) -> List[Dict[str, str]]:
+        if self._meta is None:
+            with open(self.path('meta'), 'r') as mf:
+                self._meta = [json.loads(line) for _, line in zip(range(self.n_songs), mf)]
+        return self._meta
+
+    @property
+    def n_songs(self) -> int:
+        return len(self.song_offsets) - 1
+
+    @property
+    def n_sections(self) -> int:
+        return len(self.section_offsets) - 1
+
+    @property
+    def n_lines(self) -> int:
+        return len(self.line_offsets) - 1
+
+    def __len__(self):
+        return self.n_songs
+
+    def line(self, i: int) -> np.ndarray:
+        return self.ids[self.line_offsets[i]:self.line_offsets[i + 1]]
+
+    def section_lines(self, s: int) -> range:
+        return range(self.section_offsets[s], self.section_offsets[s + 1])
+
+    def section(self, s: int) -> List[np.ndarray]:
+        return [self.line(i) for i in self.section_lines(s)]
+
+    def song_sections(self, song: int) -> range:
+        return range(self.song_offsets[song], self.song_offsets[song + 1])
+
+    def iter_sections(self, start: int = 0) -> Iterator[List[np.ndarray]]:
+        """Sections are the documents of the text corpus (separated by blank lines)"""
+        for s in range(start, self.n_sections):
+            yield self.section(s)
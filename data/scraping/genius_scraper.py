@@ -0,0 +1,315 @@
+import os
+import re
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'formatting'))
+
+import json
+import html
+import time
+import random
+import asyncio
+import urllib.error
+import urllib.parse
+import urllib.request
+
+from pathlib import Path
+from html.parser import HTMLParser
+from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+from raw_archive import RawArchiveWriter
+
+__all__ = ['TokenBucket', 'GeniusClient', 'GeniusScraper', 'extract_lyrics']
+
+
+class TokenBucket:
+    """Allows `rate` requests per second on average and bursts of up to `burst`, shared by every coroutine"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class _LyricsParser(HTMLParser):
+    # Old pages keep lyrics in <div class="lyrics">, new ones in several <div data-lyrics-container="true">
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.depth = 0
+        self.parts = list()
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        if self.depth:
+            if tag == 'br':
+                self.parts.append('\n')
+            elif tag == 'div':
+                self.depth += 1
+        elif tag == 'div' and ('lyrics' in (attrs.get('class') or '').split()
+                               or attrs.get('data-lyrics-container') == 'true'):
+            self.depth = 1
+            if self.parts:
+                self.parts.append('\n')
+
+    def handle_endtag(self, tag):
+        if self.depth and tag == 'div':
+            self.depth -= 1
+
+    def handle_data(self, data):
+        if self.depth:
+            self.parts.append(data)
+
+
+def extract_lyrics(page: str) -> Optional[str]:
+    """Lyrics text of a Genius song page, with section headers such as [Verse 1] kept for the formatter"""
+    parser = _LyricsParser()
+    parser.feed(page)
+    if not parser.parts:
+        return None
+    return html.unescape(re.sub(r'\n{3,}', '\n\n', ''.join(parser.parts))).strip('\n')
+
+
+class GeniusClient:
+    """
+    Minimal asyncio client of the Genius API. urllib runs in a thread pool, every request first takes
+    a token from the shared bucket, and failed requests (connection errors, 429 and 5xx) are retried
+    with exponential backoff, honoring Retry-After.
+    """
+
+    def __init__(self, access_token: str, base_url: str = 'https://api.genius.com', rate: float = 5.0,
+                 burst: int = 5, retries: int = 5, backoff: float = 1.0, timeout: float = 20.0,
+                 max_connections: int = 16):
+        self.access_token = access_token
+        self.base_url = base_url.rstrip('/')
+        self.bucket = TokenBucket(rate, burst)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.executor = ThreadPoolExecutor(max_workers=max_connections)
+
+    def fetch(self, url: str) -> bytes:
+        request = urllib.request.Request(url, headers={'Authorization': f'Bearer {self.access_token}',
+                                                       'User-Agent': 'Ghost lyrics scraper'})
+        with urllib.request.urlopen(request, timeout=self.timeout) as response:
+            return response.read()
+
+    async def get(self, url: str) -> bytes:
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            try:
+                return await loop.run_in_executor(self.executor, self.fetch, url)
+            except urllib.error.HTTPError as e:
+                if e.code != 429 and e.code < 500 or attempt == self.retries:
+                    raise
+                retry_after = e.headers.get('Retry-After') if e.headers else None
+                delay = float(retry_after) if retry_after and retry_after.isdigit() else None
+            except (urllib.error.URLError, ConnectionError, TimeoutError):
+                if attempt == self.retries:
+                    raise
+                delay = None
+            if delay is None:
+                delay = self.backoff * 2 ** attempt * (0.5 + random.random())
+            await asyncio.sleep(delay)
+
+    async def get_json(self, path: str, **params) -> Dict:
+        url = f'{self.base_url}{path}'
+        if params:
+            url += '?' + urllib.parse.urlencode(params)
+        return json.loads((await self.get(url)).decode('utf-8'))['response']
+
+    async def search_artist(self, name: str) -> Optional[Dict]:
+        """The primary artist of the best search hit, preferring an exact (case-insensitive) name match"""
+        hits = (await self.get_json('/search', q=name))['hits']
+        artists = [hit['result']['primary_artist'] for hit in hits if hit.get('type', 'song') == 'song']
+        for artist in artists:
+            if artist['name'].lower() == name.lower():
+                return artist
+        return artists[0] if artists else None
+
+    async def artist_songs(self, artist_id: int, per_page: int = 50) -> List[Dict]:
+        songs, page = list(), 1
+        while page:
+            response = await self.get_json(f'/artists/{artist_id}/songs', sort='title', per_page=per_page, page=page)
+            songs.extend(response['songs'])
+            page = response.get('next_page')
+        return songs
+
+    async def song(self, song_id: int) -> Dict:
+        return (await self.get_json(f'/songs/{song_id}'))['song']
+
+    async def lyrics(self, song_url: str) -> Optional[str]:
+        return extract_lyrics((await self.get(song_url)).decode('utf-8'))
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
+
+class GeniusScraper:
+    """
+    Scrapes every song of a list of artists into a raw archive, several artists and songs at a time.
+
+    Songs are stored as the same {'artist', 'songs': [{'title', 'year', 'image', 'lyrics', ...}]} dicts as
+    lyricsgenius' lyrics_*.json, named lyrics_{artist id}_{song id}.json, so a rerun skips saved songs.
+    An artist is appended to the checkpoint file only after all their songs were flushed to the archive.
+    """
+    excluded_terms = ['(Remix)', '(Live)', '(Translation)']
+
+    def __init__(self, client: GeniusClient, archive_dir: Path, checkpoint_file: Path,
+                 concurrent_artists: int = 4, concurrent_songs: int = 8):
+        self.client = client
+        self.archive_dir = Path(archive_dir)
+        self.archive = RawArchiveWriter(archive_dir)
+        self.checkpoint_file = Path(checkpoint_file)
+        self.artist_slots = asyncio.Semaphore(concurrent_artists)
+        self.song_slots = asyncio.Semaphore(concurrent_songs)
+
+        self.done = dict()
+        if self.checkpoint_file.exists():
+            with open(self.checkpoint_file, 'r', encoding='utf-8') as cf:
+                for line in cf:
+                    record = json.loads(line)
+                    self.done[record['name']] = record
+
+    def excluded(self, title: str) -> bool:
+        return any(term.lower() in title.lower() for term in self.excluded_terms)
+
+    @staticmethod
+    def song_dict(artist: Dict, song: Dict, lyrics: str) -> Dict:
+        return {'artist': artist['name'],
+                'songs': [{'title': song['title'],
+                           'year': song.get('release_date'),
+                           'image': song.get('song_art_image_url'),
+                           'album': (song.get('album') or {}).get('name'),
+                           'url': song.get('url'),
+                           'id': song['id'],
+                           'lyrics': lyrics}]}
+
+    async def scrape_song(self, artist: Dict, song_id: int) -> bool:
+        name = f'lyrics_{artist["id"]}_{song_id}.json'
+        if name in self.archive:
+            return True
+        async with self.song_slots:
+            try:
+                song = await self.client.song(song_id)
+                lyrics = await self.client.lyrics(song['url'])
+            except urllib.error.HTTPError as e:
+                if e.code != 404:
+                    raise
+                lyrics = None
+        if lyrics is None:
+            return False
+        # Coroutines share the event loop thread, so appends to the archive never interleave
+        self.archive.add(name, self.song_dict(artist, song, lyrics), source=str(self.archive_dir/name),
+                         mtime=time.time())
+        return True
+
+    async def scrape_artist(self, name: str):
+        if name in self.done:
+            return
+        async with self.artist_slots:
+            artist = await self.client.search_artist(name)
+            record = {'name': name, 'artist_id': None, 'n_songs': 0}
+            if artist is not None:
+                songs = [s for s in await self.client.artist_songs(artist['id'])
+                         if s['primary_artist']['id'] == artist['id'] and not self.excluded(s['title'])]
+                saved = await asyncio.gather(*(self.scrape_song(artist, s['id']) for s in songs))
+                record.update(artist_id=artist['id'], artist=artist['name'], n_songs=sum(saved))
+
+        self.archive.flush()
+        with open(self.checkpoint_file, 'a', encoding='utf-8') as cf:
+            cf.write(json.dumps(record) + '\n')
+        self.done[name] = record
+        print(f'Saved {record["n_songs"]} songs of {name}', file=sys.stderr)
+
+    async def scrape(self, names: List[str]):
+        results = await asyncio.gather(*(self.scrape_artist(name) for name in names), return_exceptions=True)
+        failed = [(name, e) for name, e in zip(names, results) if isinstance(e, BaseException)]
+        for name, e in failed:
+            print(f'Failed to scrape {name}: {e!r}', file=sys.stderr)
+        return failed
+
+    def close(self):
+        self.archive.close()
+
+
+async def scrape_artists(names: List[str], opts) -> int:
+    client = GeniusClient(opts.token, base_url=opts.base_url, rate=opts.rate, burst=opts.burst,
+                          retries=opts.retries, backoff=opts.backoff,
+                          max_connections=opts.concurrent_songs + opts.concurrent_artists)
+    scraper = GeniusScraper(client, opts.archive_dir, opts.checkpoint,
+                            concurrent_artists=opts.concurrent_artists, concurrent_songs=opts.concurrent_songs)
+    try:
+        failed = await scraper.scrape(names)
+    finally:
+        scraper.close()
+        client.close()
+    return len(failed)
+
+
+def main():
+    arp = ArgumentParser(description='Scrape the lyrics of every artist in a list into a raw archive')
+    arp.add_argument('-n', '--names',
+                     default='WikipediaRapArtists.txt',
+                     help='One artist name per line (Default = WikipediaRapArtists.txt)')
+    arp.add_argument('-a', '--archive-dir',
+                     default='rawLyrics.archive/',
+                     help='Raw archive to append songs to, the input of clean_lyrics.py -r')
+    arp.add_argument('--checkpoint',
+                     default=None,
+                     help='Finished artists, one JSON line each (Default = <archive-dir>/scraped-artists.jsonl)')
+    arp.add_argument('--token',
+                     default=os.environ.get('GENIUS_ACCESS_TOKEN', ''),
+                     help='Genius API access token (Default = $GENIUS_ACCESS_TOKEN)')
+    arp.add_argument('--base-url',
+                     default='https://api.genius.com',
+                     help='Genius API root, e.g. a local fake server for testing')
+    arp.add_argument('--rate',
+                     type=float, default=5.0,
+                     help='Requests per second across all connections (Default = 5)')
+    arp.add_argument('--burst',
+                     type=int, default=5,
+                     help='Requests allowed at once after idling (Default = 5)')
+    arp.add_argument('--retries',
+                     type=int, default=5,
+                     help='Retries of a failed request, with exponential backoff (Default = 5)')
+    arp.add_argument('--backoff',
+                     type=float, default=1.0,
+                     help='Seconds before the first retry, doubled for every further one (Default = 1)')
+    arp.add_argument('--concurrent-artists',
+                     type=int, default=4,
+                     help='Artists scraped at the same time (Default = 4)')
+    arp.add_argument('--concurrent-songs',
+                     type=int, default=8,
+                     help='Songs fetched at the same time across all artists (Default = 8)')
+    opts = arp.parse_args()
+    if opts.checkpoint is None:
+        opts.checkpoint = Path(opts.archive_dir)/'scraped-artists.jsonl'
+    Path(opts.archive_dir).mkdir(parents=True, exist_ok=True)
+
+    with open(opts.names, 'r', encoding='utf-8') as nf:
+        names = [name.strip() for name in nf if name.strip()]
+    print(f'n Artists: {len(names)}', file=sys.stderr)
+
+    n_failed = asyncio.run(scrape_artists(names, opts))
+    if n_failed:
+        print(f'{n_failed} artists failed, rerun to retry them', file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
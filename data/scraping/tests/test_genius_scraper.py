@@ -0,0 +1,226 @@
+"""
+Drives genius_scraper.scrape_artists against FakeGenius, a local http.server speaking the few Genius API
+endpoints the scraper uses, which can be told to fail requests with given status codes.
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import threading
+import urllib.parse
+
+from argparse import Namespace
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from genius_scraper import scrape_artists, extract_lyrics  # noqa: E402
+from raw_archive import RawArchive  # noqa: E402
+
+TOKEN = 'test-token'
+
+
+def make_catalog():
+    """Artists by name, and songs by id with the id of their primary artist"""
+    artists = {'Alpha': {'id': 1, 'name': 'Alpha'}, 'Beta': {'id': 2, 'name': 'Beta'}}
+    songs = dict()
+    for n in range(120):    # Three pages of 50
+        songs[1000 + n] = {'id': 1000 + n, 'title': f'Alpha Song {n}', 'artist_id': 1}
+    songs[1200] = {'id': 1200, 'title': 'Alpha Song (Live)', 'artist_id': 1}
+    songs[1201] = {'id': 1201, 'title': 'Alive', 'artist_id': 1}
+    songs[1202] = {'id': 1202, 'title': 'Featuring Alpha', 'artist_id': 3}    # Listed, but not Alpha's song
+    for n in range(3):
+        songs[2000 + n] = {'id': 2000 + n, 'title': f'Beta Song {n}', 'artist_id': 2}
+    return artists, songs
+
+
+class FakeGenius(ThreadingHTTPServer):
+    """
+    /search, /artists/{id}/songs (paginated), /songs/{id} and the lyrics pages at /lyrics/{id}.
+    failures maps a path to the status codes its next requests get ([None] fails all of them with 500),
+    every request is logged as (time, path, status).
+    """
+    daemon_threads = True
+
+    def __init__(self, retry_after='1'):
+        super().__init__(('127.0.0.1', 0), FakeGeniusHandler)
+        self.artists, self.songs = make_catalog()
+        self.missing_lyrics = {2001}
+        self.failures = defaultdict(list)
+        self.retry_after = retry_after
+        self.log = list()
+        self.lock = threading.Lock()
+
+    @property
+    def base_url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def requests(self, path):
+        return [entry for entry in self.log if entry[1] == path]
+
+    def __enter__(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self.shutdown()
+        self.server_close()
+
+
+class FakeGeniusHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def reply(self, status, body=b'', content_type='application/json', headers=None):
+        with self.server.lock:
+            self.server.log.append((time.monotonic(), urllib.parse.urlsplit(self.path).path, status))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, response):
+        self.reply(200, json.dumps({'meta': {'status': 200}, 'response': response}).encode('utf-8'))
+
+    def do_GET(self):
+        server = self.server
+        url = urllib.parse.urlsplit(self.path)
+        path, query = url.path, dict(urllib.parse.parse_qsl(url.query))
+        with server.lock:
+            failures = server.failures.get(path)
+            if not failures:
+                status = None
+            elif failures[0] is None:
+                status = 500
+            else:
+                status = failures.pop(0)
+        if status is not None:
+            headers = {'Retry-After': server.retry_after} if status == 429 else None
+            return self.reply(status, headers=headers)
+
+        if not path.startswith('/lyrics/') and self.headers.get('Authorization') != f'Bearer {TOKEN}':
+            return self.reply(401)
+        parts = path.strip('/').split('/')
+        if parts == ['search']:
+            artist = server.artists.get(query['q'])
+            hits = [] if artist is None else [{'type': 'song', 'result': {'primary_artist': artist}}]
+            return self.reply_json({'hits': hits})
+        if len(parts) == 3 and parts[0] == 'artists' and parts[2] == 'songs':
+            artist_id, page, per_page = int(parts[1]), int(query['page']), int(query['per_page'])
+            listed = sorted((s for s in server.songs.values() if s['artist_id'] == artist_id or
+                             (artist_id == 1 and s['id'] == 1202)), key=lambda s: s['title'])
+            chunk = listed[(page - 1) * per_page:page * per_page]
+            next_page = page + 1 if page * per_page < len(listed) else None
+            return self.reply_json({'songs': [self.song_json(s) for s in chunk], 'next_page': next_page})
+        if len(parts) == 2 and parts[0] == 'songs' and int(parts[1]) in server.songs:
+            return self.reply_json({'song': self.song_json(server.songs[int(parts[1])])})
+        if len(parts) == 2 and parts[0] == 'lyrics' and int(parts[1]) not in server.missing_lyrics:
+            song = server.songs[int(parts[1])]
+            page = (f'<html><body><div data-lyrics-container="true">[Verse 1]<br>{song["title"]} line one'
+                    f'<br>it&#x27;s line two</div></body></html>')
+            return self.reply(200, page.encode('utf-8'), content_type='text/html')
+        return self.reply(404)
+
+    def song_json(self, song):
+        return {'id': song['id'], 'title': song['title'], 'url': f'{self.server.base_url}/lyrics/{song["id"]}',
+                'primary_artist': {'id': song['artist_id']}, 'release_date': '2019-01-01',
+                'song_art_image_url': None, 'album': None}
+
+
+@pytest.fixture
+def server():
+    with FakeGenius() as fake:
+        yield fake
+
+
+def options(server, tmp_path, **overrides):
+    archive_dir = tmp_path / 'archive'
+    archive_dir.mkdir(exist_ok=True)
+    opts = Namespace(token=TOKEN, base_url=server.base_url, rate=1000.0, burst=100, retries=3, backoff=0.01,
+                     concurrent_artists=2, concurrent_songs=8, archive_dir=archive_dir,
+                     checkpoint=archive_dir / 'scraped-artists.jsonl')
+    vars(opts).update(overrides)
+    return opts
+
+
+def checkpoint(opts):
+    with open(opts.checkpoint) as cf:
+        return {record['name']: record for record in map(json.loads, cf)}
+
+
+def test_extract_lyrics():
+    page = '<div class="lyrics"><p>[Hook]<br>first &amp; last<br/></p></div><div>not lyrics</div>'
+    assert extract_lyrics(page) == '[Hook]\nfirst & last'
+    assert extract_lyrics('<html><body>no lyrics here</body></html>') is None
+
+
+def test_scrape_artists(server, tmp_path):
+    opts = options(server, tmp_path)
+    assert asyncio.run(scrape_artists(['Alpha', 'Beta', 'Nobody'], opts)) == 0
+
+    # Every page of Alpha's songs, until next_page is null
+    assert len(server.requests('/artists/1/songs')) == 3
+
+    archive = RawArchive(opts.archive_dir)
+    alpha = {f'lyrics_1_{1000 + n}.json' for n in range(120)} | {'lyrics_1_1201.json'}
+    beta = {'lyrics_2_2000.json', 'lyrics_2_2002.json'}    # 2001 has no lyrics page
+    assert {entry.name for entry in archive.entries} == alpha | beta
+    song = archive['lyrics_1_1000.json']
+    assert song['artist'] == 'Alpha'
+    assert song['songs'][0]['title'] == 'Alpha Song 0'
+    assert song['songs'][0]['lyrics'] == "[Verse 1]\nAlpha Song 0 line one\nit's line two"
+
+    records = checkpoint(opts)
+    assert records['Alpha']['n_songs'] == 121 and records['Beta']['n_songs'] == 2
+    assert records['Nobody'] == {'name': 'Nobody', 'artist_id': None, 'n_songs': 0}
+
+
+def test_retries_honor_retry_after(server, tmp_path):
+    server.failures['/songs/2000'] = [429]
+    server.failures['/artists/2/songs'] = [503, 502]
+    opts = options(server, tmp_path)
+    assert asyncio.run(scrape_artists(['Beta'], opts)) == 0
+
+    (limited, _, first_status), (retried, _, second_status) = server.requests('/songs/2000')
+    assert (first_status, second_status) == (429, 200)
+    assert retried - limited >= 0.9     # Retry-After: 1, not the 0.01 s backoff
+    assert [status for _, _, status in server.requests('/artists/2/songs')] == [503, 502, 200]
+    assert checkpoint(opts)['Beta']['n_songs'] == 2
+
+
+def test_client_errors_are_not_retried(server, tmp_path):
+    server.failures['/search'] = [403]
+    opts = options(server, tmp_path)
+    assert asyncio.run(scrape_artists(['Alpha'], opts)) == 1
+    assert len(server.requests('/search')) == 1
+    assert not opts.checkpoint.exists()
+
+
+def test_resume_after_failure(server, tmp_path):
+    # Beta's last song fails on every attempt, so Beta is not checkpointed but its other songs are archived
+    server.failures['/songs/2002'] = [None]
+    opts = options(server, tmp_path)
+    assert asyncio.run(scrape_artists(['Alpha', 'Beta'], opts)) == 1
+    assert len(server.requests('/songs/2002')) == opts.retries + 1
+    assert set(checkpoint(opts)) == {'Alpha'}
+    assert 'lyrics_2_2000.json' in {entry.name for entry in RawArchive(opts.archive_dir).entries}
+
+    del server.failures['/songs/2002']
+    server.log.clear()
+    assert asyncio.run(scrape_artists(['Alpha', 'Beta'], opts)) == 0
+    # Alpha is done and Beta's saved song is skipped
+    assert not [entry for entry in server.log if entry[1].startswith(('/artists/1', '/songs/1'))]
+    assert len(server.requests('/search')) == 1
+    assert not server.requests('/songs/2000')
+    assert [status for _, _, status in server.requests('/songs/2002')] == [200]
+
+    names = [entry.name for entry in RawArchive(opts.archive_dir).entries]
+    assert len(names) == len(set(names)) == 121 + 2
+    assert set(checkpoint(opts)) == {'Alpha', 'Beta'}
@@ -0,0 +1,66 @@
+import math
+import numpy as np
+
+
+class LengthBucketBatchSampler:
+    """
+    Batch sampler (DataLoader(batch_sampler=...)) yielding batches of instances of similar length, so that
+    trim_batch can cut most of the padding. Every epoch the indices are shuffled and, like DistributedSampler,
+    padded to a multiple of num_replicas and split between the replicas. Each replica then sorts windows of
+    batch_size * bucket_size shuffled indices by length, cuts them into batches and shuffles the batch order.
+    Call set_epoch before every epoch for a new shuffle, the same seed gives every replica the same one.
+    """
+
+    def __init__(self, lengths, batch_size, bucket_size=100, num_replicas=1, rank=0, shuffle=True, seed=0,
+                 drop_last=False):
+        self.lengths = np.asarray(lengths)
+        self.batch_size = batch_size
+        self.bucket_size = bucket_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.shuffle = shuffle
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+        self.num_samples = int(math.ceil(len(self.lengths) / num_replicas))
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __len__(self):
+        if self.drop_last:
+            return self.num_samples // self.batch_size
+        return int(math.ceil(self.num_samples / self.batch_size))
+
+    def batches(self):
+        rng = np.random.RandomState((self.seed + self.epoch) % 2 ** 32)
+        indices = rng.permutation(len(self.lengths)) if self.shuffle else np.arange(len(self.lengths))
+        # Pad with repeats so every replica gets the same number of instances
+        indices = np.concatenate([indices, indices[:self.num_samples * self.num_replicas - len(indices)]])
+        indices = indices[self.rank::self.num_replicas]
+
+        batches = []
+        window = self.batch_size * self.bucket_size
+        for start in range(0, len(indices), window):
+            bucket = indices[start:start + window]
+            bucket = bucket[np.argsort(self.lengths[bucket], kind='stable')]
+            batches.extend(bucket[i:i + self.batch_size] for i in range(0, len(bucket), self.batch_size))
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = [b for b in batches if len(b) == self.batch_size]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        return batches
+
+    def __iter__(self):
+        for batch in self.batches():
+            yield batch.tolist()
+
+
+def trim_batch(batch):
+    """
+    Cuts the (input_ids, input_mask, segment_ids, lm_label_ids, is_next) tensors or arrays of a batch to its
+    longest real sequence. Positions past it are padding, which the attention mask already hides from the rest.
+    """
+    input_ids, input_mask, segment_ids, lm_label_ids, is_next = batch
+    length = int(input_mask.sum(1).max())
+    return input_ids[:, :length], input_mask[:, :length], segment_ids[:, :length], lm_label_ids[:, :length], is_next
@@ -0,0 +1,113 @@
+import os
+import shutil
+import logging
+import torch
+
+from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
+
+from pytorch_pretrained_bert import WEIGHTS_NAME, CONFIG_NAME
+
+# A checkpoint {output_dir}/{name}/ holds
+#   WEIGHTS_NAME             the model's state dict, loadable by BertForPreTraining.from_pretrained
+#   CONFIG_NAME              the model's config
+#   TRAINING_STATE_NAME      everything else needed to resume: optimizer state, epoch, loss, ...
+# and any extra text files. The weights are only stored once, in WEIGHTS_NAME.
+TRAINING_STATE_NAME = 'training_state.bin'
+
+
+def snapshot(obj, dtype=None):
+    """Copies every tensor in a (nested) state dict to the CPU, floating point ones as dtype if given"""
+    if torch.is_tensor(obj):
+        to_dtype = dtype if dtype is not None and obj.is_floating_point() else obj.dtype
+        return obj.detach().to(device='cpu', dtype=to_dtype, copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((key, snapshot(value, dtype)) for key, value in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(snapshot(value, dtype) for value in obj)
+    return obj
+
+
+class CheckpointManager:
+    """
+    Saves checkpoints without holding up training: save() copies the model and optimizer state to the CPU
+    and returns, a background thread writes the copy. Only one checkpoint is written at a time, save() waits
+    for the previous one first, so there is never more than one snapshot in memory.
+
+    Each checkpoint is written into {name}.tmp/ and renamed to {name}/ when complete, so a checkpoint
+    directory is never partially written. With half_precision the model weights are stored as float16 (the
+    optimizer state is kept as is, resuming needs it exactly). keep_last and keep_best limit the checkpoints
+    kept to the most recent ones and the ones with the lowest metric, the latest is always kept and 0 for
+    both keeps all of them. Errors in the background thread are raised by the next save(), wait() or close().
+    """
+
+    def __init__(self, output_dir, keep_last=0, keep_best=0, half_precision=False):
+        self.output_dir = Path(output_dir)
+        self.keep_last = keep_last
+        self.keep_best = keep_best
+        self.half_precision = half_precision
+        self.saved = list()     # (name, metric) in the order written
+        self.executor = ThreadPoolExecutor(max_workers=1)
+        self.pending = None
+
+    def save(self, name, model, optimizer=None, metric=None, state=None, files=None):
+        """
+        Snapshots model (not wrapped in DataParallel or DistributedDataParallel) and optimizer for checkpoint
+        {output_dir}/{name}. state is added to the training state, files maps extra file names to their text.
+        """
+        self.wait()
+        weights = snapshot(model.state_dict(), torch.float16 if self.half_precision else None)
+        training_state = dict(state or dict())
+        if optimizer is not None:
+            training_state['optimizer_state_dict'] = snapshot(optimizer.state_dict())
+        training_state['weights'] = WEIGHTS_NAME
+        training_state['half_precision'] = self.half_precision
+        files = dict(files or dict())
+        files[CONFIG_NAME] = model.config.to_json_string()
+        self.pending = self.executor.submit(self.write, str(name), weights, training_state, files, metric)
+
+    def write(self, name, weights, training_state, files, metric):
+        final = self.output_dir / name
+        tmp = self.output_dir / f'{name}.tmp'
+        shutil.rmtree(str(tmp), ignore_errors=True)
+        tmp.mkdir(parents=True)
+        torch.save(weights, str(tmp / WEIGHTS_NAME))
+        torch.save(training_state, str(tmp / TRAINING_STATE_NAME))
+        for filename, text in files.items():
+            (tmp / filename).write_text(text)
+        old = None
+        if final.exists():
+            # Left by an earlier run into the same output_dir, only removed once the new one is in place
+            old = self.output_dir / f'{name}.old'
+            shutil.rmtree(str(old), ignore_errors=True)
+            os.rename(str(final), str(old))
+        os.rename(str(tmp), str(final))
+        if old is not None:
+            shutil.rmtree(str(old))
+        self.saved = [(n, m) for n, m in self.saved if n != name] + [(name, metric)]
+        logging.info(f'Saved checkpoint {final}')
+        self.prune()
+
+    def prune(self):
+        if not self.keep_last and not self.keep_best:
+            return
+        names = [name for name, _ in self.saved]
+        keep = set(names[-max(self.keep_last, 1):])
+        if self.keep_best:
+            ranked = sorted((metric, i) for i, (_, metric) in enumerate(self.saved) if metric is not None)
+            keep.update(names[i] for _, i in ranked[:self.keep_best])
+        for name in names:
+            if name not in keep:
+                shutil.rmtree(str(self.output_dir / name), ignore_errors=True)
+                logging.info(f'Removed checkpoint {self.output_dir / name}')
+        self.saved = [(name, metric) for name, metric in self.saved if name in keep]
+
+    def wait(self):
+        """Blocks until the checkpoint being written is complete"""
+        if self.pending is not None:
+            pending, self.pending = self.pending, None
+            pending.result()
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
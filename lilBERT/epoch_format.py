@@ -0,0 +1,167 @@
+import os
+import json
+import numpy as np
+
+from pathlib import Path
+
+# Binary layout of pregenerated epoch n (metrics 'format': 'npy'), one .npy file per array,
+# N = num_training_examples, L = max_seq_len, P = max_predictions_per_seq:
+#   epoch_{n}.input_ids.npy            int32 (N, L)  token ids of [CLS] A [SEP] B [SEP], zero padded
+#   epoch_{n}.lengths.npy              int16 (N,)    number of real tokens, the input mask is arange(L) < length
+#   epoch_{n}.a_lengths.npy            int16 (N,)    tokens of [CLS] + segment A, segment ids are 1 from here to length
+#   epoch_{n}.masked_lm_positions.npy  int16 (N, P)  positions of the masked tokens, padded with -1
+#   epoch_{n}.masked_lm_ids.npy        int32 (N, P)  original ids of the masked tokens, padded with 0
+#   epoch_{n}.is_random_next.npy       bool  (N,)
+# Everything the model needs is derived from these on the fly, so loading an epoch is an mmap.
+ARRAYS = {
+    'input_ids': (np.int32, 'seq'),
+    'lengths': (np.int16, None),
+    'a_lengths': (np.int16, None),
+    'masked_lm_positions': (np.int16, 'pred'),
+    'masked_lm_ids': (np.int32, 'pred'),
+    'is_random_next': (np.bool_, None),
+}
+
+
+def array_path(directory, prefix, name):
+    return Path(directory) / f'{prefix}.{name}.npy'
+
+
+def array_shape(name, num_samples, seq_len, max_predictions):
+    width = ARRAYS[name][1]
+    if width == 'seq':
+        return num_samples, seq_len
+    if width == 'pred':
+        return num_samples, max_predictions
+    return (num_samples,)
+
+
+class EpochArrays:
+    """Collects instances as fixed-width rows, for one shard of an epoch"""
+
+    def __init__(self, seq_len, max_predictions):
+        self.seq_len = seq_len
+        self.max_predictions = max_predictions
+        self.blocks = {name: list() for name in ARRAYS}
+        self.num_rows = 0
+
+    def __len__(self):
+        return self.num_rows
+
+    def add(self, input_ids, a_length, masked_lm_positions, masked_lm_ids, is_random_next):
+        assert len(input_ids) <= self.seq_len and len(masked_lm_positions) <= self.max_predictions
+        ids = np.zeros((1, self.seq_len), dtype=np.int32)
+        ids[0, :len(input_ids)] = input_ids
+        positions = np.full((1, self.max_predictions), -1, dtype=np.int16)
+        positions[0, :len(masked_lm_positions)] = masked_lm_positions
+        labels = np.zeros((1, self.max_predictions), dtype=np.int32)
+        labels[0, :len(masked_lm_ids)] = masked_lm_ids
+        self.add_batch({'input_ids': ids, 'lengths': [len(input_ids)], 'a_lengths': [a_length],
+                        'masked_lm_positions': positions, 'masked_lm_ids': labels,
+                        'is_random_next': [is_random_next]})
+
+    def add_batch(self, batch):
+        """Adds a dict of row arrays, such as the batches of instance_builder.InstanceBuilder"""
+        for name, (dtype, _) in ARRAYS.items():
+            self.blocks[name].append(np.asarray(batch[name], dtype=dtype))
+        self.num_rows += len(batch['lengths'])
+
+    def add_instance(self, instance, tokenizer):
+        """Adds an instance dict of create_instances_from_document"""
+        self.add(tokenizer.convert_tokens_to_ids(instance['tokens']),
+                 instance['segment_ids'].index(1) if 1 in instance['segment_ids'] else len(instance['segment_ids']),
+                 instance['masked_lm_positions'],
+                 tokenizer.convert_tokens_to_ids(instance['masked_lm_labels']),
+                 instance['is_random_next'])
+
+    def save(self, directory, prefix):
+        for name, (dtype, _) in ARRAYS.items():
+            shape = array_shape(name, len(self), self.seq_len, self.max_predictions)
+            rows = np.concatenate(self.blocks[name]) if self.blocks[name] else np.zeros(shape, dtype=dtype)
+            np.save(str(array_path(directory, prefix, name)), rows.reshape(shape))
+
+
+def merge_epoch(directory, epoch, shard_prefixes, seq_len, max_predictions, keep_rows=0):
+    """
+    Concatenates saved shards in order into the arrays of epoch_{epoch}, after its first keep_rows instances
+    when appending to an existing epoch. Returns the number of instances.
+    """
+    directory = Path(directory)
+    shard_lengths = [np.load(str(array_path(directory, p, 'lengths')), mmap_mode='r').shape[0]
+                     for p in shard_prefixes]
+    num_samples = keep_rows + sum(shard_lengths)
+    for name, (dtype, _) in ARRAYS.items():
+        final = array_path(directory, f'epoch_{epoch}', name)
+        tmp = final.with_name(final.name + '.tmp')
+        out = np.lib.format.open_memmap(str(tmp), mode='w+', dtype=dtype,
+                                        shape=array_shape(name, num_samples, seq_len, max_predictions))
+        if keep_rows:
+            # Rows past keep_rows can only be left over from an interrupted append
+            out[:keep_rows] = np.load(str(final), mmap_mode='r')[:keep_rows]
+        start = keep_rows
+        for prefix, length in zip(shard_prefixes, shard_lengths):
+            shard_file = array_path(directory, prefix, name)
+            out[start:start + length] = np.load(str(shard_file), mmap_mode='r')
+            start += length
+            shard_file.unlink()
+        out.flush()
+        del out
+        os.replace(str(tmp), str(final))
+    return num_samples
+
+
+def read_metrics(directory, epoch):
+    metrics_file = Path(directory) / f'epoch_{epoch}_metrics.json'
+    if not metrics_file.is_file():
+        return None
+    return json.loads(metrics_file.read_text())
+
+
+def write_metrics(directory, epoch, metrics):
+    """Replaces epoch_{epoch}_metrics.json atomically, it is what marks the epoch files as complete"""
+    metrics_file = Path(directory) / f'epoch_{epoch}_metrics.json'
+    tmp_file = metrics_file.with_name(metrics_file.name + '.tmp')
+    tmp_file.write_text(json.dumps(metrics))
+    os.replace(str(tmp_file), str(metrics_file))
+
+
+def epoch_exists(directory, epoch):
+    """True if epoch_{epoch} was completely written, in either format"""
+    metrics = read_metrics(directory, epoch)
+    if metrics is None:
+        return False
+    if metrics.get('format', 'json') == 'npy':
+        return all(array_path(directory, f'epoch_{epoch}', name).is_file() for name in ARRAYS)
+    return (Path(directory) / f'epoch_{epoch}.json').is_file()
+
+
+def load_epoch(directory, epoch, num_samples=None):
+    """Memory-maps every array of a binary epoch, or only its first num_samples rows"""
+    return {name: np.load(str(array_path(directory, f'epoch_{epoch}', name)), mmap_mode='r')[:num_samples]
+            for name in ARRAYS}
+
+
+def features(arrays, index):
+    """
+    Model inputs of the instances at index (an int or an array of ints): input_ids, input_mask,
+    segment_ids, lm_label_ids (-1 where nothing is predicted) and is_next, all int64
+    """
+    input_ids = np.asarray(arrays['input_ids'][index], dtype=np.int64)
+    positions = np.arange(input_ids.shape[-1])
+    lengths = np.asarray(arrays['lengths'][index], dtype=np.int64)[..., None]
+    a_lengths = np.asarray(arrays['a_lengths'][index], dtype=np.int64)[..., None]
+    input_mask = (positions < lengths).astype(np.int64)
+    segment_ids = ((positions >= a_lengths) & (positions < lengths)).astype(np.int64)
+
+    masked_positions = np.asarray(arrays['masked_lm_positions'][index], dtype=np.int64)
+    masked_ids = np.asarray(arrays['masked_lm_ids'][index], dtype=np.int64)
+    lm_label_ids = np.full(input_ids.shape, -1, dtype=np.int64)
+    valid = masked_positions >= 0
+    if input_ids.ndim == 1:
+        lm_label_ids[masked_positions[valid]] = masked_ids[valid]
+    else:
+        rows = np.nonzero(valid)[0]
+        lm_label_ids[rows, masked_positions[valid]] = masked_ids[valid]
+
+    is_next = np.asarray(arrays['is_random_next'][index], dtype=np.int64)
+    return input_ids, input_mask, segment_ids, lm_label_ids, is_next
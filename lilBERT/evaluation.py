@@ -0,0 +1,107 @@
+import math
+import torch
+import numpy as np
+
+from torch.nn.functional import cross_entropy
+from torch.utils.data import DataLoader
+
+
+def eval_batches(dataset, batch_size, num_examples=None, seed=0, num_replicas=1, rank=0):
+    """
+    Fixed index batches over a PregeneratedDataset, or over a random subset of num_examples of its instances
+    that is the same for the same seed, and the number of instances in them that count. Order does not matter
+    for evaluation, so the instances are sorted by length and every batch holds little padding.
+
+    Every replica gets its share of the instances, padded with repeats at the end of its last batch so that all
+    replicas run the same number of batches. Only the first num_valid instances count towards the metrics.
+    """
+    indices = np.arange(len(dataset))
+    if num_examples is not None and num_examples < len(dataset):
+        indices = np.sort(np.random.RandomState(seed).choice(len(dataset), num_examples, replace=False))
+    local = indices[rank::num_replicas]
+    local = local[np.argsort(np.asarray(dataset.lengths())[local], kind='stable')]
+    num_samples = int(math.ceil(len(indices) / num_replicas))
+    padded = np.concatenate([local, indices[:num_samples - len(local)]])
+    batches = [padded[i:i + batch_size].tolist() for i in range(0, len(padded), batch_size)]
+    return batches, len(local)
+
+
+class Evaluator:
+    """
+    Gradient-free evaluation of a BertForPreTraining on fixed batches of a PregeneratedDataset. The losses are
+    computed here from the model's logits rather than by the model, so the masked LM and next sentence parts
+    can be reported apart: loss (their sum, like the model's training loss), mlm_loss and nsp_loss,
+    mlm_accuracy and nsp_accuracy, and perplexity (exp of the mean masked LM loss). Sums are taken per masked
+    token and per instance over all batches, and over all processes in distributed training. Instances past the
+    first num_valid (the padding of eval_batches) are left out, so distributed metrics are exact.
+
+    Unmasked epochs are masked with a collator made from seed for every evaluate(), so repeated evaluations
+    see the same masks and can be compared.
+    """
+
+    def __init__(self, model, dataset, batches, device, num_valid=None, seed=0, num_workers=0, pin_memory=False):
+        self.model = model
+        self.dataset = dataset
+        self.batches = batches
+        self.num_valid = sum(len(batch) for batch in batches) if num_valid is None else num_valid
+        self.device = device
+        self.seed = seed
+        self.num_workers = num_workers
+        self.pin_memory = pin_memory
+
+    def __len__(self):
+        return len(self.batches)
+
+    def dataloader(self):
+        collate_fn = self.dataset.dynamic_masking(self.dataset.vocab, self.seed)
+        return DataLoader(self.dataset, sampler=self.batches, batch_size=None, collate_fn=collate_fn,
+                          num_workers=self.num_workers, pin_memory=self.pin_memory)
+
+    def evaluate(self, progress=None):
+        """Metrics over all batches, progress is called with the number of every batch done"""
+        was_training = self.model.training
+        self.model.eval()
+        # mlm_loss, mlm_correct, mlm_tokens, nsp_loss, nsp_correct, instances
+        totals = torch.zeros(6, dtype=torch.float64, device=self.device)
+        remaining = self.num_valid
+        with torch.no_grad():
+            for batch in self.dataloader():
+                # Batches come trimmed from the dataset
+                batch = tuple(t.to(self.device, non_blocking=self.pin_memory) for t in batch)
+                input_ids, input_mask, segment_ids, lm_label_ids, is_next = batch
+                prediction_scores, seq_relationship_score = self.model(input_ids, segment_ids, input_mask)
+                # Padding instances still go through the model, every replica runs the same batches
+                valid = max(0, min(len(is_next), remaining))
+                remaining -= valid
+                prediction_scores, seq_relationship_score = prediction_scores[:valid], seq_relationship_score[:valid]
+                lm_label_ids, is_next = lm_label_ids[:valid], is_next[:valid]
+                # Logits may be half precision, the sums are not
+                mlm_logits = prediction_scores.float().view(-1, prediction_scores.size(-1))
+                nsp_logits = seq_relationship_score.float().view(-1, 2)
+                labels = lm_label_ids.view(-1)
+                masked = labels != -1
+                totals += torch.stack([
+                    cross_entropy(mlm_logits, labels, ignore_index=-1, reduction='sum').double(),
+                    (mlm_logits.argmax(-1) == labels)[masked].sum().double(),
+                    masked.sum().double(),
+                    cross_entropy(nsp_logits, is_next.view(-1), reduction='sum').double(),
+                    (nsp_logits.argmax(-1) == is_next.view(-1)).sum().double(),
+                    torch.tensor(float(is_next.numel()), dtype=torch.float64, device=self.device),
+                ])
+                if progress is not None:
+                    progress(1)
+        if torch.distributed.is_available() and torch.distributed.is_initialized():
+            torch.distributed.all_reduce(totals)
+        self.model.train(was_training)
+
+        mlm_loss, mlm_correct, mlm_tokens, nsp_loss, nsp_correct, instances = totals.tolist()
+        mlm_loss /= max(mlm_tokens, 1)
+        nsp_loss /= max(instances, 1)
+        return {'loss': mlm_loss + nsp_loss,
+                'mlm_loss': mlm_loss,
+                'nsp_loss': nsp_loss,
+                'mlm_accuracy': mlm_correct / max(mlm_tokens, 1),
+                'nsp_accuracy': nsp_correct / max(instances, 1),
+                'perplexity': math.exp(min(mlm_loss, 100)),
+                'masked_tokens': int(mlm_tokens),
+                'instances': int(instances)}
@@ -0,0 +1,89 @@
+import os
+import json
+import shutil
+import hashlib
+
+from pathlib import Path
+
+# Converted features of a JSON epoch, kept between runs in {cache_dir}/{epoch file stem}.{key}/:
+#   {name}.memmap      one raw array per feature, see finetune_on_pregenerated.JSON_ARRAYS
+#   features.json      what the entry was built from, written last so it marks the entry as complete
+# The key hashes the epoch file's contents, the vocabulary and max_seq_len, so an entry is only ever found
+# by the exact inputs it was built from. Entries of an epoch file whose contents changed are removed when
+# the new entry is built.
+FEATURE_CACHE_DIR = 'feature_cache'
+_digests = dict()
+
+
+def file_digest(path, chunk_size=1 << 20):
+    """md5 of a file's contents, remembered for this process as long as its size and mtime are unchanged"""
+    stat = os.stat(str(path))
+    memo_key = (str(Path(path).resolve()), stat.st_size, stat.st_mtime_ns)
+    if memo_key not in _digests:
+        digest = hashlib.md5()
+        with open(str(path), 'rb') as f:
+            for chunk in iter(lambda: f.read(chunk_size), b''):
+                digest.update(chunk)
+        _digests[memo_key] = digest.hexdigest()
+    return _digests[memo_key]
+
+
+def known_digests():
+    return dict(_digests)
+
+
+def remember_digests(digests):
+    """Adds file digests computed by another process"""
+    _digests.update(digests)
+
+
+def vocab_digest(vocab):
+    return hashlib.md5('\n'.join(f'{token}\t{i}' for token, i in vocab.items()).encode('utf-8')).hexdigest()
+
+
+def cache_entry(cache_dir, data_file, vocab, seq_len):
+    """Directory of the features of data_file for this vocabulary and max_seq_len, and what it is keyed by"""
+    meta = {'data_file': str(Path(data_file).resolve()), 'file_digest': file_digest(data_file),
+            'vocab_digest': vocab_digest(vocab), 'max_seq_len': seq_len}
+    key = hashlib.md5(f'{meta["file_digest"]}/{meta["vocab_digest"]}/{seq_len}'.encode('utf-8')).hexdigest()
+    return Path(cache_dir) / f'{Path(data_file).stem}.{key[:16]}', meta
+
+
+def entry_complete(entry):
+    return (Path(entry) / 'features.json').is_file()
+
+
+def build_entry(entry, meta, build):
+    """
+    Calls build(working_dir) to write the feature memmaps of an entry into a private directory, which is then
+    renamed into place. If another process finished the same entry first, its files are kept.
+    """
+    entry = Path(entry)
+    entry.parent.mkdir(parents=True, exist_ok=True)
+    tmp = entry.with_name(f'{entry.name}.tmp-{os.getpid()}')
+    shutil.rmtree(str(tmp), ignore_errors=True)
+    tmp.mkdir()
+    try:
+        arrays = build(tmp)
+        for array in arrays.values():
+            array.flush()
+        del arrays
+        (tmp / 'features.json').write_text(json.dumps(meta))
+        os.rename(str(tmp), str(entry))
+    except OSError:
+        if not entry_complete(entry):
+            raise
+    finally:
+        shutil.rmtree(str(tmp), ignore_errors=True)
+    remove_stale(entry.parent, meta)
+
+
+def remove_stale(cache_dir, meta):
+    """Removes entries built from an earlier version of meta's epoch file"""
+    for meta_file in Path(cache_dir).glob('*/features.json'):
+        try:
+            other = json.loads(meta_file.read_text())
+        except (OSError, ValueError):
+            continue
+        if other['data_file'] == meta['data_file'] and other['file_digest'] != meta['file_digest']:
+            shutil.rmtree(str(meta_file.parent), ignore_errors=True)
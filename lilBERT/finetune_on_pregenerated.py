@@ -1,22 +1,35 @@
 from argparse import ArgumentParser
+import os
 from pathlib import Path
 import torch
 import logging
 import json
 import random
+import weakref
+import traceback
 import numpy as np
+import multiprocessing as mp
+from queue import Empty
+from itertools import islice
+from functools import partial
 from collections import namedtuple
 from tempfile import TemporaryDirectory
 
-from torch.utils.data import DataLoader, Dataset, RandomSampler
+from torch.utils.data import BatchSampler, DataLoader, Dataset, RandomSampler, get_worker_info
 from torch.utils.data.distributed import DistributedSampler
 from tqdm import tqdm
 
-from pytorch_pretrained_bert import WEIGHTS_NAME, CONFIG_NAME
 from pytorch_pretrained_bert.modeling import BertForPreTraining
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.optimization import BertAdam, WarmupLinearSchedule
 
+from epoch_format import epoch_exists, features, load_epoch, read_metrics
+from instance_builder import LineEndMasker
+from batching import LengthBucketBatchSampler, trim_batch
+from evaluation import Evaluator, eval_batches
+from checkpointing import CheckpointManager
+import feature_cache
+
 InputFeatures = namedtuple('InputFeatures', 'input_ids input_mask segment_ids lm_label_ids is_next')
 
 log_format = '%(asctime)-10s: %(message)s'
@@ -54,71 +67,335 @@ def convert_example_to_features(example, tokenizer, max_seq_length):
     return features
 
 
+# Arrays of a JSON epoch once converted to features, with the number of dimensions of each
+JSON_ARRAYS = {
+    'input_ids': (np.int32, 2),
+    'input_masks': (np.bool_, 2),
+    'segment_ids': (np.bool_, 2),
+    'lm_label_ids': (np.int32, 2),
+    'is_nexts': (np.bool_, 1),
+}
+
+
+def open_json_arrays(working_dir, num_samples, seq_len, mode):
+    """The arrays of a JSON epoch as {name}.memmap files of working_dir, or in memory if working_dir is None"""
+    arrays = dict()
+    for name, (dtype, ndim) in JSON_ARRAYS.items():
+        shape = (num_samples, seq_len) if ndim == 2 else (num_samples,)
+        if working_dir is None:
+            arrays[name] = np.zeros(shape=shape, dtype=dtype)
+        else:
+            arrays[name] = np.memmap(filename=Path(working_dir) / f'{name}.memmap', mode=mode, dtype=dtype, shape=shape)
+    return arrays
+
+
+def parse_epoch_json(data_file, num_samples, seq_len, tokenizer, working_dir=None):
+    arrays = open_json_arrays(working_dir, num_samples, seq_len, mode='w+')
+    arrays['lm_label_ids'][:] = -1
+    with data_file.open() as f:
+        # Lines past num_samples can only be left over from an interrupted --append
+        for i, line in enumerate(tqdm(islice(f, num_samples), total=num_samples, desc='Training examples')):
+            line = line.strip()
+            example = json.loads(line)
+            features = convert_example_to_features(example, tokenizer, seq_len)
+            arrays['input_ids'][i] = features.input_ids
+            arrays['segment_ids'][i] = features.segment_ids
+            arrays['input_masks'][i] = features.input_mask
+            arrays['lm_label_ids'][i] = features.lm_label_ids
+            arrays['is_nexts'][i] = features.is_next
+    assert i == num_samples - 1  # Assert that the sample count metric was true
+    return arrays
+
+
+def to_tensors(arrays):
+    # Trimmed batches are column slices, pinning and non-blocking copies want contiguous tensors
+    return tuple(torch.from_numpy(a if a.flags.c_contiguous else a.copy()) for a in arrays)
+
+
+class DynamicMaskingCollator:
+    """
+    Collates dataset indices of an unmasked npy epoch (pregenerated with --dynamic_masking) into batches,
+    masking every batch afresh with the line-end preference of create_masked_lm_predictions.
+    Every DataLoader worker masks with its own random state, derived from seed and the worker id.
+    """
+
+    def __init__(self, dataset, vocab, masked_lm_prob, max_predictions_per_seq, seed):
+        self.dataset = dataset
+        self.seed = seed
+        self.worker_id = None
+        self.masker = LineEndMasker(vocab, masked_lm_prob, max_predictions_per_seq, np.random.RandomState(seed))
+
+    def __call__(self, indices):
+        worker_info = get_worker_info()
+        if worker_info is not None and worker_info.id != self.worker_id:
+            # Each worker has a copy of this collator, which would otherwise repeat the others' random draws
+            self.worker_id = worker_info.id
+            self.masker.rng = np.random.RandomState([self.seed % 2 ** 32, worker_info.id])
+        index = np.asarray(indices)
+        arrays = self.dataset.arrays
+        batch = {name: arrays[name][index] for name in ('input_ids', 'lengths', 'a_lengths', 'is_random_next')}
+        batch['masked_lm_positions'], batch['masked_lm_ids'] = self.masker(batch['input_ids'], batch['lengths'])
+        return to_tensors(trim_batch(features(batch, slice(None))))
+
+
 class PregeneratedDataset(Dataset):
     def __init__(self, training_path, epoch, tokenizer, num_data_epochs, train_or_dev,
-                 reduce_memory=False):
+                 reduce_memory=False, prefetched=None, feature_cache_dir=None):
         self.vocab = tokenizer.vocab
         self.tokenizer = tokenizer
+        self.training_path = training_path
         self.epoch = epoch
         self.data_epoch = epoch % num_data_epochs
-        data_file = training_path / f'epoch_{self.data_epoch}.json'
-        metrics_file = training_path / f'epoch_{self.data_epoch}_metrics.json'
-        assert data_file.is_file() and metrics_file.is_file()
-        metrics = json.loads(metrics_file.read_text())
+        assert epoch_exists(training_path, self.data_epoch)
+        metrics = read_metrics(training_path, self.data_epoch)
         num_samples = metrics['num_training_examples']
         seq_len = metrics['max_seq_len']
+        self.num_samples = num_samples
+        self.seq_len = seq_len
+        self.metrics = metrics
+        self.masked = metrics.get('masked', True)
         self.temp_dir = None
         self.working_dir = None
-        if reduce_memory:
-            self.temp_dir = TemporaryDirectory()
+        self.arrays = None
+        if metrics.get('format', 'json') == 'npy':
+            # Token ids were written by pregeneration, the epoch only needs to be memory-mapped
+            logging.info(f'Memory-mapping {train_or_dev} examples for epoch {epoch}')
+            self.arrays = load_epoch(training_path, self.data_epoch, num_samples)
+            assert len(self.arrays['lengths']) == num_samples
+            return
+
+        data_file = training_path / f'epoch_{self.data_epoch}.json'
+        if prefetched is not None:
+            # Parsed by an EpochPrefetcher process, which hands over the memmap files and their directory
+            logging.info(f'Using prefetched {train_or_dev} examples for epoch {epoch}')
+            self.temp_dir = prefetched
             self.working_dir = Path(self.temp_dir.name)
-            input_ids = np.memmap(filename=self.working_dir/'input_ids.memmap',
-                                  mode='w+', dtype=np.int32, shape=(num_samples, seq_len))
-            input_masks = np.memmap(filename=self.working_dir/'input_masks.memmap',
-                                    shape=(num_samples, seq_len), mode='w+', dtype=np.bool)
-            segment_ids = np.memmap(filename=self.working_dir/'segment_ids.memmap',
-                                    shape=(num_samples, seq_len), mode='w+', dtype=np.bool)
-            lm_label_ids = np.memmap(filename=self.working_dir/'lm_label_ids.memmap',
-                                     shape=(num_samples, seq_len), mode='w+', dtype=np.int32)
-            lm_label_ids[:] = -1
-            is_nexts = np.memmap(filename=self.working_dir/'is_nexts.memmap',
-                                 shape=(num_samples,), mode='w+', dtype=np.bool)
+            arrays = open_json_arrays(self.working_dir, num_samples, seq_len, mode='r')
+        elif feature_cache_dir is not None:
+            entry, meta = feature_cache.cache_entry(feature_cache_dir, data_file, self.vocab, seq_len)
+            if feature_cache.entry_complete(entry):
+                logging.info(f'Using cached {train_or_dev} features for epoch {epoch} from {entry}')
+            else:
+                logging.info(f'Loading {train_or_dev} examples for epoch {epoch} into {entry}')
+                feature_cache.build_entry(entry, meta,
+                                          partial(parse_epoch_json, data_file, num_samples, seq_len, tokenizer))
+                logging.info('Loading complete!')
+            self.working_dir = entry
+            arrays = open_json_arrays(self.working_dir, num_samples, seq_len, mode='r')
         else:
-            input_ids = np.zeros(shape=(num_samples, seq_len), dtype=np.int32)
-            input_masks = np.zeros(shape=(num_samples, seq_len), dtype=np.bool)
-            segment_ids = np.zeros(shape=(num_samples, seq_len), dtype=np.bool)
-            lm_label_ids = np.full(shape=(num_samples, seq_len), dtype=np.int32, fill_value=-1)
-            is_nexts = np.zeros(shape=(num_samples,), dtype=np.bool)
-        logging.info(f'Loading {train_or_dev} examples for epoch {epoch}')
-        with data_file.open() as f:
-            for i, line in enumerate(tqdm(f, total=num_samples, desc='Training examples')):
-                line = line.strip()
-                example = json.loads(line)
-                features = convert_example_to_features(example, tokenizer, seq_len)
-                input_ids[i] = features.input_ids
-                segment_ids[i] = features.segment_ids
-                input_masks[i] = features.input_mask
-                lm_label_ids[i] = features.lm_label_ids
-                is_nexts[i] = features.is_next
-        assert i == num_samples - 1  # Assert that the sample count metric was true
-        logging.info('Loading complete!')
-        self.num_samples = num_samples
-        self.seq_len = seq_len
-        self.input_ids = input_ids
-        self.input_masks = input_masks
-        self.segment_ids = segment_ids
-        self.lm_label_ids = lm_label_ids
-        self.is_nexts = is_nexts
+            if reduce_memory:
+                self.temp_dir = TemporaryDirectory()
+                self.working_dir = Path(self.temp_dir.name)
+            logging.info(f'Loading {train_or_dev} examples for epoch {epoch}')
+            arrays = parse_epoch_json(data_file, num_samples, seq_len, tokenizer, self.working_dir)
+            logging.info('Loading complete!')
+        self.input_ids = arrays['input_ids']
+        self.input_masks = arrays['input_masks']
+        self.segment_ids = arrays['segment_ids']
+        self.lm_label_ids = arrays['lm_label_ids']
+        self.is_nexts = arrays['is_nexts']
 
     def __len__(self):
         return self.num_samples
 
+    def lengths(self):
+        """Number of real tokens of every instance"""
+        if self.arrays is not None:
+            return self.arrays['lengths']
+        return self.input_masks.sum(axis=1)
+
+    def dynamic_masking(self, vocab, seed):
+        """Collate function of an unmasked epoch, None if the epoch was masked by pregeneration"""
+        if self.masked:
+            return None
+        return DynamicMaskingCollator(self, vocab, self.metrics['masked_lm_prob'],
+                                      self.metrics['max_predictions_per_seq'], seed)
+
     def __getitem__(self, item):
-        return (torch.tensor(self.input_ids[item].astype(np.int64)),
-                torch.tensor(self.input_masks[item].astype(np.int64)),
-                torch.tensor(self.segment_ids[item].astype(np.int64)),
-                torch.tensor(self.lm_label_ids[item].astype(np.int64)),
-                torch.tensor(self.is_nexts[item].astype(np.int64)))
+        """
+        The features of one instance, or of a whole batch if item is a list of indices (as passed by
+        epoch_dataloader), which are gathered with a single fancy index per array
+        """
+        single = isinstance(item, (int, np.integer))
+        if not single:
+            item = np.asarray(item)
+        if not self.masked:
+            return item  # Masked by DynamicMaskingCollator
+        if self.arrays is not None:
+            batch = features(self.arrays, item)
+        else:
+            batch = tuple(np.asarray(getattr(self, name)[item], dtype=np.int64) for name in JSON_ARRAYS)
+        return to_tensors(batch if single else trim_batch(batch))
+
+    def __getstate__(self):
+        # DataLoader workers that do not fork reopen the memory-mapped files rather than receive pickled copies
+        state = self.__dict__.copy()
+        state['temp_dir'] = None    # Only the training process may delete it
+        if self.arrays is not None:
+            state['arrays'] = None
+        elif self.working_dir is not None:
+            for name in JSON_ARRAYS:
+                state[name] = None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.metrics.get('format', 'json') == 'npy':
+            self.arrays = load_epoch(self.training_path, self.data_epoch, self.num_samples)
+        elif self.working_dir is not None:
+            for name, array in open_json_arrays(self.working_dir, self.num_samples, self.seq_len, 'r').items():
+                setattr(self, name, array)
+
+
+def prefetch_worker(data_file, num_samples, seq_len, tokenizer, working_dir, feature_cache_dir, status):
+    """Parses an epoch into working_dir, or into its feature cache entry if feature_cache_dir is given"""
+    try:
+        if feature_cache_dir is not None:
+            entry, meta = feature_cache.cache_entry(feature_cache_dir, data_file, tokenizer.vocab, seq_len)
+            if not feature_cache.entry_complete(entry):
+                feature_cache.build_entry(entry, meta,
+                                          partial(parse_epoch_json, data_file, num_samples, seq_len, tokenizer))
+        else:
+            arrays = parse_epoch_json(data_file, num_samples, seq_len, tokenizer, working_dir)
+            for array in arrays.values():
+                array.flush()
+        # The file hashes come back along, so the training process does not have to hash the epoch again
+        status.put((None, feature_cache.known_digests()))
+    except BaseException:
+        status.put((traceback.format_exc(), None))
+
+
+class EpochPrefetcher:
+    """
+    Double-buffered PregeneratedDatasets: start() parses a JSON epoch into memmap files in a background
+    process while the current epoch trains, dataset() waits for it and hands the files over to the dataset.
+    Prefetched epochs go to shared memory (/dev/shm) as long as the ones in flight plus the ones still held
+    by datasets fit in memory_budget bytes, and to a temporary directory on disc otherwise. With a
+    feature_cache_dir, epochs are prefetched into their feature cache entry instead. npy epochs are only
+    memory-mapped, so they are not prefetched. Errors of the background process are raised by dataset().
+    """
+
+    def __init__(self, tokenizer, memory_budget, enabled=True):
+        self.tokenizer = tokenizer
+        self.memory_budget = memory_budget
+        self.enabled = enabled
+        self.shared_bytes = 0
+        self.jobs = dict()
+        # Spawned rather than forked, the training process may have initialized CUDA
+        self.ctx = mp.get_context('spawn')
+
+    def start(self, training_path, epoch, num_data_epochs, train_or_dev, feature_cache_dir=None):
+        data_epoch = epoch % num_data_epochs
+        key = (str(training_path), epoch, train_or_dev)
+        if not self.enabled or key in self.jobs or not epoch_exists(training_path, data_epoch):
+            return
+        metrics = read_metrics(training_path, data_epoch)
+        if metrics.get('format', 'json') != 'json':
+            return
+        num_samples, seq_len = metrics['num_training_examples'], metrics['max_seq_len']
+        nbytes = sum(np.dtype(dtype).itemsize * num_samples * (seq_len if ndim == 2 else 1)
+                     for dtype, ndim in JSON_ARRAYS.values())
+        if feature_cache_dir is not None:
+            shared, temp_dir, location = False, None, 'feature cache'
+        else:
+            shared = os.path.isdir('/dev/shm') and self.shared_bytes + nbytes <= self.memory_budget
+            if shared:
+                self.shared_bytes += nbytes
+            temp_dir = TemporaryDirectory(dir='/dev/shm' if shared else None)
+            location = 'shared memory' if shared else 'disc'
+        status = self.ctx.Queue()
+        process = self.ctx.Process(target=prefetch_worker, daemon=True,
+                                   args=(training_path / f'epoch_{data_epoch}.json', num_samples, seq_len,
+                                         self.tokenizer, temp_dir.name if temp_dir else None, feature_cache_dir,
+                                         status))
+        process.start()
+        logging.info(f'Prefetching {train_or_dev} examples for epoch {epoch} ({nbytes / 2 ** 20:.0f} MB, {location})')
+        self.jobs[key] = (process, status, temp_dir, nbytes if shared else 0)
+
+    def wait(self, process, status):
+        while True:
+            try:
+                return status.get(timeout=1)
+            except Empty:
+                if not process.is_alive():
+                    try:
+                        return status.get(timeout=1)
+                    except Empty:
+                        return f'Prefetch process exited with code {process.exitcode}', None
+
+    def release(self, nbytes):
+        self.shared_bytes -= nbytes
+
+    def dataset(self, training_path, epoch, num_data_epochs, train_or_dev, reduce_memory=False,
+                feature_cache_dir=None):
+        """The PregeneratedDataset of an epoch, prefetched if start() was called for it"""
+        job = self.jobs.pop((str(training_path), epoch, train_or_dev), None)
+        if job is None:
+            return PregeneratedDataset(training_path=training_path, epoch=epoch, tokenizer=self.tokenizer,
+                                       num_data_epochs=num_data_epochs, train_or_dev=train_or_dev,
+                                       reduce_memory=reduce_memory, feature_cache_dir=feature_cache_dir)
+        process, status, temp_dir, nbytes = job
+        error, digests = self.wait(process, status)
+        process.join()
+        if error is not None:
+            if temp_dir is not None:
+                temp_dir.cleanup()
+            self.release(nbytes)
+            raise RuntimeError(f'Prefetching {train_or_dev} examples for epoch {epoch} failed:\n{error}')
+        feature_cache.remember_digests(digests)
+        dataset = PregeneratedDataset(training_path=training_path, epoch=epoch, tokenizer=self.tokenizer,
+                                      num_data_epochs=num_data_epochs, train_or_dev=train_or_dev,
+                                      prefetched=temp_dir, feature_cache_dir=feature_cache_dir)
+        # Shared memory counts against the budget until the dataset (and so its memmaps) is gone
+        weakref.finalize(dataset, self.release, nbytes)
+        return dataset
+
+    def close(self):
+        for process, _, temp_dir, _ in self.jobs.values():
+            process.terminate()
+            process.join()
+            if temp_dir is not None:
+                temp_dir.cleanup()
+        self.jobs.clear()
+
+
+def feature_cache_dir(training_path, args):
+    if not args.feature_cache:
+        return None
+    return args.feature_cache_dir or training_path / feature_cache.FEATURE_CACHE_DIR
+
+
+def length_bucket_sampler(dataset, args):
+    if args.local_rank == -1:
+        return LengthBucketBatchSampler(dataset.lengths(), args.train_batch_size, args.bucket_size, seed=args.seed)
+    return LengthBucketBatchSampler(dataset.lengths(), args.train_batch_size, args.bucket_size,
+                                    num_replicas=torch.distributed.get_world_size(),
+                                    rank=torch.distributed.get_rank(), seed=args.seed)
+
+
+def dev_evaluator(model, dataset, device, args, num_examples=None):
+    if args.local_rank == -1:
+        num_replicas, rank = 1, 0
+    else:
+        num_replicas, rank = torch.distributed.get_world_size(), torch.distributed.get_rank()
+    batches, num_valid = eval_batches(dataset, args.eval_batch_size, num_examples, seed=args.seed,
+                                      num_replicas=num_replicas, rank=rank)
+    # Dev batches are masked with the same seed every time
+    return Evaluator(model, dataset, batches, device, num_valid=num_valid, seed=args.seed,
+                     num_workers=args.num_workers, pin_memory=args.pin_memory)
+
+
+def format_metrics(metrics):
+    return ', '.join(f'{name}: {value:.5f}' for name, value in metrics.items() if isinstance(value, float))
+
+
+def epoch_dataloader(dataset, batch_sampler, collate_fn, args):
+    """
+    Automatic batching is off (batch_size=None), so every index list of batch_sampler goes to
+    dataset.__getitem__ in one piece and comes back as whole batch tensors, from --num_workers processes
+    """
+    return DataLoader(dataset, sampler=batch_sampler, batch_size=None, collate_fn=collate_fn,
+                      num_workers=args.num_workers, pin_memory=args.pin_memory)
 
 
 def main():
@@ -131,6 +408,12 @@ def main():
     parser.add_argument('--do_lower_case', action='store_true')
     parser.add_argument('--reduce_memory', action='store_true',
                         help='Store training data as on-disc memmaps to massively reduce memory usage')
+    parser.add_argument('--feature_cache', action='store_true',
+                        help='Keep the converted features of JSON epochs as memmaps for later epochs and runs, keyed '
+                             'by the epoch file, vocabulary and max_seq_len')
+    parser.add_argument('--feature_cache_dir', type=Path, default=None,
+                        help=f'Directory of the feature cache, defaults to {feature_cache.FEATURE_CACHE_DIR}/ '
+                             'in each pregenerated data directory')
 
     parser.add_argument('--epochs', type=int, default=3, help='Number of epochs to train for')
     parser.add_argument('--local_rank',
@@ -148,6 +431,29 @@ def main():
                         default=32,
                         type=int,
                         help='Total batch size for training.')
+    parser.add_argument('--eval_batch_size',
+                        default=128,
+                        type=int,
+                        help='Batch size for evaluation, which keeps no activations for backward and can be larger')
+    parser.add_argument('--eval_every',
+                        default=0,
+                        type=int,
+                        help='Also evaluate on a fixed subset of the dev data every this many optimizer steps')
+    parser.add_argument('--eval_examples',
+                        default=2000,
+                        type=int,
+                        help='Number of dev instances in the subset evaluated every --eval_every steps')
+    parser.add_argument('--keep_last_checkpoints',
+                        default=0,
+                        type=int,
+                        help='Keep only this many of the most recent epoch checkpoints, 0 keeps all')
+    parser.add_argument('--keep_best_checkpoints',
+                        default=0,
+                        type=int,
+                        help='Also keep this many epoch checkpoints with the lowest dev loss')
+    parser.add_argument('--save_half_precision',
+                        action='store_true',
+                        help='Store the weights of checkpoints as float16, halving their size')
     parser.add_argument('--fp16',
                         action='store_true',
                         help='Whether to use 16-bit float precision instead of 32-bit')
@@ -169,23 +475,48 @@ def main():
                         type=int,
                         default=42,
                         help='random seed for initialization')
+    parser.add_argument('--prefetch',
+                        action='store_true',
+                        help='Parse the next JSON epoch (and the dev epoch) in a background process while training')
+    parser.add_argument('--prefetch_memory_mb',
+                        type=int,
+                        default=2048,
+                        help='Shared memory for prefetched epochs, any that do not fit are prefetched to disc')
+    parser.add_argument('--length_bucketing',
+                        action='store_true',
+                        help='Batch instances of similar length together, so less of every batch is padding')
+    parser.add_argument('--num_workers',
+                        type=int,
+                        default=0,
+                        help='DataLoader worker processes, each fetching whole batches from the memory-mapped epoch')
+    parser.add_argument('--pin_memory',
+                        action='store_true',
+                        help='Collect batches in pinned memory, so they are copied to the GPU asynchronously')
+    parser.add_argument('--bucket_size',
+                        type=int,
+                        default=100,
+                        help='With --length_bucketing, batches per window of shuffled instances sorted by length')
     args = parser.parse_args()
 
     assert args.pregenerated_training_data.is_dir(), \
         '--pregenerated_training_data should point to the folder of files made by pregenerate_training_data.py!'
 
     samples_per_epoch = []
+    dynamic_masking = False
     for i in range(args.epochs):
-        epoch_file = args.pregenerated_training_data / f'epoch_{i}.json'
-        metrics_file = args.pregenerated_training_data / f'epoch_{i}_metrics.json'
-        if epoch_file.is_file() and metrics_file.is_file():
-            metrics = json.loads(metrics_file.read_text())
+        if epoch_exists(args.pregenerated_training_data, i):
+            metrics = read_metrics(args.pregenerated_training_data, i)
             samples_per_epoch.append(metrics['num_training_examples'])
+            dynamic_masking |= not metrics.get('masked', True)
         else:
             if i == 0:
                 exit('No training data was found!')
-            print(f'Warning! There are fewer epochs of pregenerated data ({i}) than training epochs ({args.epochs}).')
-            print('This script will loop over the available data, but training diversity may be negatively impacted.')
+            if dynamic_masking:
+                logging.info(f'Training on {i} epoch(s) of unmasked data, masked afresh every epoch')
+            else:
+                print(f'Warning! There are fewer epochs of pregenerated data ({i}) than training epochs ({args.epochs}).')
+                print('This script will loop over the available data, but training diversity may be negatively '
+                      'impacted. Pregenerate with --dynamic_masking to mask the data afresh every epoch instead.')
             num_data_epochs = i
             break
     else:
@@ -282,6 +613,8 @@ def main():
     # Track loss
     train_loss_history = list()
     dev_loss_history = list()
+    dev_metrics_history = list()
+    dev_subset_history = list()
 
     # Start training
     global_step = 0
@@ -289,22 +622,42 @@ def main():
     logging.info(f'  Num examples = {total_train_examples}')
     logging.info(f'  Batch size = {args.train_batch_size}')
     logging.info(f'  Num steps = {num_train_optimization_steps} \n')
+    prefetcher = EpochPrefetcher(tokenizer, args.prefetch_memory_mb << 20, enabled=args.prefetch)
+    checkpoints = CheckpointManager(args.output_dir, keep_last=args.keep_last_checkpoints,
+                                    keep_best=args.keep_best_checkpoints, half_precision=args.save_half_precision)
+    train_cache = feature_cache_dir(args.pregenerated_training_data, args)
+    dev_cache = feature_cache_dir(args.pregenerated_dev_data, args)
+    prefetcher.start(args.pregenerated_training_data, 0, num_data_epochs, 'train', train_cache)
+    if args.eval_every:
+        subset_dataset = PregeneratedDataset(training_path=args.pregenerated_dev_data, epoch=0, tokenizer=tokenizer,
+                                             num_data_epochs=num_data_epochs, train_or_dev='dev',
+                                             reduce_memory=args.reduce_memory, feature_cache_dir=dev_cache)
+        subset_evaluator = dev_evaluator(model, subset_dataset, device, args, num_examples=args.eval_examples)
     for epoch in range(args.epochs):
         # Train model
         model.train()
-        epoch_dataset = PregeneratedDataset(epoch=epoch, training_path=args.pregenerated_training_data,
-                                            tokenizer=tokenizer, num_data_epochs=num_data_epochs,
-                                            train_or_dev='train', reduce_memory=args.reduce_memory)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(epoch_dataset)
+        epoch_dataset = prefetcher.dataset(args.pregenerated_training_data, epoch, num_data_epochs, 'train',
+                                           reduce_memory=args.reduce_memory, feature_cache_dir=train_cache)
+        # The dev examples of this epoch and the training examples of the next are parsed while this one trains
+        prefetcher.start(args.pregenerated_dev_data, epoch, num_data_epochs, 'dev', dev_cache)
+        if epoch + 1 < args.epochs:
+            prefetcher.start(args.pregenerated_training_data, epoch + 1, num_data_epochs, 'train', train_cache)
+        collate_fn = epoch_dataset.dynamic_masking(tokenizer.vocab, args.seed + epoch)
+        if args.length_bucketing:
+            train_sampler = length_bucket_sampler(epoch_dataset, args)
+            train_sampler.set_epoch(epoch)
         else:
-            train_sampler = DistributedSampler(epoch_dataset)
-        train_dataloader = DataLoader(epoch_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
+            if args.local_rank == -1:
+                train_sampler = RandomSampler(epoch_dataset)
+            else:
+                train_sampler = DistributedSampler(epoch_dataset)
+            train_sampler = BatchSampler(train_sampler, args.train_batch_size, drop_last=False)
+        train_dataloader = epoch_dataloader(epoch_dataset, train_sampler, collate_fn, args)
         tr_loss = 0
         nb_tr_examples, nb_tr_steps = 0, 0
         with tqdm(total=len(train_dataloader), desc=f'Epoch {epoch}') as train_pbar:
             for step, batch in enumerate(train_dataloader):
-                batch = tuple(t.to(device) for t in batch)
+                batch = tuple(t.to(device, non_blocking=args.pin_memory) for t in batch)
                 input_ids, input_mask, segment_ids, lm_label_ids, is_next = batch
                 loss = model(input_ids, segment_ids, input_mask, lm_label_ids, is_next)
                 if n_gpu > 1:
@@ -333,66 +686,33 @@ def main():
                     optimizer.step()
                     optimizer.zero_grad()
                     global_step += 1
+                    if args.eval_every and global_step % args.eval_every == 0:
+                        dev_subset_metrics = subset_evaluator.evaluate()
+                        dev_subset_history.append((global_step, dev_subset_metrics))
+                        logging.info(f'Step {global_step} dev subset {format_metrics(dev_subset_metrics)}')
 
         # Evaluate dev loss
-        model.eval()
-        dev_dataset = PregeneratedDataset(epoch=epoch, training_path=args.pregenerated_dev_data,
-                                          tokenizer=tokenizer, num_data_epochs=num_data_epochs,
-                                          train_or_dev='dev', reduce_memory=args.reduce_memory)
-        if args.local_rank == -1:
-            train_sampler = RandomSampler(dev_dataset)
-        else:
-            train_sampler = DistributedSampler(dev_dataset)
-        dev_dataloader = DataLoader(dev_dataset, sampler=train_sampler, batch_size=args.train_batch_size)
-        dev_loss = 0
-        nb_dev_examples, nb_dev_steps = 0, 0
-        with tqdm(total=len(dev_dataloader), desc=f'Epoch {epoch}') as dev_pbar:
-            for step, batch in enumerate(dev_dataloader):
-                batch = tuple(t.to(device) for t in batch)
-                input_ids, input_mask, segment_ids, lm_label_ids, is_next = batch
-                loss = model(input_ids, segment_ids, input_mask, lm_label_ids, is_next)
-                if n_gpu > 1:
-                    loss = loss.mean()  # mean() to average on multi-gpu.
-                if args.gradient_accumulation_steps > 1:
-                    loss = loss / args.gradient_accumulation_steps
-                if args.fp16:
-                    optimizer.backward(loss)
-                else:
-                    loss.backward()
-                dev_loss += loss.item()
-                nb_dev_examples += input_ids.size(0)
-                nb_dev_steps += 1
-                dev_pbar.update(1)
-                mean_dev_loss = dev_loss * args.gradient_accumulation_steps / nb_dev_steps
-                dev_pbar.set_postfix_str(f'Loss: {mean_dev_loss:.5f}')
-        dev_loss_history.append((epoch, mean_dev_loss))     # Only collect final mean dev loss
-
-        # Save training progress with optimizer
-        logging.info('** ** * Saving training progress * ** **')
-        Path(args.output_dir / f'{epoch}/').mkdir(exist_ok=True)
-
-        output_model_file = args.output_dir / f'{epoch}/model_and_opt.bin'
-        torch.save({'epoch': epoch,
-                    'model_state_dict': model.state_dict(),
-                    'optimizer_state_dict': optimizer.state_dict(),
-                    'loss': tr_loss,
-                    }, str(output_model_file))
-
-        # Save easily-loadable model module
-        logging.info(f'** ** * Saving fine-tuned model {epoch} * ** ** \n')
-        model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
-
-        output_model_file = args.output_dir / f'{epoch}/{WEIGHTS_NAME}'
-        output_config_file = args.output_dir / f'{epoch}/{CONFIG_NAME}'
-
-        torch.save(model_to_save.state_dict(), str(output_model_file))
-        model_to_save.config.to_json_file(str(output_config_file))
-        tokenizer.save_vocabulary(args.output_dir)
-
-        # Save loss history after every epoch
-        with open(args.output_dir / f'{epoch}/loss_history.json', 'a') as h:
-            hist = {'dev': dev_loss_history, 'train': train_loss_history}
-            h.write(f'{json.dumps(hist)}\n')
+        dev_dataset = prefetcher.dataset(args.pregenerated_dev_data, epoch, num_data_epochs, 'dev',
+                                         reduce_memory=args.reduce_memory, feature_cache_dir=dev_cache)
+        evaluator = dev_evaluator(model, dev_dataset, device, args)
+        with tqdm(total=len(evaluator), desc=f'Epoch {epoch} dev') as dev_pbar:
+            dev_metrics = evaluator.evaluate(progress=dev_pbar.update)
+        logging.info(f'Epoch {epoch} dev {format_metrics(dev_metrics)}')
+        dev_loss_history.append((epoch, dev_metrics['loss']))     # Only collect final mean dev loss
+        dev_metrics_history.append((epoch, dev_metrics))
+
+        # Save training progress with optimizer and the fine-tuned model, written while the next epoch trains
+        if args.local_rank in [-1, 0]:
+            logging.info(f'** ** * Saving training progress and fine-tuned model {epoch} * ** ** \n')
+            model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
+            hist = {'dev': dev_loss_history, 'train': train_loss_history,
+                    'dev_metrics': dev_metrics_history, 'dev_subset': dev_subset_history}
+            checkpoints.save(epoch, model_to_save, optimizer, metric=dev_metrics['loss'],
+                             state={'epoch': epoch, 'loss': tr_loss},
+                             files={'loss_history.json': f'{json.dumps(hist)}\n'})
+            tokenizer.save_vocabulary(args.output_dir)
+    prefetcher.close()
+    checkpoints.close()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,260 @@
+import numpy as np
+
+
+class LineEndMasker:
+    """
+    create_masked_lm_predictions for a whole batch of assembled instances: 40% of the predictions go to
+    line-end tokens (followed by [SEP]) and 60% to interior tokens, then each is replaced by [MASK] 80%,
+    left as is 10% and replaced by a random token 10% of the time. Random ranks stand in for sample().
+    """
+
+    def __init__(self, vocab, masked_lm_prob, max_predictions_per_seq, rng):
+        self.masked_lm_prob = masked_lm_prob
+        self.max_predictions_per_seq = max_predictions_per_seq
+        self.vocab_size = len(vocab)
+        self.cls_id = vocab['[CLS]']
+        self.sep_id = vocab['[SEP]']
+        self.mask_id = vocab['[MASK]']
+        self.rng = rng
+
+    def choose(self, candidates, k):
+        """Boolean mask of k[r] uniformly chosen candidates of every row r"""
+        scores = np.where(candidates, self.rng.random_sample(candidates.shape), 2.0)
+        ranks = np.argsort(np.argsort(scores, axis=1, kind='stable'), axis=1, kind='stable')
+        return candidates & (ranks < k[:, None])
+
+    def __call__(self, input_ids, lengths):
+        """Masks input_ids in place, returns the masked positions and original ids padded to max_predictions"""
+        n, seq_len = input_ids.shape
+        in_seq = np.arange(seq_len)[None, :] < lengths[:, None]
+        is_sep = in_seq & (input_ids == self.sep_id)
+        is_cls = in_seq & (input_ids == self.cls_id)
+        # Line ends are the tokens right before each [SEP]
+        line_ends = np.zeros_like(is_sep)
+        line_ends[:, :-1] = is_sep[:, 1:]
+        interior = in_seq & ~is_cls & ~is_sep & ~line_ends
+
+        num_to_mask = np.minimum(self.max_predictions_per_seq,
+                                 np.maximum(1, np.round(lengths * self.masked_lm_prob).astype(np.int64)))
+        k_line_ends = np.minimum((num_to_mask * 0.4).astype(np.int64), line_ends.sum(axis=1))
+        k_interior = np.minimum((num_to_mask * 0.6).astype(np.int64), interior.sum(axis=1))
+        chosen = self.choose(line_ends, k_line_ends) | self.choose(interior, k_interior)
+
+        # 80% [MASK], 10% original, 10% random token
+        mask_rows, mask_columns = np.nonzero(chosen)
+        labels = input_ids[mask_rows, mask_columns]
+        policy = self.rng.random_sample(len(labels))
+        random_ids = self.rng.randint(0, self.vocab_size, size=len(labels))
+        input_ids[mask_rows, mask_columns] = np.where(policy < 0.8, self.mask_id,
+                                                      np.where(policy < 0.9, labels, random_ids))
+
+        counts = chosen.sum(axis=1)
+        slots = np.arange(len(labels)) - np.repeat(np.cumsum(counts) - counts, counts)
+        positions = np.full((n, self.max_predictions_per_seq), -1, dtype=np.int16)
+        masked_ids = np.zeros((n, self.max_predictions_per_seq), dtype=np.int32)
+        positions[mask_rows, slots] = mask_columns
+        masked_ids[mask_rows, slots] = labels
+        return positions, masked_ids
+
+
+class InstanceBuilder:
+    """
+    NumPy version of create_instances_from_document + truncate_seq_pair + create_masked_lm_predictions.
+
+    Documents are only split into (A, B) sentence pairs one by one, which is cheap arithmetic on sentence
+    lengths. Truncation, [CLS]/[SEP] assembly and masking then happen for a whole batch of pairs at once:
+    - truncation always trims the longer sequence, so how many tokens each side loses is known in closed
+      form, and since each trim is from the front with probability 1/2, the front trims are binomial
+    - masking is a LineEndMasker, or skipped with masked=False so instances can be masked at train time
+    The random draws differ from the reference functions, so output is equal in distribution, not in value.
+    Batches are dicts of the arrays of epoch_format.py.
+    """
+
+    def __init__(self, docs, max_seq_length, short_seq_prob, masked_lm_prob, max_predictions_per_seq, vocab, rng,
+                 masked=True):
+        self.docs = docs
+        self.max_seq_length = max_seq_length
+        self.max_num_tokens = max_seq_length - 3
+        self.short_seq_prob = short_seq_prob
+        self.max_predictions_per_seq = max_predictions_per_seq
+        self.cls_id = vocab['[CLS]']
+        self.sep_id = vocab['[SEP]']
+        self.rng = rng
+        self.masker = LineEndMasker(vocab, masked_lm_prob, max_predictions_per_seq, rng) if masked else None
+
+    def pairs_from_document(self, doc_idx):
+        """(tokens_a, tokens_b, is_random_next) id arrays, chunked exactly like create_instances_from_document"""
+        rng = self.rng
+        document = self.docs.document_ids(doc_idx)
+        lengths = [len(sentence) for sentence in document]
+
+        target_seq_length = self.max_num_tokens
+        if rng.random_sample() < self.short_seq_prob:
+            target_seq_length = rng.randint(10, self.max_num_tokens + 1)
+        # Every pair uses up at least one sentence, so a document never needs more random documents than
+        # it has sentences. They are drawn all at once.
+        random_docs = iter(self.docs.sample_docs(doc_idx, size=len(document), rng=rng).tolist())
+
+        pairs = []
+        current_chunk = []
+        current_length = 0
+        i = 0
+        while i < len(document):
+            current_chunk.append(i)
+            current_length += lengths[i]
+            if i == len(document) - 1 or current_length >= target_seq_length:
+                a_end = 1
+                if len(current_chunk) >= 2:
+                    a_end = rng.randint(1, len(current_chunk))
+                tokens_a = [document[j] for j in current_chunk[:a_end]]
+
+                if len(current_chunk) == 1 or rng.random_sample() < 0.5:
+                    is_random_next = True
+                    target_b_length = target_seq_length - sum(lengths[j] for j in current_chunk[:a_end])
+                    random_document = self.docs.document_ids(next(random_docs))
+                    tokens_b, b_length = [], 0
+                    for j in range(rng.randint(0, len(random_document)), len(random_document)):
+                        tokens_b.append(random_document[j])
+                        b_length += len(random_document[j])
+                        if b_length >= target_b_length:
+                            break
+                    # Put the unused segments back
+                    i -= len(current_chunk) - a_end
+                else:
+                    is_random_next = False
+                    tokens_b = [document[j] for j in current_chunk[a_end:]]
+                pairs.append((np.concatenate(tokens_a), np.concatenate(tokens_b), is_random_next))
+                current_chunk = []
+                current_length = 0
+            i += 1
+        return pairs
+
+    def truncate(self, a_lengths, b_lengths):
+        """Tokens kept (from, to) of A and B after truncating like truncate_seq_pair"""
+        excess = np.maximum(a_lengths + b_lengths - self.max_num_tokens, 0)
+        # The longer side is trimmed until both are equal (ties trim B), then they alternate starting with B
+        a_first = np.where(a_lengths > b_lengths, np.minimum(excess, a_lengths - b_lengths), 0)
+        b_first = np.where(a_lengths > b_lengths, 0, np.minimum(excess, b_lengths - a_lengths))
+        rest = excess - a_first - b_first
+        a_trim = a_first + rest // 2
+        b_trim = b_first + rest - rest // 2
+
+        a_front = self.rng.binomial(a_trim, 0.5)
+        b_front = self.rng.binomial(b_trim, 0.5)
+        return (a_front, a_lengths - (a_trim - a_front)), (b_front, b_lengths - (b_trim - b_front))
+
+    @staticmethod
+    def scatter(flat, starts, kept, out, rows, columns):
+        """out[rows[r], columns[r] + k] = flat[starts[r] + kept_from[r] + k] for every kept token k of every row r"""
+        keep_from, keep_to = kept
+        counts = keep_to - keep_from
+        row_of = np.repeat(np.arange(len(counts)), counts)
+        within = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        out[rows[row_of], columns[row_of] + within] = flat[starts[row_of] + keep_from[row_of] + within]
+        return counts
+
+    def build(self, pairs):
+        """Truncates, assembles and (unless masked=False) masks a list of pairs into one batch"""
+        n = len(pairs)
+        seq_len = self.max_seq_length
+        a_flat = np.concatenate([a for a, _, _ in pairs]).astype(np.int32)
+        b_flat = np.concatenate([b for _, b, _ in pairs]).astype(np.int32)
+        a_lengths = np.array([len(a) for a, _, _ in pairs], dtype=np.int64)
+        b_lengths = np.array([len(b) for _, b, _ in pairs], dtype=np.int64)
+        a_starts = np.cumsum(a_lengths) - a_lengths
+        b_starts = np.cumsum(b_lengths) - b_lengths
+
+        a_kept, b_kept = self.truncate(a_lengths, b_lengths)
+        assert (a_kept[1] > a_kept[0]).all() and (b_kept[1] > b_kept[0]).all()
+
+        # [CLS] A [SEP] B [SEP], where lines already end in [SEP] unless truncation cut it off
+        rows = np.arange(n)
+        input_ids = np.zeros((n, seq_len), dtype=np.int32)
+        input_ids[:, 0] = self.cls_id
+        a_counts = self.scatter(a_flat, a_starts, a_kept, input_ids, rows, np.ones(n, dtype=np.int64))
+        a_counts += a_flat[a_starts + a_kept[1] - 1] != self.sep_id
+        input_ids[rows, a_counts] = self.sep_id
+        a_segment = 1 + a_counts
+        b_counts = self.scatter(b_flat, b_starts, b_kept, input_ids, rows, a_segment)
+        b_counts += b_flat[b_starts + b_kept[1] - 1] != self.sep_id
+        lengths = a_segment + b_counts
+        input_ids[rows, lengths - 1] = self.sep_id
+
+        if self.masker is not None:
+            positions, masked_ids = self.masker(input_ids, lengths)
+        else:
+            positions = np.full((n, self.max_predictions_per_seq), -1, dtype=np.int16)
+            masked_ids = np.zeros((n, self.max_predictions_per_seq), dtype=np.int32)
+        return {'input_ids': input_ids,
+                'lengths': lengths.astype(np.int16),
+                'a_lengths': a_segment.astype(np.int16),
+                'masked_lm_positions': positions,
+                'masked_lm_ids': masked_ids,
+                'is_random_next': np.array([r for _, _, r in pairs], dtype=np.bool_)}
+
+    def batches(self, doc_indices, batch_size=4096):
+        """Batches of the instances of doc_indices, in document order"""
+        pairs = []
+        for doc_idx in doc_indices:
+            pairs.extend(self.pairs_from_document(doc_idx))
+            if len(pairs) >= batch_size:
+                yield self.build(pairs)
+                pairs = []
+        if pairs:
+            yield self.build(pairs)
+
+
+def batch_to_instances(batch, id_to_token):
+    """The instance dicts create_instances_from_document would give, for JSON output"""
+    for r in range(len(batch['lengths'])):
+        length, a_length = int(batch['lengths'][r]), int(batch['a_lengths'][r])
+        positions = batch['masked_lm_positions'][r]
+        positions = positions[positions >= 0]
+        yield {'tokens': id_to_token[batch['input_ids'][r, :length]].tolist(),
+               'segment_ids': [0] * a_length + [1] * (length - a_length),
+               'is_random_next': bool(batch['is_random_next'][r]),
+               'masked_lm_positions': positions.tolist(),
+               'masked_lm_labels': id_to_token[batch['masked_lm_ids'][r, :len(positions)]].tolist()}
+
+
+def instance_statistics(instances):
+    """Distribution summaries of instance dicts, for comparing two ways of generating them"""
+    n, tokens, a_tokens, random_next, masked = 0, 0, 0, 0, 0
+    line_end, as_mask, kept, replaced, seps = 0, 0, 0, 0, 0
+    for instance in instances:
+        n += 1
+        length = len(instance['tokens'])
+        tokens += length
+        a_tokens += instance['segment_ids'].count(0)
+        random_next += instance['is_random_next']
+        masked += len(instance['masked_lm_positions'])
+        masked_at = set(instance['masked_lm_positions'])
+        for position, label in zip(instance['masked_lm_positions'], instance['masked_lm_labels']):
+            token = instance['tokens'][position]
+            following = position + 1
+            line_end += following < length and following not in masked_at and instance['tokens'][following] == '[SEP]'
+            as_mask += token == '[MASK]'
+            kept += token == label
+            replaced += token != '[MASK]' and token != label
+        seps += instance['tokens'].count('[SEP]')
+    return {'instances': n,
+            'tokens_per_instance': tokens / n,
+            'a_share': a_tokens / tokens,
+            'random_next': random_next / n,
+            'masked_per_instance': masked / n,
+            'masked_line_end': line_end / masked,
+            'replaced_by_mask': as_mask / masked,
+            'kept_original': kept / masked,
+            'replaced_by_random': replaced / masked,
+            'sep_per_instance': seps / n}
+
+
+def compare_statistics(reference, vectorized, tolerance=0.05):
+    """Rows of (statistic, reference, vectorized, ok), ok if within tolerance relative (or 0.01 absolute)"""
+    rows = []
+    for key in reference:
+        if key == 'instances':
+            continue
+        r, v = reference[key], vectorized[key]
+        rows.append((key, r, v, abs(r - v) <= max(tolerance * abs(r), 0.01)))
+    return rows
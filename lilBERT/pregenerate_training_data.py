@@ -1,82 +1,209 @@
+import os
+import sys
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data', 'formatting'))
+
 from argparse import ArgumentParser
 from pathlib import Path
 from tqdm import tqdm, trange
 from tempfile import TemporaryDirectory
-import shelve
+import multiprocessing as mp
+import hashlib
+import random as random_module
+from array import array
 
 from random import random, randrange, randint, shuffle, choice, sample
-from pytorch_pretrained_bert.tokenization import BertTokenizer
 import numpy as np
 import json
 
+from corpus_io import expand_corpus, iter_corpus_lines
+from token_corpus import TokenCorpus
+from token_cache import CachedTokenizer
+from epoch_format import EpochArrays, merge_epoch, read_metrics, write_metrics
+from instance_builder import InstanceBuilder, batch_to_instances, instance_statistics, compare_statistics
+
 
 class DocumentDatabase:
-    def __init__(self, reduce_memory=False):
+    """
+    Documents stored as one contiguous int32 array of token ids, with the offset of every sentence into it
+    and the index of the first sentence of every document. With reduce_memory the ids are spilled to a
+    temporary file while loading and memory-mapped afterwards. Any document is a slice away instead of an
+    unpickle: document_ids() gives its sentences as id arrays, and tokens() converts only the ids that end up
+    in an instance back to token strings.
+    """
+    def __init__(self, vocab, reduce_memory=False, flush_tokens=1 << 22):
+        self.vocab = vocab
+        self.id_to_token = np.empty(len(vocab), dtype=object)
+        for token, idx in vocab.items():
+            self.id_to_token[idx] = token
+
         if reduce_memory:
             self.temp_dir = TemporaryDirectory()
             self.working_dir = Path(self.temp_dir.name)
-            self.document_shelf_filepath = self.working_dir / 'shelf.db'
-            self.document_shelf = shelve.open(str(self.document_shelf_filepath),
-                                              flag='n', protocol=-1)
-            self.documents = None
+            self.ids_filepath = self.working_dir / 'ids.int32'
+            self.ids_file = self.ids_filepath.open('wb')
         else:
-            self.documents = []
-            self.document_shelf = None
-            self.document_shelf_filepath = None
             self.temp_dir = None
-        self.doc_lengths = []
+            self.ids_filepath = None
+            self.ids_file = None
+        self.reduce_memory = reduce_memory
+        self.flush_tokens = flush_tokens
+
+        # Filled while loading, compact until freeze() turns them into arrays
+        self.pending = []
+        self.num_pending = 0
+        self.chunks = []
+        self.sentence_offsets = array('q', [0])
+        self.doc_offsets = array('q', [0])
+
+        self.ids = None
+        self.doc_lengths = None
         self.doc_cumsum = None
         self.cumsum_max = None
-        self.reduce_memory = reduce_memory
 
     def add_document(self, document):
-        if not document:
+        """Adds a document given as sentences of token strings"""
+        self.add_document_ids([[self.vocab[token] for token in sentence] for sentence in document])
+
+    def add_document_ids(self, document):
+        """Adds a document given as sentences of token ids"""
+        if not len(document):
+            return
+        for sentence in document:
+            self.pending.append(np.asarray(sentence, dtype=np.int32))
+            self.num_pending += len(sentence)
+            self.sentence_offsets.append(self.sentence_offsets[-1] + len(sentence))
+        self.doc_offsets.append(len(self.sentence_offsets) - 1)
+        if self.num_pending >= self.flush_tokens:
+            self._flush()
+
+    def _flush(self):
+        if not self.pending:
             return
+        ids = np.concatenate(self.pending)
+        if self.reduce_memory:
+            self.ids_file.write(ids.tobytes())
+        else:
+            self.chunks.append(ids)
+        self.pending = []
+        self.num_pending = 0
+
+    def freeze(self):
+        """Done adding documents: builds the arrays (memory-mapped with reduce_memory) and sampling weights"""
+        self._flush()
+        num_tokens = self.sentence_offsets[-1]
         if self.reduce_memory:
-            current_idx = len(self.doc_lengths)
-            self.document_shelf[str(current_idx)] = document
+            self.ids_file.close()
+            self.ids = (np.memmap(str(self.ids_filepath), dtype=np.int32, mode='r', shape=(num_tokens,))
+                        if num_tokens else np.zeros(0, dtype=np.int32))
         else:
-            self.documents.append(document)
-        self.doc_lengths.append(len(document))
+            self.ids = np.concatenate(self.chunks) if self.chunks else np.zeros(0, dtype=np.int32)
+            self.chunks = []
+        self.sentence_offsets = np.frombuffer(self.sentence_offsets, dtype=np.int64).copy()
+        self.doc_offsets = np.frombuffer(self.doc_offsets, dtype=np.int64).copy()
+        self.doc_lengths = np.diff(self.doc_offsets)
+        self._precalculate_doc_weights()
+
+    def load(self, directory):
+        """
+        Adds the documents of a store written by save() to an empty database, returns the store's metadata.
+        Arrays may be longer than the metadata says if a save was interrupted, only its documents are loaded.
+        """
+        assert len(self) == 0, 'Stored documents must be loaded first'
+        directory = Path(directory)
+        meta = json.loads((directory / 'documents.json').read_text())
+        doc_offsets = np.load(str(directory / 'documents.docs.npy'), mmap_mode='r')[:meta['num_documents'] + 1]
+        sentence_offsets = np.load(str(directory / 'documents.sentences.npy'), mmap_mode='r')[:doc_offsets[-1] + 1]
+        ids = np.load(str(directory / 'documents.ids.npy'), mmap_mode='r')[:sentence_offsets[-1]]
+
+        self.doc_offsets = array('q', np.asarray(doc_offsets, dtype=np.int64).tobytes())
+        self.sentence_offsets = array('q', np.asarray(sentence_offsets, dtype=np.int64).tobytes())
+        for start in range(0, len(ids), self.flush_tokens):
+            self.pending.append(np.array(ids[start:start + self.flush_tokens]))
+            self.num_pending += len(self.pending[-1])
+            self._flush()
+        return meta
+
+    def save(self, directory, meta):
+        """
+        Writes the frozen documents to directory/documents.*, so that --append can add to them later.
+        The metadata, with the number of documents, is written last and is what makes the new store count.
+        """
+        directory = Path(directory)
+        for name, values in (('ids', self.ids), ('sentences', self.sentence_offsets), ('docs', self.doc_offsets)):
+            final = directory / f'documents.{name}.npy'
+            tmp = final.with_name(final.name + '.tmp')
+            with tmp.open('wb') as f:
+                np.save(f, values)
+            os.replace(str(tmp), str(final))
+        meta = dict(meta, num_documents=len(self), num_tokens=int(self.sentence_offsets[-1]))
+        tmp = directory / 'documents.json.tmp'
+        tmp.write_text(json.dumps(meta))
+        os.replace(str(tmp), str(directory / 'documents.json'))
+
+    @staticmethod
+    def remove(directory):
+        """Removes a store written by save(), its metadata first"""
+        for name in ['json', 'docs.npy', 'sentences.npy', 'ids.npy']:
+            path = Path(directory) / f'documents.{name}'
+            if path.exists():
+                path.unlink()
 
     def _precalculate_doc_weights(self):
         self.doc_cumsum = np.cumsum(self.doc_lengths)
         self.cumsum_max = self.doc_cumsum[-1]
 
     def sample_doc(self, current_idx, sentence_weighted=True):
+        return self[self.sample_doc_index(current_idx, sentence_weighted)]
+
+    def sample_doc_index(self, current_idx, sentence_weighted=True):
         # Uses the current iteration counter to ensure we don't sample the same doc twice
         if sentence_weighted:
             # With sentence weighting, we sample docs proportionally to their sentence length
-            if self.doc_cumsum is None or len(self.doc_cumsum) != len(self.doc_lengths):
-                self._precalculate_doc_weights()
             rand_start = self.doc_cumsum[current_idx]
             rand_end = rand_start + self.cumsum_max - self.doc_lengths[current_idx]
             sentence_index = randrange(rand_start, rand_end) % self.cumsum_max
             sampled_doc_index = np.searchsorted(self.doc_cumsum, sentence_index, side='right')
         else:
             # If we don't use sentence weighting, then every doc has an equal chance to be chosen
-            sampled_doc_index = (current_idx + randrange(1, len(self.doc_lengths))) % len(self.doc_lengths)
+            sampled_doc_index = (current_idx + randrange(1, len(self))) % len(self)
         assert sampled_doc_index != current_idx
-        if self.reduce_memory:
-            return self.document_shelf[str(sampled_doc_index)]
-        else:
-            return self.documents[sampled_doc_index]
+        return sampled_doc_index
+
+    def sample_docs(self, current_idx, size=None, rng=np.random):
+        """
+        Vectorized sample_doc: indices of `size` documents (one per entry if current_idx is an array),
+        sentence-weighted and never current_idx, drawn from a numpy RandomState
+        """
+        current_idx = np.asarray(current_idx)
+        rand_start = self.doc_cumsum[current_idx]
+        offset = (rng.random_sample(size if size is not None else current_idx.shape) *
+                  (self.cumsum_max - self.doc_lengths[current_idx])).astype(np.int64)
+        return np.searchsorted(self.doc_cumsum, (rand_start + offset) % self.cumsum_max, side='right')
+
+    def document_ids(self, item):
+        """Sentences of a document as views into the id array"""
+        bounds = self.sentence_offsets[self.doc_offsets[item]:self.doc_offsets[item + 1] + 1]
+        return [self.ids[start:end] for start, end in zip(bounds[:-1], bounds[1:])]
+
+    def tokens(self, ids):
+        """Token strings of a list of token ids"""
+        return self.id_to_token[np.asarray(ids, dtype=np.int64)].tolist()
 
     def __len__(self):
-        return len(self.doc_lengths)
+        return len(self.doc_offsets) - 1
 
     def __getitem__(self, item):
-        if self.reduce_memory:
-            return self.document_shelf[str(item)]
-        else:
-            return self.documents[item]
+        bounds = self.sentence_offsets[self.doc_offsets[item]:self.doc_offsets[item + 1] + 1].tolist()
+        tokens = self.id_to_token[self.ids[bounds[0]:bounds[-1]]].tolist()
+        return [tokens[start - bounds[0]:end - bounds[0]] for start, end in zip(bounds[:-1], bounds[1:])]
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_val, traceback):
-        if self.document_shelf is not None:
-            self.document_shelf.close()
+        if self.ids_file is not None:
+            self.ids_file.close()
+        self.ids = None
         if self.temp_dir is not None:
             self.temp_dir.cleanup()
 
@@ -152,8 +279,9 @@ def create_instances_from_document(
     """This code is mostly a duplicate of the equivalent function from Google BERT's repo.
     However, we make some changes and improvements. Sampling is improved and no longer requires a loop in this function.
     Also, documents are sampled proportionally to the number of sentences they contain, which means each sentence
-    (rather than each document) has an equal chance of being sampled as a false example for the NextSentence task."""
-    document = doc_database[doc_idx]
+    (rather than each document) has an equal chance of being sampled as a false example for the NextSentence task.
+    Sentences are handled as token ids, only the tokens that survive truncation are converted to strings."""
+    document = [sentence.tolist() for sentence in doc_database.document_ids(doc_idx)]
     # Account for [CLS] ([SEP] tokens were already added between each line)
     max_num_tokens = max_seq_length - 3
     # Sometimes [SEP] can be double truncated so 3 is necessary
@@ -203,11 +331,12 @@ def create_instances_from_document(
                     target_b_length = target_seq_length - len(tokens_a)
 
                     # Sample a random document, with longer docs being sampled more frequently
-                    random_document = doc_database.sample_doc(current_idx=doc_idx, sentence_weighted=True)
+                    random_document = doc_database.document_ids(
+                        doc_database.sample_doc_index(current_idx=doc_idx, sentence_weighted=True))
 
                     random_start = randrange(0, len(random_document))
                     for j in range(random_start, len(random_document)):
-                        tokens_b.extend(random_document[j])
+                        tokens_b.extend(random_document[j].tolist())
                         if len(tokens_b) >= target_b_length:
                             break
                     # We didn't actually use these segments so we 'put them back' so
@@ -223,6 +352,8 @@ def create_instances_from_document(
 
                 assert len(tokens_a) >= 1
                 assert len(tokens_b) >= 1
+                tokens_a = doc_database.tokens(tokens_a)
+                tokens_b = doc_database.tokens(tokens_b)
 
                 # NOTE: [SEP] tokens are added after each line during data cleaning step,
                 #       but they may have been truncated
@@ -250,9 +381,165 @@ def create_instances_from_document(
     return instances
 
 
+def shard_seed(seed, epoch, shard):
+    """Independent, reproducible seed of every (epoch, document shard), whichever process generates it"""
+    digest = hashlib.md5(f'{seed}-{epoch}-{shard}'.encode()).digest()
+    return int.from_bytes(digest[:4], 'big')
+
+
+# Set before the worker pool forks, so workers inherit the documents instead of pickling them
+_shared = dict()
+
+
+def generate_shard(job):
+    """Writes the instances of documents [start, end) for one epoch to temporary shard file(s)"""
+    epoch, shard, start, end, seed = job
+    docs, args, vocab_list = _shared['docs'], _shared['args'], _shared['vocab_list']
+    random_module.seed(seed)
+    np.random.seed(seed)
+
+    def shard_instances():
+        for doc_idx in range(start, end):
+            for instance in create_instances_from_document(
+                    docs, doc_idx, max_seq_length=args.max_seq_len, short_seq_prob=args.short_seq_prob,
+                    masked_lm_prob=args.masked_lm_prob, max_predictions_per_seq=args.max_predictions_per_seq,
+                    vocab_list=vocab_list):
+                yield instance
+
+    def shard_batches():
+        builder = InstanceBuilder(docs, args.max_seq_len, args.short_seq_prob, args.masked_lm_prob,
+                                  args.max_predictions_per_seq, _shared['tokenizer'].vocab,
+                                  rng=np.random.RandomState(seed), masked=not args.dynamic_masking)
+        return builder.batches(range(start, end))
+
+    if args.output_format == 'npy':
+        # Token ids in fixed-width arrays, see epoch_format.py
+        shard_prefix = f'.epoch_{epoch}_shard_{shard}'
+        arrays = EpochArrays(args.max_seq_len, args.max_predictions_per_seq)
+        if args.vectorized or args.dynamic_masking:
+            for batch in shard_batches():
+                arrays.add_batch(batch)
+        else:
+            for instance in shard_instances():
+                arrays.add_instance(instance, _shared['tokenizer'])
+        arrays.save(args.output_dir, shard_prefix)
+        return epoch, shard, shard_prefix, len(arrays)
+
+    if args.vectorized:
+        instances = (instance for batch in shard_batches() for instance in batch_to_instances(batch, docs.id_to_token))
+    else:
+        instances = shard_instances()
+    shard_filename = args.output_dir / f'.epoch_{epoch}_shard_{shard}.json.tmp'
+    num_instances = 0
+    with shard_filename.open('w') as shard_file:
+        for instance in instances:
+            shard_file.write(json.dumps(instance) + '\n')
+            num_instances += 1
+    return epoch, shard, shard_filename, num_instances
+
+
+def check_vectorized(docs, args, vocab_list, tokenizer, num_docs):
+    """
+    Generates instances of the first num_docs documents both ways and compares their statistics,
+    returns True if every statistic agrees within tolerance
+    """
+    num_docs = min(num_docs, len(docs))
+    random_module.seed(args.seed)
+    np.random.seed(args.seed)
+    reference = instance_statistics(
+        instance for doc_idx in range(num_docs) for instance in create_instances_from_document(
+            docs, doc_idx, max_seq_length=args.max_seq_len, short_seq_prob=args.short_seq_prob,
+            masked_lm_prob=args.masked_lm_prob, max_predictions_per_seq=args.max_predictions_per_seq,
+            vocab_list=vocab_list))
+    builder = InstanceBuilder(docs, args.max_seq_len, args.short_seq_prob, args.masked_lm_prob,
+                              args.max_predictions_per_seq, tokenizer.vocab, rng=np.random.RandomState(args.seed))
+    vectorized = instance_statistics(
+        instance for batch in builder.batches(range(num_docs)) for instance in batch_to_instances(batch, docs.id_to_token))
+
+    print(f'{"statistic":<22}{"reference":>12}{"vectorized":>12}')
+    ok = True
+    for key, r, v, within in compare_statistics(reference, vectorized):
+        print(f'{key:<22}{r:>12.4f}{v:>12.4f}{"" if within else "  MISMATCH"}')
+        ok &= within
+    return ok
+
+
+def copy_shards(epoch_file, shard_filenames):
+    for shard_filename in shard_filenames:
+        with shard_filename.open('rb') as shard_file:
+            while True:
+                block = shard_file.read(16 << 20)
+                if not block:
+                    break
+                epoch_file.write(block)
+        shard_filename.unlink()
+
+
+def merge_shards(epoch_filename, shard_filenames):
+    """Concatenates shard files in order into the epoch file, which only appears once complete"""
+    tmp_filename = epoch_filename.with_name(epoch_filename.name + '.tmp')
+    with tmp_filename.open('wb') as epoch_file:
+        copy_shards(epoch_file, shard_filenames)
+    os.replace(str(tmp_filename), str(epoch_filename))
+
+
+def append_shards(epoch_filename, shard_filenames, num_bytes):
+    """
+    Appends shard files to the first num_bytes of the epoch file, the size its metrics were written for,
+    so that anything an interrupted append left behind is cut off first
+    """
+    with epoch_filename.open('r+b') as epoch_file:
+        epoch_file.truncate(num_bytes)
+        epoch_file.seek(num_bytes)
+        copy_shards(epoch_file, shard_filenames)
+        epoch_file.flush()
+        os.fsync(epoch_file.fileno())
+
+
+def corpus_sources(train_corpus):
+    """{path: size} of the files of a corpus, a pre-tokenized corpus is its prefix and number of sections"""
+    if TokenCorpus.is_token_corpus(train_corpus):
+        return {str(train_corpus): TokenCorpus(train_corpus).n_sections}
+    return {str(path): path.stat().st_size for path in expand_corpus(train_corpus)}
+
+
+def load_documents(docs, train_corpus, paths, tokenizer, args, first_section=0):
+    """Adds the documents of the given files of train_corpus, of a pre-tokenized one from first_section on"""
+    if TokenCorpus.is_token_corpus(train_corpus):
+        # Already tokenized, sections are documents and ids only need a vocab lookup
+        corpus = TokenCorpus(train_corpus)
+        if corpus.tokenizer_type != args.bert_model:
+            print(f'Warning! {train_corpus} was tokenized for {corpus.tokenizer_type}, not {args.bert_model}')
+        for section in tqdm(corpus.iter_sections(first_section), total=corpus.n_sections - first_section,
+                            desc='Loading Dataset', unit=' sections'):
+            docs.add_document_ids(section)
+        return
+
+    doc = []
+    for line in tqdm(iter_corpus_lines(paths, workers=args.read_workers),
+                     desc='Loading Dataset', unit=' lines'):
+        line = line.strip()
+        if line == '':
+            docs.add_document(doc)
+            doc = []
+        else:
+            tokens = tokenizer.tokenize(line)
+            doc.append(tokens)
+    if doc:
+        docs.add_document(doc)  # If the last doc didn't end on a newline, make sure it still gets added
+    if isinstance(tokenizer, CachedTokenizer):
+        print(f'Token cache hit rate: {tokenizer.hit_rate:.1%} ({len(tokenizer)} lines cached)')
+        if args.token_cache_file:
+            tokenizer.save()
+
+
 def main():
     parser = ArgumentParser()
-    parser.add_argument('--train_corpus', type=Path, required=True)
+    parser.add_argument('--train_corpus', type=str, required=True,
+                        help='Corpus file, directory or glob of shards, e.g. "cleanLyrics/*-train-*.txt.gz", '
+                             'or a pre-tokenized corpus written by clean_lyrics.py --token-ids')
+    parser.add_argument('--read_workers', type=int, default=1,
+                        help='Number of corpus shards to decompress in parallel')
     parser.add_argument('--output_dir', type=Path, required=True)
     parser.add_argument('--bert_model', type=str, required=True,
                         choices=['bert-base-uncased', 'bert-large-uncased', 'bert-base-cased',
@@ -261,9 +548,14 @@ def main():
 
     parser.add_argument('--reduce_memory', action='store_true',
                         help='Reduce memory usage for large datasets by keeping data on disc rather than in memory')
-
-    parser.add_argument('--epochs_to_generate', type=int, default=3,
-                        help='Number of epochs of data to pregenerate')
+    parser.add_argument('--token_cache_size', type=int, default=1 << 18,
+                        help='Corpus lines whose tokens are memoized, repeated lines are only tokenized once. 0 disables')
+    parser.add_argument('--token_cache_file', type=Path, default=None,
+                        help='Load the token cache from and save it to this .json.gz file')
+
+    parser.add_argument('--epochs_to_generate', type=int, default=None,
+                        help='Number of epochs of data to pregenerate (default 3, with --append the existing '
+                             'ones; more are generated in full)')
     parser.add_argument('--max_seq_len', type=int, default=128)
     parser.add_argument('--short_seq_prob', type=float, default=0.1,
                         help='Probability of making a short sentence as a training example')
@@ -271,24 +563,83 @@ def main():
                         help='Probability of masking each token for the LM task')
     parser.add_argument('--max_predictions_per_seq', type=int, default=20,
                         help='Maximum number of tokens to mask in each sequence')
+    parser.add_argument('--num_workers', type=int, default=1,
+                        help='Number of processes generating document shards')
+    parser.add_argument('--docs_per_shard', type=int, default=4096,
+                        help='Documents per unit of work. Output depends on --seed and this, not on --num_workers')
+    parser.add_argument('--seed', type=int, default=None,
+                        help='Random seed of the epochs, picked at random and saved in the metrics if not given')
+    parser.add_argument('--output_format', choices=['json', 'npy'], default='json',
+                        help='json: one instance of token strings per line. npy: fixed-width token id arrays that '
+                             'finetune_on_pregenerated.py memory-maps without any parsing (layout in epoch_format.py)')
+    parser.add_argument('--vectorized', action='store_true',
+                        help='Truncate, assemble and mask whole batches of instances with NumPy (instance_builder.py). '
+                             'Same distribution of instances as the default, but not the same instances for a seed')
+    parser.add_argument('--check_vectorized', type=int, default=0, metavar='NUM_DOCS',
+                        help='Compare the statistics of --vectorized and default instances on the first NUM_DOCS '
+                             'documents, then exit (non-zero if they differ)')
+    parser.add_argument('--dynamic_masking', action='store_true',
+                        help='Write unmasked instances (npy only), which finetune_on_pregenerated.py masks afresh for '
+                             'every batch, so a single epoch of data can be trained on for any number of epochs')
+    parser.add_argument('--append', action='store_true',
+                        help='Add the corpus files that are not yet in the document store of --output_dir, and '
+                             'append their instances to the existing epochs. Instance settings are taken from those')
+    parser.add_argument('--save_documents', action='store_true',
+                        help='Keep the tokenized documents in --output_dir, so later runs can --append to it')
 
     args = parser.parse_args()
+    if args.dynamic_masking and args.output_format != 'npy':
+        parser.error('--dynamic_masking requires --output_format npy')
+    if args.seed is None:
+        args.seed = random_module.SystemRandom().randrange(2 ** 32)
 
+    # Only needed here, so the document and instance code can be used without the BERT package
+    from pytorch_pretrained_bert.tokenization import BertTokenizer
     tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    if args.token_cache_size:
+        tokenizer = CachedTokenizer(tokenizer, args.bert_model, args.do_lower_case,
+                                    max_size=args.token_cache_size, cache_file=args.token_cache_file)
     vocab_list = list(tokenizer.vocab.keys())
-    with DocumentDatabase(reduce_memory=args.reduce_memory) as docs:
-        with args.train_corpus.open() as f:
-            doc = []
-            for line in tqdm(f, desc='Loading Dataset', unit=' lines'):
-                line = line.strip()
-                if line == '':
-                    docs.add_document(doc)
-                    doc = []
-                else:
-                    tokens = tokenizer.tokenize(line)
-                    doc.append(tokens)
-            if doc:
-                docs.add_document(doc)  # If the last doc didn't end on a newline, make sure it still gets added
+    sources = corpus_sources(args.train_corpus)
+    store_meta = {'bert_model': args.bert_model, 'do_lower_case': args.do_lower_case, 'sources': dict()}
+    previous = list()   # Metrics of the epochs appended to
+    if args.append:
+        if not (args.output_dir / 'documents.json').is_file():
+            exit(f'ERROR: --append needs the document store of an earlier --save_documents run in {args.output_dir}')
+        while read_metrics(args.output_dir, len(previous)) is not None:
+            previous.append(read_metrics(args.output_dir, len(previous)))
+        if not previous:
+            exit(f'ERROR: --append found no epochs in {args.output_dir}')
+        # New instances must fit the existing ones
+        args.max_seq_len = previous[0]['max_seq_len']
+        args.output_format = previous[0].get('format', 'json')
+        args.max_predictions_per_seq = previous[0].get('max_predictions_per_seq', args.max_predictions_per_seq)
+        args.masked_lm_prob = previous[0].get('masked_lm_prob', args.masked_lm_prob)
+        args.dynamic_masking = not previous[0].get('masked', True)
+        args.vectorized = previous[0].get('vectorized', False)
+        args.epochs_to_generate = max(args.epochs_to_generate or 0, len(previous))
+    elif args.epochs_to_generate is None:
+        args.epochs_to_generate = 3
+
+    with DocumentDatabase(tokenizer.vocab, reduce_memory=args.reduce_memory) as docs:
+        if args.append:
+            store_meta = docs.load(args.output_dir)
+            if (store_meta['bert_model'], store_meta['do_lower_case']) != (args.bert_model, args.do_lower_case):
+                exit(f'ERROR: the document store of {args.output_dir} was tokenized for {store_meta["bert_model"]} '
+                     f'(do_lower_case={store_meta["do_lower_case"]})')
+            # clean_lyrics.py starts a new shard every run, but a pre-tokenized corpus only ever grows
+            is_token_corpus = TokenCorpus.is_token_corpus(args.train_corpus)
+            for path, size in sources.items():
+                stored = store_meta['sources'].get(path, size)
+                if stored > size or (stored != size and not is_token_corpus):
+                    exit(f'ERROR: {path} changed since it was added to the document store, '
+                         f'pregenerate without --append instead')
+        num_stored = len(docs)
+        new_sources = {path: size for path, size in sources.items() if store_meta['sources'].get(path) != size}
+        print(f'Adding {len(new_sources)} new or grown corpus file(s) to {num_stored} stored documents')
+        if new_sources:
+            load_documents(docs, args.train_corpus, list(new_sources), tokenizer, args,
+                           first_section=store_meta['sources'].get(str(args.train_corpus), 0))
         if len(docs) <= 1:
             exit('ERROR: No document breaks were found in the input file! These are necessary to allow the script to '
                  'ensure that random NextSentences are not sampled from the same document. Please add blank lines to '
@@ -297,26 +648,79 @@ def main():
                  'sections or paragraphs.')
 
         args.output_dir.mkdir(exist_ok=True)
-        for epoch in trange(args.epochs_to_generate, desc='Epoch'):
-            epoch_filename = args.output_dir / f'epoch_{epoch}.json'
-            num_instances = 0
-            with epoch_filename.open('w') as epoch_file:
-                for doc_idx in trange(len(docs), desc='Document'):
-                    doc_instances = create_instances_from_document(
-                        docs, doc_idx, max_seq_length=args.max_seq_len, short_seq_prob=args.short_seq_prob,
-                        masked_lm_prob=args.masked_lm_prob, max_predictions_per_seq=args.max_predictions_per_seq,
-                        vocab_list=vocab_list)
-                    doc_instances = [json.dumps(instance) for instance in doc_instances]
-                    for instance in doc_instances:
-                        epoch_file.write(instance + '\n')
-                        num_instances += 1
-            metrics_file = args.output_dir / f'epoch_{epoch}_metrics.json'
-            with metrics_file.open('w') as metrics_file:
-                metrics = {
-                    'num_training_examples': num_instances,
-                    'max_seq_len': args.max_seq_len
-                }
-                metrics_file.write(json.dumps(metrics))
+        docs.freeze()
+        if (args.append and new_sources) or args.save_documents:
+            store_meta['sources'].update(new_sources)
+            docs.save(args.output_dir, store_meta)
+        elif not args.append and not args.check_vectorized:
+            # A store left by an earlier run no longer matches the epochs about to be written
+            DocumentDatabase.remove(args.output_dir)
+        _shared.update(docs=docs, args=args, vocab_list=vocab_list, tokenizer=tokenizer)
+        if args.check_vectorized:
+            exit(0 if check_vectorized(docs, args, vocab_list, tokenizer, args.check_vectorized) else 1)
+
+        # Every epoch is split into shards of documents, each generated with its own derived seed. Appended
+        # epochs only cover the documents added since they were generated, with shard seeds of their own.
+        epoch_jobs = list()
+        for epoch in range(args.epochs_to_generate):
+            metrics = previous[epoch] if epoch < len(previous) else None
+            first_doc = metrics.get('num_documents', num_stored) if metrics else 0
+            seed = metrics.get('seed', args.seed) if metrics else args.seed
+            epoch_jobs.append([(epoch, shard, start, min(start + args.docs_per_shard, len(docs)),
+                                shard_seed(seed, epoch, shard if first_doc == 0 else f'{first_doc}+{shard}'))
+                               for shard, start in enumerate(range(first_doc, len(docs), args.docs_per_shard))])
+
+        pool = None
+        jobs = [job for shard_jobs in epoch_jobs for job in shard_jobs]
+        if args.num_workers > 1:
+            pool = mp.get_context('fork').Pool(args.num_workers)
+            results = pool.imap(generate_shard, jobs)
+        else:
+            results = map(generate_shard, jobs)
+
+        try:
+            for epoch in trange(args.epochs_to_generate, desc='Epoch'):
+                if not epoch_jobs[epoch]:
+                    continue    # Already covers every document
+                shard_outputs = list()
+                num_instances = 0
+                for _ in trange(len(epoch_jobs[epoch]), desc='Document shard'):
+                    _, _, shard_output, shard_instances = next(results)
+                    shard_outputs.append(shard_output)
+                    num_instances += shard_instances
+
+                metrics = previous[epoch] if epoch < len(previous) else None
+                epoch_filename = args.output_dir / f'epoch_{epoch}.json'
+                if args.output_format == 'npy':
+                    merge_epoch(args.output_dir, epoch, shard_outputs, args.max_seq_len, args.max_predictions_per_seq,
+                                keep_rows=metrics['num_training_examples'] if metrics else 0)
+                elif metrics:
+                    append_shards(epoch_filename, shard_outputs, metrics.get('num_bytes', epoch_filename.stat().st_size))
+                else:
+                    merge_shards(epoch_filename, shard_outputs)
+
+                if metrics:
+                    metrics = dict(metrics, num_training_examples=metrics['num_training_examples'] + num_instances)
+                else:
+                    metrics = {
+                        'num_training_examples': num_instances,
+                        'max_seq_len': args.max_seq_len,
+                        'seed': args.seed,
+                        'docs_per_shard': args.docs_per_shard,
+                        'format': args.output_format,
+                        'max_predictions_per_seq': args.max_predictions_per_seq,
+                        'vectorized': args.vectorized or args.dynamic_masking,
+                        'masked': not args.dynamic_masking,
+                        'masked_lm_prob': args.masked_lm_prob
+                    }
+                metrics['num_documents'] = len(docs)
+                if args.output_format == 'json':
+                    metrics['num_bytes'] = epoch_filename.stat().st_size
+                write_metrics(args.output_dir, epoch, metrics)
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
 
 
 if __name__ == '__main__':
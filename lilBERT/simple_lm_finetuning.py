@@ -20,6 +20,7 @@ from __future__ import absolute_import, division, print_function, unicode_litera
 import argparse
 import logging
 import os
+import sys
 import random
 from io import open
 
@@ -33,6 +34,11 @@ from pytorch_pretrained_bert.modeling import BertForPreTraining
 from pytorch_pretrained_bert.tokenization import BertTokenizer
 from pytorch_pretrained_bert.optimization import BertAdam, WarmupLinearSchedule
 
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'data', 'formatting'))
+from corpus_io import iter_corpus_lines
+from token_corpus import TokenCorpus
+from token_cache import CachedTokenizer
+
 logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
                     datefmt='%m/%d/%Y %H:%M:%S',
                     level=logging.INFO)
@@ -40,16 +46,23 @@ logger = logging.getLogger(__name__)
 
 
 class BERTDataset(Dataset):
-    def __init__(self, corpus_path, tokenizer, seq_len, encoding="utf-8", corpus_lines=None, on_memory=True):
+    def __init__(self, corpus_path, tokenizer, seq_len, encoding="utf-8", corpus_lines=None, on_memory=True,
+                 read_workers=1):
         self.vocab = tokenizer.vocab
         self.tokenizer = tokenizer
         self.seq_len = seq_len
         self.on_memory = on_memory
         self.corpus_lines = corpus_lines  # number of non-empty lines in input corpus
-        self.corpus_path = corpus_path
+        self.corpus_path = corpus_path  # file, directory or glob of (gzipped) shards
         self.encoding = encoding
+        self.read_workers = read_workers
         self.current_doc = 0  # to avoid random sentence from same doc
 
+        # pre-tokenized corpora store line indices instead of text and are always random access
+        self.token_corpus = TokenCorpus(corpus_path) if TokenCorpus.is_token_corpus(corpus_path) else None
+        if self.token_corpus is not None:
+            on_memory = self.on_memory = True
+
         # for loading samples directly from file
         self.sample_counter = 0  # used to keep track of full epochs on file
         self.line_buffer = None  # keep second sentence of a pair in memory and use as first sentence in next pair
@@ -59,26 +72,37 @@ class BERTDataset(Dataset):
         self.num_docs = 0
         self.sample_to_doc = [] # map sample index to doc and line
 
+        # load line indices of a pre-tokenized corpus, sections are documents
+        if self.token_corpus is not None:
+            self.all_docs = []
+            for s in range(self.token_corpus.n_sections):
+                doc = list(self.token_corpus.section_lines(s))
+                for line in range(len(doc) - 1):
+                    self.sample_to_doc.append({"doc_id": len(self.all_docs), "line": line})
+                self.all_docs.append(doc)
+            self.corpus_lines = self.token_corpus.n_lines
+            self.num_docs = len(self.all_docs)
+
         # load samples into memory
-        if on_memory:
+        elif on_memory:
             self.all_docs = []
             doc = []
             self.corpus_lines = 0
-            with open(corpus_path, "r", encoding=encoding) as f:
-                for line in tqdm(f, desc="Loading Dataset", total=corpus_lines):
-                    line = line.strip()
-                    if line == "":
-                        self.all_docs.append(doc)
-                        doc = []
-                        #remove last added sample because there won't be a subsequent line anymore in the doc
-                        self.sample_to_doc.pop()
-                    else:
-                        #store as one sample
-                        sample = {"doc_id": len(self.all_docs),
-                                  "line": len(doc)}
-                        self.sample_to_doc.append(sample)
-                        doc.append(line)
-                        self.corpus_lines = self.corpus_lines + 1
+            lines = iter_corpus_lines(corpus_path, workers=read_workers, encoding=encoding)
+            for line in tqdm(lines, desc="Loading Dataset", total=corpus_lines):
+                line = line.strip()
+                if line == "":
+                    self.all_docs.append(doc)
+                    doc = []
+                    #remove last added sample because there won't be a subsequent line anymore in the doc
+                    self.sample_to_doc.pop()
+                else:
+                    #store as one sample
+                    sample = {"doc_id": len(self.all_docs),
+                              "line": len(doc)}
+                    self.sample_to_doc.append(sample)
+                    doc.append(line)
+                    self.corpus_lines = self.corpus_lines + 1
 
             # if last row in file is not empty
             if self.all_docs[-1] != doc:
@@ -90,20 +114,30 @@ class BERTDataset(Dataset):
         # load samples later lazily from disk
         else:
             if self.corpus_lines is None:
-                with open(corpus_path, "r", encoding=encoding) as f:
-                    self.corpus_lines = 0
-                    for line in tqdm(f, desc="Loading Dataset", total=corpus_lines):
-                        if line.strip() == "":
-                            self.num_docs += 1
-                        else:
-                            self.corpus_lines += 1
-
-                    # if doc does not end with empty line
-                    if line.strip() != "":
+                self.corpus_lines = 0
+                lines = iter_corpus_lines(corpus_path, workers=read_workers, encoding=encoding)
+                for line in tqdm(lines, desc="Loading Dataset", total=corpus_lines):
+                    if line.strip() == "":
                         self.num_docs += 1
+                    else:
+                        self.corpus_lines += 1
 
-            self.file = open(corpus_path, "r", encoding=encoding)
-            self.random_file = open(corpus_path, "r", encoding=encoding)
+                # if doc does not end with empty line
+                if line.strip() != "":
+                    self.num_docs += 1
+
+            self.file = self.open_corpus()
+            self.random_file = self.open_corpus()
+
+    def open_corpus(self):
+        """Streams every shard of the corpus as one file"""
+        return iter_corpus_lines(self.corpus_path, workers=self.read_workers, encoding=self.encoding)
+
+    def line_tokens(self, line):
+        """Tokens of a corpus line. Pre-tokenized lines are indices and only need a vocab lookup."""
+        if self.token_corpus is None:
+            return self.tokenizer.tokenize(line)
+        return self.tokenizer.convert_ids_to_tokens(self.token_corpus.line(line).tolist())
 
     def __len__(self):
         # last line of doc won't be used, because there's no "nextSentence". Additionally, we start counting at 0.
@@ -116,13 +150,13 @@ class BERTDataset(Dataset):
             # after one epoch we start again from beginning of file
             if cur_id != 0 and (cur_id % len(self) == 0):
                 self.file.close()
-                self.file = open(self.corpus_path, "r", encoding=self.encoding)
+                self.file = self.open_corpus()
 
         t1, t2, is_next_label = self.random_sent(item)
 
         # tokenize
-        tokens_a = self.tokenizer.tokenize(t1)
-        tokens_b = self.tokenizer.tokenize(t2)
+        tokens_a = self.line_tokens(t1)
+        tokens_b = self.line_tokens(t2)
 
         # combine to one sample
         cur_example = InputExample(guid=cur_id, tokens_a=tokens_a, tokens_b=tokens_b, is_next=is_next_label)
@@ -152,8 +186,9 @@ class BERTDataset(Dataset):
             t2 = self.get_random_line()
             label = 1
 
-        assert len(t1) > 0
-        assert len(t2) > 0
+        if self.token_corpus is None:
+            assert len(t1) > 0
+            assert len(t2) > 0
         return t1, t2, label
 
     def get_corpus_line(self, item):
@@ -226,7 +261,7 @@ class BERTDataset(Dataset):
                 line = next(self.random_file).strip()
         except StopIteration:
             self.random_file.close()
-            self.random_file = open(self.corpus_path, "r", encoding=self.encoding)
+            self.random_file = self.open_corpus()
             line = next(self.random_file).strip()
         return line
 
@@ -405,7 +440,8 @@ def main():
                         default=None,
                         type=str,
                         required=True,
-                        help="The input train corpus.")
+                        help="The input train corpus: a file, directory or glob of (gzipped) shards, "
+                             "or a pre-tokenized corpus written by clean_lyrics.py --token-ids.")
     parser.add_argument("--bert_model", default=None, type=str, required=True,
                         help="Bert pre-trained model selected in the list: bert-base-uncased, "
                              "bert-large-uncased, bert-base-cased, bert-base-multilingual, bert-base-chinese.")
@@ -448,9 +484,22 @@ def main():
     parser.add_argument("--on_memory",
                         action='store_true',
                         help="Whether to load train samples into memory or use disk")
+    parser.add_argument("--read_workers",
+                        default=1,
+                        type=int,
+                        help="Number of corpus shards to decompress in parallel")
     parser.add_argument("--do_lower_case",
                         action='store_true',
                         help="Whether to lower case the input text. True for uncased models, False for cased models.")
+    parser.add_argument("--token_cache_size",
+                        default=1 << 18,
+                        type=int,
+                        help="Corpus lines whose tokens are memoized, so repeated lines are only tokenized once. "
+                             "0 disables the cache")
+    parser.add_argument("--token_cache_file",
+                        default=None,
+                        type=str,
+                        help="Load the token cache from and save it to this .json.gz file")
     parser.add_argument("--local_rank",
                         type=int,
                         default=-1,
@@ -507,13 +556,16 @@ def main():
         os.makedirs(args.output_dir)
 
     tokenizer = BertTokenizer.from_pretrained(args.bert_model, do_lower_case=args.do_lower_case)
+    if args.token_cache_size:
+        tokenizer = CachedTokenizer(tokenizer, args.bert_model, args.do_lower_case,
+                                    max_size=args.token_cache_size, cache_file=args.token_cache_file)
 
     #train_examples = None
     num_train_optimization_steps = None
     if args.do_train:
         print("Loading Train Dataset", args.train_corpus)
         train_dataset = BERTDataset(args.train_corpus, tokenizer, seq_len=args.max_seq_length,
-                                    corpus_lines=None, on_memory=args.on_memory)
+                                    corpus_lines=None, on_memory=args.on_memory, read_workers=args.read_workers)
         num_train_optimization_steps = int(
             len(train_dataset) / args.train_batch_size / args.gradient_accumulation_steps) * args.num_train_epochs
         if args.local_rank != -1:
@@ -611,6 +663,11 @@ def main():
                     optimizer.zero_grad()
                     global_step += 1
 
+        if isinstance(tokenizer, CachedTokenizer):
+            logger.info("  Token cache = %s", tokenizer.stats())
+            if args.token_cache_file:
+                tokenizer.save()
+
         # Save a trained model
         logger.info("** ** * Saving fine - tuned model ** ** * ")
         model_to_save = model.module if hasattr(model, 'module') else model  # Only save the model it-self
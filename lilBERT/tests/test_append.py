@@ -0,0 +1,92 @@
+"""
+The --append workflow end to end: a cleaning run writes a corpus, pregenerate_training_data.py --save_documents
+generates epochs from it, a second cleaning run adds songs and --append adds their instances to the epochs.
+"""
+import os
+import sys
+import json
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', '..', 'data', 'formatting'))
+for module in ['spacy', 'spacy_langdetect', 'pytorch_pretrained_bert']:
+    pytest.importorskip(module)
+
+from pytorch_pretrained_bert import BertTokenizer  # noqa: E402
+from clean_lyrics import CleanCorpusWriter  # noqa: E402
+from token_corpus import TokenCorpus  # noqa: E402
+from epoch_format import read_metrics  # noqa: E402
+import pregenerate_training_data  # noqa: E402
+
+TOKENIZER_TYPE = 'bert-base-uncased'
+WORDS = [f'w{i}' for i in range(200)]
+
+
+@pytest.fixture
+def vocab(tmp_path, monkeypatch):
+    """A small vocabulary that every BertTokenizer.from_pretrained loads, so nothing is downloaded"""
+    vocab_file = tmp_path / 'vocab.txt'
+    vocab_file.write_text('\n'.join(['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + WORDS) + '\n')
+    monkeypatch.setattr(BertTokenizer, 'from_pretrained',
+                        classmethod(lambda cls, *args, **kwargs: cls(str(vocab_file), do_lower_case=True)))
+    return BertTokenizer.from_pretrained(TOKENIZER_TYPE).vocab
+
+
+def song(n, vocab):
+    """Three sections of three lines, different for every n"""
+    sections = [[' '.join(WORDS[(n * 7 + s * 3 + l + k) % len(WORDS)] for k in range(4 + l)) for l in range(3)]
+                for s in range(3)]
+    token_ids = [[[vocab[word] for word in line.split()] + [vocab['[SEP]']] for line in section]
+                 for section in sections]
+    return {'artist': f'artist {n % 4}', 'title': f'song {n}', 'year': '2019', 'sections': sections,
+            'token_ids': token_ids}
+
+
+def clean(clean_dir, songs, vocab):
+    with CleanCorpusWriter(clean_dir, TOKENIZER_TYPE, clean_dir / 'progress.sqlite', commit_every=8,
+                           token_ids=True) as writer:
+        for n in songs:
+            writer.add(song(n, vocab), clean_dir / f'lyrics_{n}.json', stat=(100, 0.0))
+
+
+def pregenerate(monkeypatch, train_corpus, output_dir, *extra):
+    monkeypatch.setattr(sys, 'argv', ['pregenerate_training_data.py', '--train_corpus', str(train_corpus),
+                                      '--bert_model', TOKENIZER_TYPE, '--do_lower_case', '--output_dir',
+                                      str(output_dir), '--max_seq_len', '64', '--seed', '3'] + list(extra))
+    pregenerate_training_data.main()
+
+
+def epoch_instances(output_dir, epoch):
+    with open(output_dir / f'epoch_{epoch}.json') as ef:
+        return [json.loads(line) for line in ef]
+
+
+@pytest.mark.parametrize('corpus', ['shards', 'token_corpus'])
+def test_clean_pregenerate_clean_append(tmp_path, monkeypatch, vocab, corpus):
+    clean_dir, output_dir = tmp_path / 'clean', tmp_path / 'pregenerated'
+    clean_dir.mkdir()
+    prefix = clean_dir / f'train-{TOKENIZER_TYPE}'
+    train_corpus = clean_dir / f'*-train-{TOKENIZER_TYPE}.txt.gz' if corpus == 'shards' else prefix
+
+    clean(clean_dir, range(60), vocab)
+    shards = {path: path.read_bytes() for path in clean_dir.glob(f'*-train-{TOKENIZER_TYPE}.txt.gz')}
+    pregenerate(monkeypatch, train_corpus, output_dir, '--save_documents', '--epochs_to_generate', '2')
+    first = [read_metrics(output_dir, epoch) for epoch in range(2)]
+    assert first[0]['num_documents'] == TokenCorpus(prefix).n_sections
+
+    # The second run leaves the shards of the first one as they are
+    clean(clean_dir, range(60, 100), vocab)
+    assert all(path.read_bytes() == data for path, data in shards.items())
+    assert len(list(clean_dir.glob(f'*-train-{TOKENIZER_TYPE}.txt.gz'))) > len(shards)
+
+    pregenerate(monkeypatch, train_corpus, output_dir, '--append')
+    num_documents = TokenCorpus(prefix).n_sections
+    assert num_documents > first[0]['num_documents']
+    for epoch in range(2):
+        metrics = read_metrics(output_dir, epoch)
+        assert metrics['num_documents'] == num_documents
+        assert metrics['num_training_examples'] > first[epoch]['num_training_examples']
+        assert len(epoch_instances(output_dir, epoch)) == metrics['num_training_examples']
+    # Only the existing epochs are extended, no new ones are generated
+    assert not (output_dir / 'epoch_2.json').exists()
@@ -0,0 +1,144 @@
+"""
+Statistical equivalence of instance_builder.InstanceBuilder and create_instances_from_document.
+
+The vectorized builder draws its random numbers differently, so the two are compared by the distributions
+of what they generate: truncation (instance and segment A lengths, [SEP] counts), next sentence sampling,
+the 40/60 line-end/interior split of the masked positions and the 80/10/10 [MASK]/original/random policy.
+"""
+import os
+import sys
+import random
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from pregenerate_training_data import DocumentDatabase, create_instances_from_document  # noqa: E402
+from instance_builder import InstanceBuilder, batch_to_instances, instance_statistics, compare_statistics  # noqa: E402
+
+MAX_SEQ_LEN = 128
+SHORT_SEQ_PROB = 0.1
+MASKED_LM_PROB = 0.15
+MAX_PREDICTIONS = 20
+NUM_DOCS = 1500
+SEED = 12345
+
+# Relative tolerance of compare_statistics (0.01 absolute for small values)
+TOLERANCE = 0.05
+# Absolute tolerance of the replacement policy shares around 0.8 / 0.1 / 0.1
+POLICY_TOLERANCE = 0.02
+
+
+@pytest.fixture(scope='module')
+def vocab():
+    tokens = ['[PAD]', '[UNK]', '[CLS]', '[SEP]', '[MASK]'] + [f'w{i}' for i in range(500)]
+    return {token: i for i, token in enumerate(tokens)}
+
+
+@pytest.fixture(scope='module')
+def docs(vocab):
+    """Songs of 2-12 sections of 2-6 lines of 3-10 words, every line ending in [SEP] like cleaned lyrics"""
+    rng = np.random.RandomState(0)
+    words = [token for token in vocab if token.startswith('w')]
+    database = DocumentDatabase(vocab)
+    for _ in range(NUM_DOCS):
+        document = []
+        for _ in range(rng.randint(2, 13)):
+            section = []
+            for _ in range(rng.randint(2, 7)):
+                section.extend(words[w] for w in rng.randint(0, len(words), size=rng.randint(3, 11)))
+                section.append('[SEP]')
+            document.append(section)
+        database.add_document(document)
+    database.freeze()
+    yield database
+    database.__exit__(None, None, None)
+
+
+@pytest.fixture(scope='module')
+def reference(docs, vocab):
+    random.seed(SEED)
+    np.random.seed(SEED)
+    vocab_list = list(vocab)
+    return instance_statistics(
+        instance for doc_idx in range(len(docs)) for instance in create_instances_from_document(
+            docs, doc_idx, max_seq_length=MAX_SEQ_LEN, short_seq_prob=SHORT_SEQ_PROB, masked_lm_prob=MASKED_LM_PROB,
+            max_predictions_per_seq=MAX_PREDICTIONS, vocab_list=vocab_list))
+
+
+def build_batches(docs, vocab, seed=SEED, masked=True):
+    builder = InstanceBuilder(docs, MAX_SEQ_LEN, SHORT_SEQ_PROB, MASKED_LM_PROB, MAX_PREDICTIONS, vocab,
+                              rng=np.random.RandomState(seed), masked=masked)
+    return list(builder.batches(range(len(docs)), batch_size=1024))
+
+
+@pytest.fixture(scope='module')
+def vectorized(docs, vocab):
+    return instance_statistics(instance for batch in build_batches(docs, vocab)
+                               for instance in batch_to_instances(batch, docs.id_to_token))
+
+
+def test_enough_instances(reference, vectorized):
+    assert reference['instances'] > 2000
+    assert abs(vectorized['instances'] - reference['instances']) <= TOLERANCE * reference['instances']
+
+
+@pytest.mark.parametrize('statistic', ['tokens_per_instance', 'a_share', 'sep_per_instance'])
+def test_truncation_distribution(reference, vectorized, statistic):
+    rows = {key: (r, v, ok) for key, r, v, ok in compare_statistics(reference, vectorized, TOLERANCE)}
+    assert rows[statistic][2], f'{statistic}: reference {rows[statistic][0]:.4f}, vectorized {rows[statistic][1]:.4f}'
+
+
+def test_next_sentence_distribution(reference, vectorized):
+    assert abs(vectorized['random_next'] - reference['random_next']) <= 0.03
+
+
+def test_line_end_interior_split(reference, vectorized):
+    assert vectorized['masked_per_instance'] == pytest.approx(reference['masked_per_instance'], rel=TOLERANCE)
+    assert vectorized['masked_line_end'] == pytest.approx(reference['masked_line_end'], rel=TOLERANCE)
+    # int(0.4 * k) line ends and int(0.6 * k) interior tokens of k predictions
+    assert 0.3 <= vectorized['masked_line_end'] <= 0.45
+
+
+@pytest.mark.parametrize('statistic, share', [('replaced_by_mask', 0.8),
+                                              ('kept_original', 0.1),
+                                              ('replaced_by_random', 0.1)])
+def test_replacement_policy(reference, vectorized, statistic, share):
+    assert reference[statistic] == pytest.approx(share, abs=POLICY_TOLERANCE)
+    assert vectorized[statistic] == pytest.approx(share, abs=POLICY_TOLERANCE)
+
+
+def test_instances_are_well_formed(docs, vocab):
+    cls_id, sep_id = vocab['[CLS]'], vocab['[SEP]']
+    for batch in build_batches(docs, vocab):
+        lengths = batch['lengths'].astype(np.int64)
+        a_lengths = batch['a_lengths'].astype(np.int64)
+        rows = np.arange(len(lengths))
+        assert (lengths <= MAX_SEQ_LEN).all() and (a_lengths < lengths).all()
+        # The instances before masking
+        original = batch['input_ids'].copy()
+        masked_rows, slots = np.nonzero(batch['masked_lm_positions'] >= 0)
+        masked_columns = batch['masked_lm_positions'][masked_rows, slots].astype(np.int64)
+        original[masked_rows, masked_columns] = batch['masked_lm_ids'][masked_rows, slots]
+        assert (original[:, 0] == cls_id).all()
+        assert (original[rows, a_lengths - 1] == sep_id).all() and (original[rows, lengths - 1] == sep_id).all()
+        assert (masked_columns < lengths[masked_rows]).all()
+        # Like create_masked_lm_predictions, [CLS] and [SEP] are only masked as the line end of a [SEP] after
+        # them, which happens when truncation leaves a segment starting with [SEP]
+        special = np.isin(original[masked_rows, masked_columns], [cls_id, sep_id])
+        assert (original[masked_rows[special], masked_columns[special] + 1] == sep_id).all()
+
+
+def test_unmasked_instances_have_no_predictions(docs, vocab):
+    for batch in build_batches(docs, vocab, masked=False):
+        assert (batch['masked_lm_positions'] == -1).all()
+        assert not (batch['input_ids'] == vocab['[MASK]']).any()
+
+
+def test_same_seed_same_instances(docs, vocab):
+    first, second = build_batches(docs, vocab, seed=7), build_batches(docs, vocab, seed=7)
+    assert len(first) == len(second)
+    for a, b in zip(first, second):
+        for name in a:
+            assert np.array_equal(a[name], b[name])